@@ -3,6 +3,7 @@ import asyncio
 import datetime
 import functools
 import hashlib
+import ipaddress
 import json
 import uuid
 
@@ -20,6 +21,23 @@ def gen_token():
     return uuid.uuid4().hex
 
 
+def ip_to_int(ip):
+    """integer of an ipv4 address(mysql INET_ATON), None when it isn't one"""
+    try:
+        return int(ipaddress.IPv4Address(ip))
+    except ValueError:
+        return None
+
+
+def cidr_to_int_range(cidr):
+    """
+    (first, last) integer address of an ipv4 network, host bits are ignored: 10.0.0.1/24 -> 10.0.0.0-10.0.0.255
+    :raise ValueError: not an ipv4 network
+    """
+    network = ipaddress.IPv4Network(cidr, strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
 class Now:
 
     def __init__(self):
@@ -73,6 +91,66 @@ def object_cache(f):
     return wrapper
 
 
+class LazyJson:
+    """
+    raw json text of a large column, decoded on first access
+    reads like the decoded dict/list: lazy["k"], lazy.get("k"), len(lazy), iter(lazy) ...
+    """
+    __slots__ = ("_raw", "_value", "_decoded")
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._value = None
+        self._decoded = False
+
+    @property
+    def decoded(self):
+        return self._decoded
+
+    @property
+    def value(self):
+        if not self._decoded:
+            self._value = json.loads(self._raw)
+            self._raw = None
+            self._decoded = True
+        return self._value
+
+    def get(self, k, default=None):
+        return self.value.get(k, default)
+
+    def keys(self):
+        return self.value.keys()
+
+    def values(self):
+        return self.value.values()
+
+    def items(self):
+        return self.value.items()
+
+    def __getitem__(self, k):
+        return self.value[k]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __contains__(self, k):
+        return k in self.value
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __eq__(self, other):
+        return self.value == (other.value if isinstance(other, LazyJson) else other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"LazyJson({self.value!r})" if self._decoded else f"LazyJson(<{len(self._raw)} raw>)"
+
+
 class BaseJsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
@@ -81,6 +159,8 @@ class BaseJsonEncoder(json.JSONEncoder):
             return list(obj)
         elif isinstance(obj, Object):
             return obj.meta
+        elif isinstance(obj, LazyJson):
+            return obj.value
         else:
             return json.JSONEncoder.default(self, obj)
 
@@ -53,6 +53,7 @@ PMS_SEARCH_OPERATION = "search_operation"
 PMS_SEARCH_TASK = "search_task"
 PMS_DELETE_TASK = "delete_task"
 PMS_OPERATION_TASK = "operation_task"
+PMS_MANAGE_ADMISSION = "manage_admission"
 
 PMS_TYPE_OVERALL = "overall"
 PMS_TYPE_PRIVATE = "private"
@@ -88,6 +89,7 @@ OVERALL_PMSS = {PMS_CREATE_USER,
                 PMS_DELETE_OPERATOR,
                 PMS_MODIFY_OPERATOR,
                 PMS_SEARCH_OPERATOR,
+                PMS_MANAGE_ADMISSION,
                 *PRIVATE_PMSS
                 }
 
@@ -114,6 +116,12 @@ TASK_STATUS_FINISH = "finish"
 TASK_STATUS_SUCCESS = "success"
 TASK_STATUS_FAILURE = "failure"
 
+# task queue levels, highest first
+TASK_PRIORITY_URGENT = "urgent"
+TASK_PRIORITY_NORMAL = "normal"
+TASK_PRIORITY_BULK = "bulk"
+TASK_PRIORITIES = [TASK_PRIORITY_URGENT, TASK_PRIORITY_NORMAL, TASK_PRIORITY_BULK]
+
 TASK_ALL_STATUS = [TASK_STATUS_WAIT,
                    TASK_STATUS_QUEUE,
                    TASK_STATUS_ROUTER,
@@ -132,3 +140,7 @@ TASK_RETURN_CODE_SFTP_TRANSFER_IO_ERROR = -2202
 TASK_RETURN_CODE_UNKNOWN_ERROR = -3000
 TASK_RETURN_CODE_SYSTEM_ERROR = -5000
 TASK_RETURN_CODE_UNKNOWN = -9999
+
+DB_ENGINE_THREAD = "thread"
+DB_ENGINE_ASYNC = "async"
+DB_ENGINES = [DB_ENGINE_THREAD, DB_ENGINE_ASYNC]
@@ -1,6 +1,7 @@
+from op_center.basic import cfg
 from op_center.server.worker_master import WorkerMaster
 
-worker_master = WorkerMaster()
+worker_master = WorkerMaster(**cfg.get("worker_master", {}))
 
 if __name__ == '__main__':
     worker_master.run_forever()
\ No newline at end of file
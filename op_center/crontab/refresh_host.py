@@ -1,10 +1,12 @@
 import logging
 
-from op_center.basic import HOST_ENV_PREFIX
+from op_center.basic import HOST_ENV_PREFIX, LazyJson
 from op_center.crontab import ABCCrontab
 from op_center.other_system.cmdb import CMDB
 from op_center.other_system.issystem import ISSystem
 from op_center.server import orm
+from op_center.server.host_filter_cache import host_filter_cache
+from op_center.server.host_filter_membership import HostFilterMembership
 
 logger = logging.getLogger(__name__)
 
@@ -16,19 +18,29 @@ class RefreshAllHost(ABCCrontab):
         self.issystem = ISSystem()
         self.host = orm.Host()
 
-    async def run(self):
+    @staticmethod
+    def mk_envs(ip, basic, issystem_info):
+        return {HOST_ENV_PREFIX + "IDC": basic["idc"],
+                HOST_ENV_PREFIX + "ENV": basic["env_type"],
+                HOST_ENV_PREFIX + "IP": ip,
+                HOST_ENV_PREFIX + "APP4": " ".join(issystem_info.get("app4", [])),
+                HOST_ENV_PREFIX + "ZONE": issystem_info.get("zone", ""),
+                HOST_ENV_PREFIX + "APP_NAME": " ".join(issystem_info.get("app_name", []))}
+
+    @staticmethod
+    def changed(host, row):
+        """the attributes host filters read differ between the stored host and the new row"""
+        if host is None:
+            return True
+        issystem = host["issystem"].value if isinstance(host["issystem"], LazyJson) else host["issystem"]
+        return not host["ok"] or host["basic"] != row["basic"] or issystem != row["issystem"]
 
-        created = 0
-        updated = 0
-        enabled = 0
+    async def run(self):
 
         print(f"get all host from cmdb ...")
         cmdb_hosts = await self.cmdb.get_hosts()
 
-        print(f"work start set all host state to disable...")
-        await self.host.query_update(ok=False)
-        total = await self.host.count()
-        print(f"work start set all host state to disable -> ok...")
+        rows = {}
         for basic in cmdb_hosts:
             ip = basic["main_ip"].strip()
             if ip == "127.0.0.1":
@@ -36,38 +48,39 @@ class RefreshAllHost(ABCCrontab):
             if type(ip) is not str:
                 raise RuntimeError(ip)
             issystem_info = await self.issystem.get_ip_basic_info(ip)
-            h = await self.host.only_or_none(orm.t.h.ip == ip)
-            if h:
-                # if await self.host.query(orm.t.h.ip == ip, orm.t.h.ok == True):
-                #     print(ip)
-                #     break
-                await self.host.query_update(orm.t.h.ip == ip,
-                                             basic=basic,
-                                             issystem=issystem_info,
-                                             envs={HOST_ENV_PREFIX + "IDC": basic["idc"],
-                                                   HOST_ENV_PREFIX + "ENV": basic["env_type"],
-                                                   HOST_ENV_PREFIX + "IP": ip,
-                                                   HOST_ENV_PREFIX + "APP4": " ".join(issystem_info.get("app4", [])),
-                                                   HOST_ENV_PREFIX + "ZONE": issystem_info.get("zone", ""),
-                                                   HOST_ENV_PREFIX + "APP_NAME": " ".join(
-                                                       issystem_info.get("app_name", []))},
-                                             ok=True)
-                updated += 1
-                print(f"host `{ip}` updated ...")
-            else:
-                await self.host.create(ip=ip,
-                                       basic=basic,
-                                       issystem=issystem_info,
-                                       envs={HOST_ENV_PREFIX + "IDC": basic["idc"],
-                                             HOST_ENV_PREFIX + "ENV": basic["env_type"],
-                                             HOST_ENV_PREFIX + "IP": ip,
-                                             HOST_ENV_PREFIX + "APP4": " ".join(issystem_info.get("app4", [])),
-                                             HOST_ENV_PREFIX + "ZONE": issystem_info.get("zone", ""),
-                                             HOST_ENV_PREFIX + "APP_NAME": " ".join(issystem_info.get("app_name", []))},
-                                       ok=True)
-                created += 1
-                print(f"host `{ip}` created ...")
-            enabled += 1
+            rows[ip] = dict(ip=ip,
+                            basic=basic,
+                            issystem=issystem_info,
+                            envs=self.mk_envs(ip, basic, issystem_info),
+                            ok=True)
+
+        existed = {h["ip"]: h for h in await self.host.query(columns=[orm.t.h.ip, orm.t.h.basic, orm.t.h.issystem,
+                                                                     orm.t.h.ok])}
+        total = len(existed)
+        missing = {ip for ip, host in existed.items() if host["ok"] and ip not in rows}
+        changed = {ip for ip, row in rows.items() if self.changed(existed.get(ip), row)} | missing
+
+        # only rows that really change are written, m_time of the others stays for the incremental readers
+        # (host_inventory refresh, HostFilterMembership.refresh_hosts)
+        print(f"work start set {len(missing)} missing host state to disable...")
+        if missing:
+            await self.host.bulk_update([{"ip": ip, "ok": False} for ip in sorted(missing)])
+        print(f"work start set {len(missing)} missing host state to disable -> ok...")
+        upserts = [row for ip, row in rows.items() if ip in changed]
+        if upserts:
+            await self.host.bulk_upsert(upserts)
+
+        # cached host filter results of the old host table are never read again
+        await host_filter_cache.bump_version()
+
+        print(f"work start re-test {len(changed)} changed hosts against saved host filters...")
+        deltas = await HostFilterMembership().refresh_hosts(changed)
+        for filter_id, (added, removed) in sorted(deltas.items()):
+            print(f"host filter {filter_id}:\t +{len(added)}\t -{len(removed)}")
+
+        created = len(rows.keys() - existed)
+        updated = len(rows.keys() & existed)
+        enabled = len(rows)
 
         print(f"""create: {created}\t update: {updated}\t total: {total}\t enable: {enabled}""")
 
@@ -1,6 +1,7 @@
 import aioredis
 
 from op_center.mq import ABCAsyncMQ
+from op_center.mq.scripts import RedisScript
 
 
 class ABCAsyncRedisMQ(ABCAsyncMQ):
@@ -28,5 +29,13 @@ class ABCAsyncRedisMQ(ABCAsyncMQ):
         self.LINK_POOL.close()
         await self.LINK_POOL.wait_closed()
 
+    async def run_script(self, script: RedisScript, keys=(), args=()):
+        try:
+            return await self.LINK_POOL.evalsha(script.sha, keys=list(keys), args=list(args))
+        except aioredis.errors.ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+        return await self.LINK_POOL.eval(script.source, keys=list(keys), args=list(args))
+
     def __init__(self, link_kwargs=None):
         self._link_kwargs = link_kwargs
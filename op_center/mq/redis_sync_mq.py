@@ -1,6 +1,8 @@
 import redis
+import redis.exceptions
 
 from op_center.mq import ABCSyncMQ
+from op_center.mq.scripts import RedisScript
 
 
 class ABCSyncRedisMQ(ABCSyncMQ):
@@ -41,6 +43,12 @@ class ABCSyncRedisMQ(ABCSyncMQ):
 
 class ABCSyncRedisOneLinkMQ(ABCSyncMQ):
 
+    def run_script(self, script: RedisScript, keys=(), args=()):
+        try:
+            return self.conn.evalsha(script.sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            return self.conn.eval(script.source, len(keys), *keys, *args)
+
     def available(self):
         try:
             if self.conn.ping():
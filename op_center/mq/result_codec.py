@@ -0,0 +1,164 @@
+import json
+import logging
+import zlib
+
+import msgpack
+
+from op_center.basic import cfg
+from op_center.mq import MQException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCodecException(MQException):
+    pass
+
+
+def truncate_output(text, limit):
+    """head and tail of `text` within `limit` chars, the cut part replaced by a marker"""
+    if len(text) <= limit:
+        return text
+    head = limit // 2
+    tail = limit - head
+    return "".join([text[:head], f"\n...[{len(text) - limit} chars truncated]...\n", text[len(text) - tail:]])
+
+
+class ResultCodec:
+    """
+    host result <-> bytes of the result stream entries(worker.mq.write_host_delta / write_host_result)
+    one header byte then msgpack, compressed once the msgpack is over `compress_threshold` bytes
+    top level stdout / stderr equal to the joined history outputs(ABCWorker.work_done) are left out and joined back
+    by decode, entries written as json by older workers are still decoded
+
+    workers write deltas: the top level fields changed since their last entry and the new history steps,
+    readers fold them(fold) onto the result they have, so every step is stored once
+    """
+    FORMAT_MSGPACK = 1
+    FORMAT_MSGPACK_ZLIB = 2
+    FORMAT_MSGPACK_ZSTD = 3
+    FORMAT_JSON = ord("{")
+
+    OUTPUT_KEYS = ("stdout", "stderr")
+
+    def __init__(self, *, compress="zlib", compress_threshold=1024, level=None, max_output=262144):
+        """
+        :param compress: zlib / zstd(falls back to zlib without the zstandard package) / None
+        :param max_output: stdout + stderr chars kept per host, None: no limit
+        """
+        if compress == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, host results are compressed by zlib")
+            compress = "zlib"
+        if compress not in ("zlib", "zstd", None):
+            raise ResultCodecException(f"unknown result compression {compress}, one of zlib / zstd / None")
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.level = level
+        self.max_output = max_output
+
+    def _joined_output(self, result, key):
+        return "".join(step.get(key) or "" for step in result.get("history") or [])
+
+    def encode(self, result: dict, whole=True) -> bytes:
+        """:param whole: a whole host result, False: a delta of diff, encoded as it is"""
+        if whole and result.get("history"):
+            result = {k: v for k, v in result.items()
+                      if k not in self.OUTPUT_KEYS or v != self._joined_output(result, k)}
+        data = msgpack.packb(result, use_bin_type=True)
+        if self.compress is None or len(data) < self.compress_threshold:
+            return bytes([self.FORMAT_MSGPACK]) + data
+        if self.compress == "zstd":
+            level = 3 if self.level is None else self.level
+            return bytes([self.FORMAT_MSGPACK_ZSTD]) + zstandard.ZstdCompressor(level=level).compress(data)
+        level = 6 if self.level is None else self.level
+        return bytes([self.FORMAT_MSGPACK_ZLIB]) + zlib.compress(data, level)
+
+    def decode(self, raw, whole=True) -> dict:
+        """:param raw: bytes of encode, or a json str / bytes"""
+        if isinstance(raw, str):
+            return json.loads(raw)
+        header, data = raw[0], raw[1:]
+        if header == self.FORMAT_JSON:
+            return json.loads(raw)
+        if header == self.FORMAT_MSGPACK_ZLIB:
+            data = zlib.decompress(data)
+        elif header == self.FORMAT_MSGPACK_ZSTD:
+            if zstandard is None:
+                raise ResultCodecException("host result is compressed by zstd, install zstandard to read it")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif header != self.FORMAT_MSGPACK:
+            raise ResultCodecException(f"unknown host result format {header}")
+        result = msgpack.unpackb(data, raw=False)
+        if whole and result.get("history"):
+            for key in self.OUTPUT_KEYS:
+                if key not in result:
+                    result[key] = self._joined_output(result, key)
+        return result
+
+    def diff(self, written, steps, result) -> dict:
+        """
+        :param written: top level fields of the result already written
+        :param steps: number of history steps already written
+        :return: delta of `result`, {} when nothing changed,
+                 outputs equal to the joined history are only named in delta["joined"]
+        """
+        delta = {k: v for k, v in result.items() if k != "history" and (k not in written or written[k] != v)}
+        history = result.get("history") or []
+        for key in self.OUTPUT_KEYS:
+            if delta.get(key) and history and delta[key] == self._joined_output(result, key):
+                del delta[key]
+                delta.setdefault("joined", []).append(key)
+        if len(history) > steps:
+            delta["history"] = history[steps:]
+        return delta
+
+    def fold(self, result, delta) -> dict:
+        """:return: a new result, `result`(None before the first delta) with `delta` of diff applied"""
+        result = dict(result or {})
+        delta = dict(delta)
+        joined = delta.pop("joined", [])
+        steps = delta.pop("history", [])
+        result.update(delta)
+        result["history"] = [*(result.get("history") or []), *steps]
+        for key in joined:
+            result[key] = self._joined_output(result, key)
+        return result
+
+    def decode_entry(self, fields) -> dict:
+        """
+        :param fields: {field name: value} of a result stream entry as bytes
+        :return: {"ip": xxx, "delta": decoded delta} or {"ip": xxx, "result": decoded host result}
+        """
+        fields = {k.decode() if isinstance(k, bytes) else k: v for k, v in fields.items()}
+        ip = fields["ip"]
+        entry = {"ip": ip.decode() if isinstance(ip, bytes) else ip}
+        if "delta" in fields:
+            entry["delta"] = self.decode(fields["delta"], whole=False)
+        else:
+            entry["result"] = self.decode(fields["result"])
+        return entry
+
+    def cap_output(self, step, used=0):
+        """
+        truncate stdout / stderr of a history step in place to what is left of max_output
+        :param used: output chars of the host before the step
+        :return: output chars of the host after the step
+        """
+        if self.max_output is None:
+            return used
+        for key in self.OUTPUT_KEYS:
+            text = step.get(key)
+            if not text:
+                continue
+            left = max(self.max_output - used, 0)
+            if len(text) > left:
+                step[key] = truncate_output(text, left)
+            used += min(len(text), left)
+        return used
+
+
+result_codec = ResultCodec(**cfg.get("result_codec", {}))
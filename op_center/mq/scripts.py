@@ -0,0 +1,415 @@
+"""
+lua scripts run by the mqs, every task status transition is one atomic round trip:
+counters of a task status hash can't be left half updated by a crash between two commands
+
+field names are passed in ARGV, the scripts don't know the TASK_STATUS_* constants
+"""
+import hashlib
+
+
+class RedisScript:
+    """
+    lua source and its sha1, mqs run it with EVALSHA and fall back to EVAL on NOSCRIPT
+    (redis was restarted / flushed since the script was loaded)
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    def __repr__(self):
+        return f"<RedisScript {self.name} {self.sha}>"
+
+
+# KEYS[1] task status hash
+# ARGV field value [field value ...]
+SET_TASK_STATUS = RedisScript("set_task_status", """
+for i = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return #ARGV / 2
+""")
+
+# one host moves from counter ARGV[1] to counter ARGV[2]
+# :return: new value of ARGV[2]
+MOVE_HOST = RedisScript("move_host", """
+redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+return redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+""")
+
+# a host finished: leaves counter ARGV[1], counted in finish counter ARGV[2] and result counter ARGV[3],
+# the host making finish reach total(ARGV[4] field) adds the task done event to stream KEYS[2]
+# ARGV[5] task id, ARGV[6] approximate max length of the stream
+# :return: {finish, total(false when missing)}
+FINISH_HOST = RedisScript("finish_host", """
+redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+redis.call('HINCRBY', KEYS[1], ARGV[3], 1)
+local finish = redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+local total = redis.call('HGET', KEYS[1], ARGV[4])
+if total and finish == tonumber(total) then
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[6], '*', 'task_id', ARGV[5], 'event', 'done')
+end
+return {finish, total}
+""")
+
+# admission control, usage / limits per scope: global and the group of the task
+# fields: queued_tasks, queued_hosts, running_tasks, running_hosts, a missing limit is unlimited,
+# a task weighs its host count in the *_hosts fields, one that is heavier than a host limit is still
+# admitted when nothing else of the scope is queued / running(it would never be otherwise)
+# admission tasks hash: task id -> "state:weight:enqueued at:group"
+# scripts using it take ADMISSION_KEYS first:
+#   KEYS[1] global limits, KEYS[2] global usage, KEYS[3] group limits, KEYS[4] group usage,
+#   KEYS[5] limits of groups without their own, KEYS[6] admission tasks hash, KEYS[7] stats hash
+ADMISSION_KEYS = 7
+_ADMISSION = """
+local scopes = {{'global', {KEYS[1]}, KEYS[2]}, {'group', {KEYS[3], KEYS[5]}, KEYS[4]}}
+
+local function limit_of(limits, field)
+    for _, key in ipairs(limits) do
+        local limit = redis.call('HGET', key, field)
+        if limit then
+            return tonumber(limit)
+        end
+    end
+    return -1
+end
+
+-- :return: false when admitted, else {scope, limit field, usage, limit}
+local function over_limit(kind, weight)
+    for _, scope in ipairs(scopes) do
+        local tasks = tonumber(redis.call('HGET', scope[3], kind .. '_tasks') or '0')
+        local max_tasks = limit_of(scope[2], kind .. '_tasks')
+        if max_tasks >= 0 and tasks + 1 > max_tasks then
+            return {scope[1], kind .. '_tasks', tasks, max_tasks}
+        end
+        local hosts = tonumber(redis.call('HGET', scope[3], kind .. '_hosts') or '0')
+        local max_hosts = limit_of(scope[2], kind .. '_hosts')
+        if max_hosts >= 0 and tasks > 0 and hosts + weight > max_hosts then
+            return {scope[1], kind .. '_hosts', hosts, max_hosts}
+        end
+    end
+    return false
+end
+
+local function add_usage(kind, tasks, hosts)
+    for _, scope in ipairs(scopes) do
+        redis.call('HINCRBY', scope[3], kind .. '_tasks', tasks)
+        redis.call('HINCRBY', scope[3], kind .. '_hosts', hosts)
+    end
+end
+
+local function reject(kind, rejection)
+    redis.call('HINCRBY', KEYS[7], rejection[1] .. ':rejected_' .. kind, 1)
+    return {0, rejection[1], rejection[2], rejection[3], rejection[4]}
+end
+
+-- :return: state, weight, enqueued at or nil
+local function admitted(task_id)
+    local entry = redis.call('HGET', KEYS[6], task_id)
+    if not entry then
+        return nil
+    end
+    local state, weight, enqueued_at = string.match(entry, '^(%a+):(%d+):([%d%.]+):')
+    return state, tonumber(weight), tonumber(enqueued_at)
+end
+"""
+
+# task queues: one list per (priority level, group), levels are served in strict priority order,
+# the groups of a level by start time fair queueing: the sched zset of a level holds the active groups
+# scored by the virtual start time of their next task, the lowest one is popped, its group then moves
+# on by the host count of the task / the group weight, so each group gets its weighted share of hosts
+# scripts using them take QUEUE_KEYS, from the one given to queue_keys:
+#   +0 <base>                the list of the single fifo queue, still drained after the levels
+#   +1 {<base>}_positions    hash task id -> "level:group:weight:enqueued at", until the task is acked
+#   +2 {<base>}_sched_state  hash clock:<level> -> virtual time of the level, finish:<level>:<group>
+#   +3 {<base>}_weights      hash group -> weight(default 1)
+#   +4 {<base>}_signal       list a push adds a token to, idle masters block on it
+#   +5 {<base>}_stats        hash wait time counters per level and per level:group
+# the keys of a level / group can't be known before the pop, they are named after the base:
+#   {<base>}_<level>_<group> task ids, LPUSH in / RPOP out
+#   {<base>}_sched_<level>   zset group -> virtual start time
+# the mqs hash tag the admission and lease keys {<base>} too, a tag hashes what is in the braces so every key
+# of the queue, lease and admission scripts is in the slot of <base>, a redis cluster runs them on one node,
+# only the task info / status keys ENQUEUE_TASK writes along are in the slots of their task
+QUEUE_KEYS = 6
+_QUEUES = """
+local function queue_keys(first)
+    local base = KEYS[first]
+    return {base = base, tag = '{' .. base .. '}', positions = KEYS[first + 1], state = KEYS[first + 2],
+            weights = KEYS[first + 3], signal = KEYS[first + 4], stats = KEYS[first + 5]}
+end
+
+local function queue_key(q, level, group)
+    return q.tag .. '_' .. level .. '_' .. group
+end
+
+local function sched_key(q, level)
+    return q.tag .. '_sched_' .. level
+end
+
+local function queue_position(q, task_id)
+    local entry = redis.call('HGET', q.positions, task_id)
+    if not entry then
+        return nil
+    end
+    local level, group, weight, enqueued_at = string.match(entry, '^(%w+):(.+):(%d+):([%d%.]+)$')
+    return level, group, tonumber(weight), tonumber(enqueued_at)
+end
+
+-- :param front: true -> the next one popped from its group queue
+local function queue_push(q, task_id, level, group, weight, enqueued_at, front)
+    local queue = queue_key(q, level, group)
+    redis.call('HSET', q.positions, task_id, level .. ':' .. group .. ':' .. weight .. ':' .. enqueued_at)
+    if front then
+        redis.call('RPUSH', queue, task_id)
+    else
+        redis.call('LPUSH', queue, task_id)
+    end
+    local sched = sched_key(q, level)
+    if not redis.call('ZSCORE', sched, group) then
+        local clock = tonumber(redis.call('HGET', q.state, 'clock:' .. level) or '0')
+        local finish = tonumber(redis.call('HGET', q.state, 'finish:' .. level .. ':' .. group) or '0')
+        redis.call('ZADD', sched, math.max(clock, finish), group)
+    end
+    redis.call('LPUSH', q.signal, 1)
+    redis.call('LTRIM', q.signal, 0, 999)
+    return redis.call('LLEN', queue)
+end
+
+local function count_wait(q, name, waited)
+    redis.call('HINCRBY', q.stats, name .. ':dequeued', 1)
+    redis.call('HINCRBYFLOAT', q.stats, name .. ':wait_seconds', waited)
+    if waited > tonumber(redis.call('HGET', q.stats, name .. ':max_wait_seconds') or '0') then
+        redis.call('HSET', q.stats, name .. ':max_wait_seconds', waited)
+    end
+end
+
+-- :return: {task id, level, group, seconds waited(string)} or false
+local function queue_pop(q, levels, now)
+    for _, level in ipairs(levels) do
+        local sched = sched_key(q, level)
+        local head = redis.call('ZRANGE', sched, 0, 0, 'WITHSCORES')
+        while #head > 0 do
+            local group, start = head[1], tonumber(head[2])
+            local queue = queue_key(q, level, group)
+            local task_id = redis.call('RPOP', queue)
+            if task_id then
+                local _, _, weight, enqueued_at = queue_position(q, task_id)
+                local group_weight = tonumber(redis.call('HGET', q.weights, group) or '1')
+                if group_weight <= 0 then
+                    group_weight = 1
+                end
+                local finish = start + math.max(weight or 1, 1) / group_weight
+                redis.call('HSET', q.state, 'clock:' .. level, start)
+                redis.call('HSET', q.state, 'finish:' .. level .. ':' .. group, finish)
+                if redis.call('LLEN', queue) > 0 then
+                    redis.call('ZADD', sched, finish, group)
+                else
+                    redis.call('ZREM', sched, group)
+                end
+                local waited = math.max(now - (enqueued_at or now), 0)
+                count_wait(q, level, waited)
+                count_wait(q, level .. ':' .. group, waited)
+                return {task_id, level, group, tostring(waited)}
+            end
+            redis.call('ZREM', sched, group)
+            head = redis.call('ZRANGE', sched, 0, 0, 'WITHSCORES')
+        end
+    end
+    -- left in the single fifo queue by the version before the levels
+    local task_id = redis.call('RPOP', q.base)
+    if task_id then
+        return {task_id, '', '', '0'}
+    end
+    return false
+end
+"""
+
+# admission check(queued) and enqueue of a task, nothing is written when rejected
+# KEYS[8..13] QUEUE_KEYS, KEYS[14] task info key, KEYS[15] task status hash
+# ARGV[1] task id, ARGV[2] weight, ARGV[3] now, ARGV[4] group, ARGV[5] priority level, ARGV[6] task json,
+# ARGV[7..] status field value pairs
+# :return: {1, length of the group queue after push} or {0, scope, limit field, usage, limit}
+ENQUEUE_TASK = RedisScript("enqueue_task", _ADMISSION + _QUEUES + """
+local weight = tonumber(ARGV[2])
+local rejection = over_limit('queued', weight)
+if rejection then
+    return reject('queued', rejection)
+end
+add_usage('queued', 1, weight)
+redis.call('HSET', KEYS[6], ARGV[1], 'queued:' .. ARGV[2] .. ':' .. ARGV[3] .. ':' .. ARGV[4])
+redis.call('SET', KEYS[14], ARGV[6])
+for i = 7, #ARGV, 2 do
+    redis.call('HSET', KEYS[15], ARGV[i], ARGV[i + 1])
+end
+return {1, queue_push(queue_keys(8), ARGV[1], ARGV[5], ARGV[4], ARGV[2], ARGV[3], false)}
+""")
+
+# admission check(running) of a popped task: queued -> running
+# KEYS[8] lease owners hash, KEYS[9] processing list of the caller(optional, both)
+# ARGV[1] task id, ARGV[2] weight, ARGV[3] now, ARGV[4] group
+# :return: {1, seconds waited since enqueued(string)} or {0, scope, limit field, usage, limit}
+#          or {-1} the caller doesn't hold the lease of the task(any more)
+START_TASK = RedisScript("start_task", _ADMISSION + """
+if KEYS[8] and redis.call('HGET', KEYS[8], ARGV[1]) ~= KEYS[9] then
+    return {-1}
+end
+local state, weight, enqueued_at = admitted(ARGV[1])
+if state == 'running' then
+    -- popped again after the master starting it died(a live one renews its lease), already counted
+    return {1, '0'}
+end
+weight = weight or tonumber(ARGV[2])
+local rejection = over_limit('running', weight)
+if rejection then
+    return reject('running', rejection)
+end
+if state == 'queued' then
+    add_usage('queued', -1, -weight)
+end
+add_usage('running', 1, weight)
+redis.call('HSET', KEYS[6], ARGV[1], 'running:' .. weight .. ':' .. (enqueued_at or ARGV[3]) .. ':' .. ARGV[4])
+local waited = math.max(tonumber(ARGV[3]) - (enqueued_at or tonumber(ARGV[3])), 0)
+redis.call('HINCRBY', KEYS[7], 'started', 1)
+redis.call('HINCRBYFLOAT', KEYS[7], 'wait_seconds', waited)
+if waited > tonumber(redis.call('HGET', KEYS[7], 'max_wait_seconds') or '0') then
+    redis.call('HSET', KEYS[7], 'max_wait_seconds', waited)
+end
+return {1, tostring(waited)}
+""")
+
+# the task leaves admission control(done / dropped), its usage is given back, a second call does nothing
+# ARGV[1] task id
+# :return: 1 released, 0 not admitted
+RELEASE_TASK = RedisScript("release_task", _ADMISSION + """
+local state, weight = admitted(ARGV[1])
+if not state then
+    return 0
+end
+add_usage(state, -1, -weight)
+redis.call('HDEL', KEYS[6], ARGV[1])
+return 1
+""")
+
+# reliable dequeue: a popped id goes into the processing list of the master and is leased until the master
+# acks it, expired leases / what a restarted master left in its processing list go back to their queues
+# lease scripts take LEASE_KEYS first:
+#   KEYS[1..6] QUEUE_KEYS, KEYS[7] processing list, KEYS[8] leases zset(task id -> deadline),
+#   KEYS[9] lease owners hash(task id -> processing list)
+LEASE_KEYS = QUEUE_KEYS + 3
+_LEASES = """
+local q = queue_keys(1)
+local processing, leases, owners = KEYS[7], KEYS[8], KEYS[9]
+
+local function unlease(task_id)
+    redis.call('ZREM', leases, task_id)
+    redis.call('HDEL', owners, task_id)
+end
+
+-- the lease of the task belongs to the processing list of the caller
+local function leased(task_id)
+    return redis.call('HGET', owners, task_id) == processing
+end
+
+-- back to the front of its queue, tasks of the single fifo queue go to the normal level
+local function requeue(task_id, now)
+    local level, group, weight, enqueued_at = queue_position(q, task_id)
+    return queue_push(q, task_id, level or 'normal', group or 'none', weight or 1, enqueued_at or now, true)
+end
+"""
+
+# ARGV[1] now, ARGV[2] lease deadline, ARGV[3..] priority levels, highest first
+# :return: {task id, level, group, seconds waited(string)} or false
+DEQUEUE_TASK = RedisScript("dequeue_task", _QUEUES + _LEASES + """
+local levels = {}
+for i = 3, #ARGV do
+    levels[#levels + 1] = ARGV[i]
+end
+local popped = queue_pop(q, levels, tonumber(ARGV[1]))
+if popped then
+    redis.call('LPUSH', processing, popped[1])
+    redis.call('ZADD', leases, ARGV[2], popped[1])
+    redis.call('HSET', owners, popped[1], processing)
+end
+return popped
+""")
+
+# KEYS[10] running tasks set(optional)
+# ARGV[1] task id
+# :return: 1 acked, 0 the lease was reclaimed before the ack(the id is back in the queue or leased to another master)
+ACK_TASK = RedisScript("ack_task", _QUEUES + _LEASES + """
+if not leased(ARGV[1]) then
+    return 0
+end
+unlease(ARGV[1])
+if redis.call('LREM', processing, 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', q.positions, ARGV[1])
+if KEYS[10] then
+    redis.call('SADD', KEYS[10], ARGV[1])
+end
+return 1
+""")
+
+# a popped task that can't start yet goes back to the front of its group queue,
+# its group has been charged for the turn so the other groups go first
+# ARGV[1] task id, ARGV[2] now
+REQUEUE_TASK = RedisScript("requeue_task", _QUEUES + _LEASES + """
+if not leased(ARGV[1]) then
+    return 0
+end
+unlease(ARGV[1])
+if redis.call('LREM', processing, 1, ARGV[1]) == 0 then
+    return 0
+end
+return requeue(ARGV[1], ARGV[2])
+""")
+
+# a master still dispatching a task keeps its lease
+# ARGV[1] task id, ARGV[2] new deadline
+# :return: 1 renewed, 0 the lease was reclaimed
+RENEW_LEASE = RedisScript("renew_lease", _QUEUES + _LEASES + """
+if not leased(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', leases, ARGV[2], ARGV[1])
+return 1
+""")
+
+# expired leases of every master back to their queues
+# KEYS[7] is not used, the processing list of each task is in the owners hash(named by the mqs, in the slot too)
+# ARGV[1] now
+# :return: reclaimed task ids
+RECLAIM_EXPIRED_TASKS = RedisScript("reclaim_expired_tasks", _QUEUES + _LEASES + """
+local expired = redis.call('ZRANGEBYSCORE', leases, '-inf', ARGV[1])
+local reclaimed = {}
+-- latest deadline first, the oldest lease ends up next in line
+for i = #expired, 1, -1 do
+    local task_id = expired[i]
+    local owner = redis.call('HGET', owners, task_id)
+    unlease(task_id)
+    if owner and redis.call('LREM', owner, 1, task_id) > 0 then
+        requeue(task_id, ARGV[1])
+        reclaimed[#reclaimed + 1] = task_id
+    end
+end
+return reclaimed
+""")
+
+# everything left in a processing list back to the queues, run by a master on startup for its own list
+# ARGV[1] now
+# :return: reclaimed task ids
+RECLAIM_PROCESSING_TASKS = RedisScript("reclaim_processing_tasks", _QUEUES + _LEASES + """
+local reclaimed = {}
+-- newest first, the oldest popped ends up next in line
+local task_id = redis.call('LPOP', processing)
+while task_id do
+    unlease(task_id)
+    requeue(task_id, ARGV[1])
+    reclaimed[#reclaimed + 1] = task_id
+    task_id = redis.call('LPOP', processing)
+end
+return reclaimed
+""")
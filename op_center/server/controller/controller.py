@@ -3,11 +3,14 @@ import logging
 from op_center.basic import PMS_CREATE_HOST_FILTER, PMS_MODIFY_HOST_FILTER, PMS_DELETE_HOST_FILTER, \
     WORKFLOW_TYPE_REMOTE, PMS_CREATE_WORKFLOW, PMS_MODIFY_WORKFLOW, PMS_SEARCH_WORKFLOW, PMS_DELETE_WORKFLOW, \
     PMS_SEARCH_HOST_FILTER, PMS_CREATE_OPERATOR, PMS_DELETE_OPERATOR, PMS_MODIFY_OPERATOR, PMS_SEARCH_OPERATOR, \
-    PMS_CREATE_OPERATION, PMS_MODIFY_OPERATION, PMS_DELETE_OPERATION, PMS_SEARCH_TASK, PMS_RUN_OPERATION
+    PMS_CREATE_OPERATION, PMS_MODIFY_OPERATION, PMS_DELETE_OPERATION, PMS_SEARCH_TASK, PMS_RUN_OPERATION, \
+    PMS_MANAGE_ADMISSION, TASK_PRIORITIES, TASK_PRIORITY_NORMAL
 from op_center.server import host_filter, user
 from op_center.server import orm
 from op_center.server.controller.exception import ControllerException
 from op_center.server.controller.permission import pms_required, overall_pms_required, PermissionDeny
+from op_center.server.host_filter_cache import host_filter_cache
+from op_center.server.host_filter_membership import HostFilterMembership
 from op_center.server.mq import main_mq
 from op_center.server.operation import Operation
 from op_center.server.task import Task
@@ -25,6 +28,17 @@ class ArgumentError(ControllerException):
 
 class Controller:
     mq = main_mq
+    HOST_FILTER_PREVIEW_MAX_SAMPLE = 100
+    # task list never carries the (large) result column
+    TASK_COLUMNS = [orm.t.tsk.id,
+                    orm.t.tsk.operation_id,
+                    orm.t.tsk.group_id,
+                    orm.t.tsk.running_kwargs,
+                    orm.t.tsk.runner,
+                    orm.t.tsk.status,
+                    orm.t.tsk.c_time,
+                    orm.t.tsk.m_time,
+                    orm.t.tsk.f_time]
 
     @property
     def orm_user(self):
@@ -63,11 +77,12 @@ class Controller:
         return self._orm_task
 
     def __init__(self, u: user.User, loop=None, orm_session=None):
-        self.orm_session = orm_session or orm.DBSession()
+        # without a session the first orm creates and closes it, every other orm shares it
+        self._orm_user = orm.User(session=orm_session)
+        self.orm_session = self._orm_user._session
         self.loop = loop
         self.user = u
 
-        self._orm_user = None
         self._orm_host_filter = None
         self._orm_workflow = None
         self._orm_operator = None
@@ -84,16 +99,16 @@ class Controller:
         return group_id or await self.user.my_basic_group_id()
 
     async def __get_workflow_group_id(self, *, id):
-        return (await self.orm_workflow.only_or_raise(orm.t.wf.id == id))["group_id"]
+        return (await self.orm_workflow.get_or_raise(id))["group_id"]
 
     async def __get_host_filter_group_id(self, *, id):
-        return (await self.orm_host_filter.only_or_raise(orm.t.hf.id == id))["group_id"]
+        return (await self.orm_host_filter.get_or_raise(id))["group_id"]
 
     async def __get_operation_group_id(self, *, id):
-        return (await self.orm_operation.only_or_raise(orm.t.optn.id == id))["group_id"]
+        return (await self.orm_operation.get_or_raise(id))["group_id"]
 
     async def __get_task_group_id(self, *, id):
-        return (await self.orm_task.only_or_raise(orm.t.tsk.id == id))["group_id"]
+        return (await self.orm_task.get_or_raise(id))["group_id"]
 
     # host filter
     @pms_required(PMS_CREATE_HOST_FILTER,
@@ -110,33 +125,53 @@ class Controller:
             "filters": filters,
             "group_id": group_id or await self.user.my_basic_group_id(),
         }
-        await host_filter.HostFilter(meta).get_hosts()
+        host_filter.HostFilter(meta, orm_session=self.orm_session).validate()
         new_host_filter_id = await self.orm_host_filter.create(**meta)
         logger.debug(f"create host filter ok id is: {new_host_filter_id}")
-        return await self.orm_host_filter.only_or_raise(orm.t.hf.id == new_host_filter_id)
+        return await self.orm_host_filter.get_or_raise(new_host_filter_id)
 
     @pms_required(PMS_MODIFY_HOST_FILTER,
                   group_id_function=__get_host_filter_group_id,
                   group_id_params={"id": "id"})
     async def update_host_filter(self, id, name=None, filters=None, description=None):
-        target = await self.orm_host_filter.only_or_raise(orm.t.hf.id == id)
+        target = await self.orm_host_filter.get_or_raise(id)
         # 判断 如果是从共有改成私有则拒绝
         # if change group_id from null -> some_id deny
         # if target["group_id"] is None and group_id != target["group_id"]:
         #     raise UnsupportedOperation("can't change a group from public to private"
         #                                ", if you real wan't to do this try fork this to your self group")
         if filters is not None:
-            if type(filters) is not list or filters == []:
-                raise UnsupportedOperation("filters must be a not empty list")
+            if type(filters) not in (list, dict) or not filters:
+                raise UnsupportedOperation("filters must be a not empty list or expression")
 
         update_dict = self.mk_update_dict(name=name,
                                           filters=filters,
                                           description=description)
         meta = target
         meta.update(update_dict)
-        await host_filter.HostFilter(meta).get_hosts()
+        host_filter.HostFilter(meta, orm_session=self.orm_session).validate()
+        if filters is not None:
+            # membership is recomputed(as a delta) on the filter's next use or host refresh
+            update_dict["materialized_at"] = None
         await self.orm_host_filter.query_update(orm.t.hf.id == id, **update_dict)
 
+    @pms_required(PMS_SEARCH_HOST_FILTER,
+                  group_id_function=__fill_user_basic_group_id,
+                  group_id_params={"group_id": "group_id"})
+    async def preview_host_filter(self, *, filters, sample_size=10, group_id=None):
+        """match count and a few hosts of a filter definition which doesn't need to be saved"""
+        if not filters or type(filters) not in (list, dict):
+            raise UnsupportedOperation("filters must be a not empty list or expression")
+        try:
+            sample_size = None if isinstance(sample_size, (bool, float)) else int(sample_size)
+        except (TypeError, ValueError):
+            sample_size = None
+        if sample_size is None or sample_size < 0:
+            raise ArgumentError("sample_size must be an int >= 0")
+        hf = host_filter.HostFilter({"id": None, "filters": filters}, orm_session=self.orm_session)
+        hf.validate()
+        return await hf.preview(sample_size=min(sample_size, self.HOST_FILTER_PREVIEW_MAX_SAMPLE))
+
     @pms_required(PMS_SEARCH_HOST_FILTER,
                   group_id_function=__get_host_filter_group_id,
                   group_id_params={"id": "id"})
@@ -150,7 +185,7 @@ class Controller:
         :param name: new host_filter name
         ":param group_id: copy to which group , default is user.basic_group
         """
-        target = await self.orm_host_filter.only_or_raise(orm.t.hf.id == id)
+        target = await self.orm_host_filter.get_or_raise(id)
         group_id = group_id or await self.user.my_basic_group_id()
         name = name or target["name"] + f" fork[{group_id}]"
         return await self.create_host_filter(name=name,
@@ -162,9 +197,25 @@ class Controller:
                   group_id_function=__get_host_filter_group_id,
                   group_id_params={"id": "id"})
     async def get_host_filter_hosts(self, id):
-        hf = await host_filter.HostFilter.create_by_name_or_id(id=id)
+        hf = await host_filter.HostFilter.create_by_name_or_id(id=id, orm_session=self.orm_session)
         return await hf.get_hosts(columns=[orm.t.h.ip, orm.t.h.envs])
 
+    @pms_required(PMS_SEARCH_HOST_FILTER,
+                  group_id_function=__get_host_filter_group_id,
+                  group_id_params={"id": "id"})
+    async def get_host_filter_hosts_page(self, id, cursor=None, limit=None):
+        """:return: (hosts, cursor of next page or None)"""
+        hf = await host_filter.HostFilter.create_by_name_or_id(id=id, orm_session=self.orm_session)
+        return await hf.get_hosts_page(columns=[orm.t.h.ip, orm.t.h.envs], cursor=cursor, limit=limit)
+
+    @pms_required(PMS_SEARCH_HOST_FILTER,
+                  group_id_function=__get_host_filter_group_id,
+                  group_id_params={"id": "id"})
+    async def get_host_filter_facets(self, id, dimensions):
+        """:return: {dimension: {value: host count}}"""
+        hf = await host_filter.HostFilter.create_by_name_or_id(id=id, orm_session=self.orm_session)
+        return await hf.facets(dimensions)
+
     @pms_required(PMS_DELETE_HOST_FILTER,
                   group_id_function=__get_host_filter_group_id,
                   group_id_params={"id": "id"})
@@ -172,6 +223,7 @@ class Controller:
         #
         # put relate check here
         #
+        await HostFilterMembership(orm_session=self.orm_session).remove_filter(id)
         await self.orm_host_filter.query_delete(orm.t.hf.id == id)
 
     async def get_host_filters(self, id=None):
@@ -180,6 +232,13 @@ class Controller:
         else:
             return await self.orm_host_filter.query()
 
+    async def get_host_filter_cache_stats(self):
+        return {**host_filter_cache.stats(), "host_version": await host_filter_cache.version()}
+
+    async def get_host_filters_page(self, cursor=None, limit=None):
+        """:return: (host filters, cursor of next page or None)"""
+        return await self.orm_host_filter.query_page(cursor=cursor, limit=limit)
+
     # workflow
     @pms_required(PMS_CREATE_WORKFLOW,
                   group_id_function=__fill_user_basic_group_id,
@@ -204,7 +263,7 @@ class Controller:
         if "LANG" not in meta["envs"]:
             meta["envs"]["LANG"] = "en_US.UTF-8"
         meta_id = await self.orm_workflow.create(**meta)
-        return await self.orm_workflow.only_or_raise(orm.t.wf.id == meta_id)
+        return await self.orm_workflow.get_or_raise(meta_id)
 
     @pms_required(PMS_MODIFY_WORKFLOW,
                   group_id_function=__get_workflow_group_id,
@@ -224,7 +283,7 @@ class Controller:
                   group_id_function=__fill_user_basic_group_id,
                   group_id_params={"group_id": "group_id"})
     async def fork_workflow(self, id, name=None, group_id=None):
-        target = await self.orm_workflow.only_or_raise(orm.t.wf.id == id)
+        target = await self.orm_workflow.get_or_raise(id)
         group_id = group_id or await self.user.my_basic_group_id()
         name = name or target["name"] + f" fork[{group_id}]"
         return await self.create_workflow(name=name,
@@ -259,7 +318,7 @@ class Controller:
             type=type,
             mq_link=mq_link
         )
-        meta = await self.orm_operator.only_or_raise(orm.t.optr.id == meta_id)
+        meta = await self.orm_operator.get_or_raise(meta_id)
         return meta
 
     @overall_pms_required(PMS_DELETE_OPERATOR)
@@ -293,12 +352,12 @@ class Controller:
                                                     orm.t.optn.group_id == group_id)
 
         # 检查 workflow host_filter 是否存在
-        workflow = await self.orm_workflow.only_or_raise(orm.t.wf.id == workflow_id)
-        hf = await self.orm_host_filter.only_or_raise(orm.t.hf.id == host_filter_id)
+        workflow = await self.orm_workflow.get_or_raise(workflow_id)
+        hf = await self.orm_host_filter.get_or_raise(host_filter_id)
 
         # 如果使用非默认operator 检查是否存在
         if operator_id:
-            await self.orm_operator.only_or_raise(orm.t.optr.id == operator_id)
+            await self.orm_operator.get_or_raise(operator_id)
 
         # 判断是否需要fork
         fork = set()
@@ -338,7 +397,7 @@ class Controller:
                                                   host_filter_id=hf["id"],
                                                   operator_id=operator_id,
                                                   cache={})
-        return await self.orm_operation.only_or_raise(orm.t.optn.id == meta_id)
+        return await self.orm_operation.get_or_raise(meta_id)
 
     @pms_required(PMS_MODIFY_OPERATION,
                   group_id_function=__get_operation_group_id,
@@ -358,7 +417,7 @@ class Controller:
 
     async def get_operation(self, id=None):
         if id:
-            return await self.orm_operation.query(orm.t.optn.id == id)
+            return await self.orm_operation.query(orm.t.optn.id == id, include_large=True)
         else:
             return await self.orm_operation.query()
 
@@ -371,34 +430,60 @@ class Controller:
     @pms_required(PMS_RUN_OPERATION,
                   group_id_function=__get_operation_group_id,
                   group_id_params={"id": "id"})
-    async def operation_run(self, id, running_kwargs: dict = None, use_cache=True, hosts=None):
+    async def operation_run(self, id, running_kwargs: dict = None, use_cache=True, hosts=None,
+                            priority=TASK_PRIORITY_NORMAL):
+        if priority not in TASK_PRIORITIES:
+            raise ArgumentError(f"priority must be one of {TASK_PRIORITIES}")
         operation_instance = await Operation.create_by_id_or_name(id=id, user=self.user,
                                                                   orm_session=self.orm_session,
                                                                   use_cache=use_cache)
-        return await operation_instance.run(running_kwargs=running_kwargs, hosts=hosts)
+        return await operation_instance.run(running_kwargs=running_kwargs, hosts=hosts, priority=priority)
+
+    # task admission
+    @overall_pms_required(PMS_MANAGE_ADMISSION)
+    async def get_admission(self):
+        return await self.mq.get_admission()
+
+    @overall_pms_required(PMS_MANAGE_ADMISSION)
+    async def set_admission_limits(self, *, scope, limits, group_id=None):
+        """
+        :param scope: global / group_default / group(with group_id)
+        :param limits: {queued_tasks / queued_hosts / running_tasks / running_hosts: int >= 0 or None(unlimited)}
+        """
+        if scope not in ("global", "group_default", "group"):
+            raise ArgumentError(f"unknown admission scope {scope}")
+        if scope == "group" and group_id is None:
+            raise ArgumentError("group admission limits need group_id")
+        if not isinstance(limits, dict) or set(limits) - set(self.mq.ADMISSION_LIMIT_FIELDS):
+            raise ArgumentError(f"admission limits must be a dict of {self.mq.ADMISSION_LIMIT_FIELDS}")
+        for field, limit in limits.items():
+            if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+                raise ArgumentError(f"admission limit {field} must be an int >= 0 or null")
+        await self.mq.set_admission_limits(scope, limits, group_id=group_id)
+        return await self.mq.get_admission()
+
+    @overall_pms_required(PMS_MANAGE_ADMISSION)
+    async def get_task_queues(self):
+        return {"queues": await self.mq.get_queues(), "stats": await self.mq.get_queue_stats()}
+
+    @overall_pms_required(PMS_MANAGE_ADMISSION)
+    async def set_task_group_weight(self, *, group_id, weight=None):
+        """:param weight: fair share weight of the group in every queue level, > 0, None -> default 1"""
+        if weight is not None and (not isinstance(weight, (int, float)) or isinstance(weight, bool) or weight <= 0):
+            raise ArgumentError("group weight must be a number > 0 or null")
+        await self.mq.set_group_weight(group_id, weight)
+        return await self.get_task_queues()
 
     # task
     async def get_task(self, id=None):
         if id:
-            return await self.orm_task.query(orm.t.tsk.id == id, columns=[orm.t.tsk.id,
-                                                                          orm.t.tsk.operation_id,
-                                                                          orm.t.tsk.group_id,
-                                                                          orm.t.tsk.running_kwargs,
-                                                                          orm.t.tsk.runner,
-                                                                          orm.t.tsk.status,
-                                                                          orm.t.tsk.c_time,
-                                                                          orm.t.tsk.m_time,
-                                                                          orm.t.tsk.f_time])
+            return await self.orm_task.query(orm.t.tsk.id == id, columns=self.TASK_COLUMNS)
         else:
-            return await self.orm_task.query(columns=[orm.t.tsk.id,
-                                                      orm.t.tsk.operation_id,
-                                                      orm.t.tsk.group_id,
-                                                      orm.t.tsk.running_kwargs,
-                                                      orm.t.tsk.runner,
-                                                      orm.t.tsk.status,
-                                                      orm.t.tsk.c_time,
-                                                      orm.t.tsk.m_time,
-                                                      orm.t.tsk.f_time])
+            return await self.orm_task.query(columns=self.TASK_COLUMNS)
+
+    async def get_task_page(self, cursor=None, limit=None):
+        """:return: (tasks, cursor of next page or None)"""
+        return await self.orm_task.query_page(columns=self.TASK_COLUMNS, cursor=cursor, limit=limit)
 
     @pms_required(PMS_SEARCH_TASK,
                   group_id_function=__get_task_group_id,
@@ -412,7 +497,7 @@ class Controller:
                   group_id_params={"id": "id"})
     async def get_task_result(self, id):
         t = await Task.create_by_id(id, orm_session=self.orm_session)
-        return t.meta["result"]
+        return await t.get_result()
 
     @pms_required(PMS_SEARCH_TASK,
                   group_id_function=__get_task_group_id,
@@ -16,77 +16,101 @@ class PermissionCheckArgsError(ControllerException):
     code = 500
 
 
-def overall_pms_required(pms):
-    def wrapper(func):
-        @functools.wraps(func)
-        async def real_func(self, *args, **kwargs):
-            if pms in await self.user.my_overall_permissions():
-                return await func(self, *args, **kwargs)
-            else:
-                raise PermissionDeny(f"you have no permission: {pms}")
+def overall_pms_check(pms):
+    """
+    :return: an awaitable check(self) raise PermissionDeny when self.user has no overall pms
+    """
 
-        return real_func
+    async def check(self):
+        if pms not in await self.user.my_overall_permissions():
+            raise PermissionDeny(f"you have no permission: {pms}")
 
-    return wrapper
+    return check
 
 
-def private_pms_required(pms, group_id="group_id", group_id_function=None, group_id_params=None):
+def private_pms_check(pms, func, group_id="group_id", group_id_function=None, group_id_params=None):
     """
     :param pms: string  permission
+    :param func: the decorated function, used to map call args
     :param group_id:  group_id key in call_args
     :param group_id_function: an awaitable function return a real group_id to check private permission
     :param group_id_params: group_id_function's args dict
                             map is:
                             call_args_key_name  ->  group_id_function_key_name
+    :return: an awaitable check(self, *args, **kwargs) raise PermissionDeny when deny
     """
     group_id_params = group_id_params or {}
+    _real_function = get_real_function(func)
 
-    def wrapper(func):
-        _real_function = get_real_function(func)
-
-        @functools.wraps(func)
-        async def real_func_string(self, *args, **kwargs):
-            call_args = inspect.getcallargs(_real_function, self, *args, **kwargs)
+    async def check(self, *args, **kwargs):
+        call_args = inspect.getcallargs(_real_function, self, *args, **kwargs)
+        if group_id_function:
+            gid = await group_id_function(self, **{call_key: call_args[call_key]
+                                                   for f_key, call_key in group_id_params.items()})
+            logger.debug(f"get gid result is : {gid}")
+        else:
             try:
                 logger.debug(f" call args is : {call_args}")
                 gid = call_args[group_id]
             except KeyError:
                 raise PermissionCheckArgsError(f"args list not found {group_id}")
-            if pms in await self.user.my_group_private_permissions(group_id=gid):
-                return await func(self, *args, **kwargs)
-            else:
-                raise PermissionDeny(f"you have no permission: {pms} in group(id={gid})")
+        if pms not in await self.user.my_group_private_permissions(group_id=gid):
+            raise PermissionDeny(f"you have no permission: {pms} in group(id={gid})")
+
+    return check
 
+
+def overall_pms_required(pms):
+    check = overall_pms_check(pms)
+
+    def wrapper(func):
         @functools.wraps(func)
-        async def real_func_awaitable(self, *args, **kwargs):
-            call_args = inspect.getcallargs(_real_function, self, *args, **kwargs)
-            gid = await group_id_function(self, **{call_key: call_args[call_key]
-                                                   for f_key, call_key in group_id_params.items()})
-            logger.debug(f"get gid result is : {gid}")
-            if pms in await self.user.my_group_private_permissions(group_id=gid):
-                return await func(self, *args, **kwargs)
-            else:
-                raise PermissionDeny(f"you have no permission: {pms} in group(id={gid})")
+        async def real_func(self, *args, **kwargs):
+            await check(self)
+            return await func(self, *args, **kwargs)
 
-        if group_id_function:
-            return real_func_awaitable
-        else:
-            return real_func_string
+        return real_func
+
+    return wrapper
+
+
+def private_pms_required(pms, group_id="group_id", group_id_function=None, group_id_params=None):
+    """see private_pms_check"""
+
+    def wrapper(func):
+        check = private_pms_check(pms, func, group_id=group_id,
+                                  group_id_function=group_id_function,
+                                  group_id_params=group_id_params)
+
+        @functools.wraps(func)
+        async def real_func(self, *args, **kwargs):
+            await check(self, *args, **kwargs)
+            return await func(self, *args, **kwargs)
+
+        return real_func
 
     return wrapper
 
 
 def private_or_overall_pms_required(pms, group_id="group_id", group_id_function=None, group_id_params=None):
+    """
+    check private permission first, fall back to overall permission only when private one deny,
+    the decorated function is called once after the check, PermissionDeny raised inside it is not retried
+    """
+    overall_check = overall_pms_check(pms)
+
     def wrapper(func):
+        private_check = private_pms_check(pms, func, group_id=group_id,
+                                          group_id_function=group_id_function,
+                                          group_id_params=group_id_params)
+
         @functools.wraps(func)
         async def real_func(self, *args, **kwargs):
             try:
-                return await private_pms_required(pms,
-                                                  group_id=group_id,
-                                                  group_id_function=group_id_function,
-                                                  group_id_params=group_id_params)(func)(self, *args, **kwargs)
+                await private_check(self, *args, **kwargs)
             except PermissionDeny:
-                return await overall_pms_required(pms)(func)(self, *args, **kwargs)
+                await overall_check(self)
+            return await func(self, *args, **kwargs)
 
         return real_func
 
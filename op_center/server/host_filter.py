@@ -1,11 +1,18 @@
 import abc
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import operator
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, not_, true, false
 from sqlalchemy.sql import func
 
+from op_center.basic import ip_to_int, cidr_to_int_range
 from op_center.server import orm, ServerException
+from op_center.server.host_filter_cache import host_filter_cache, filter_cache_key
+from op_center.server.host_inventory import host_inventory, HostInventoryUnsupported
 
 logger = logging.getLogger(__name__)
 
@@ -34,29 +41,60 @@ class HostItemFilterNotFound(HostFilterItemException):
     pass
 
 
+class HostFilterFacetNotAllow(HostFilterException):
+    code = 400
+
+
+def host_json_key(column, path):
+    """
+    expression of a scalar host json attribute,
+    the indexed generated column when table.Host has one for it, json path otherwise
+    """
+    generated = orm.t.h.JSON_GENERATED_COLUMNS.get((column, path))
+    if generated:
+        return getattr(orm.t.h, generated).expression
+    return getattr(orm.t.h, column).expression[path]
+
+
 class ABCHostItemFilter(metaclass=abc.ABCMeta):
     NAME = None
     key = None
+    # (json column, path), key is resolved from it by host_json_key
+    JSON_PATH = None
+    # HostSnapshot attribute the conditions are evaluated on, None -> sql only
+    INVENTORY_ATTRIBUTE = None
 
     ENABLED_CONDITIONS = ["in", "not_in", "is", "is_not"]
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.JSON_PATH:
+            cls.key = host_json_key(*cls.JSON_PATH)
+
     def __init__(self, kwargs):
         self.kwargs = kwargs
         logger.debug(kwargs)
-        self.result = {}
-
-    def query_condition(self) -> dict:
-        for condition, args in self.kwargs.items():
-            if condition not in self.ENABLED_CONDITIONS:
-                raise HostFilterItemConditionNotAllow(f"condition {condition} not allow in {self.NAME}")
-            if hasattr(self, f"op_{condition}"):
-                attribute = getattr(self, f"op_{condition}")
-                # logger.debug(f"{condition}, {args}, {self.key}")
-                r = attribute(args)
-                logger.debug(r)
-                self.result[f"{self.NAME}_{condition}"] = r
-        logger.debug(self.result)
-        return self.result
+
+    def check_condition(self, condition):
+        if condition not in self.ENABLED_CONDITIONS:
+            raise HostFilterItemConditionNotAllow(f"condition {condition} not allow in {self.NAME}")
+
+    def condition_sql(self, condition, args):
+        """sql expression of one condition"""
+        self.check_condition(condition)
+        r = getattr(self, f"op_{condition}")(args)
+        if isinstance(r, bool):
+            return true() if r else false()
+        return r
+
+    def condition_bitmap(self, snapshot, condition, args):
+        """condition_sql evaluated as a bitmap of a HostSnapshot"""
+        if self.INVENTORY_ATTRIBUTE is None:
+            raise HostInventoryUnsupported(f"{self.NAME} is not in inventory")
+        self.check_condition(condition)
+        if not hasattr(snapshot, f"bitmap_{condition}"):
+            raise HostInventoryUnsupported(f"condition {condition} is not in inventory")
+        return getattr(snapshot, f"bitmap_{condition}")(self.INVENTORY_ATTRIBUTE, args)
 
     def op_in(self, args):
         if type(args) is not list and type(args) is not tuple and type(args) is not set:
@@ -76,6 +114,34 @@ class ABCHostItemFilter(metaclass=abc.ABCMeta):
         return self.key != args
 
 
+class ABCHostArrayItemFilter(ABCHostItemFilter):
+    """
+    json array attribute, conditions are written as JSON_OVERLAPS / JSON_CONTAINS
+    so mysql answers them from the multi-valued index on the same path
+    """
+    ARRAY_PATH = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.ARRAY_PATH:
+            column, path = cls.ARRAY_PATH
+            cls.key = func.json_extract(getattr(orm.t.h, column), f"$.{path}")
+
+    def op_in(self, args):
+        super().op_in(args)
+        return func.json_overlaps(self.key, func.json_array(*args))
+
+    def op_not_in(self, args):
+        super().op_not_in(args)
+        return not_(func.json_overlaps(self.key, func.json_array(*args)))
+
+    def op_is(self, args):
+        return func.json_contains(self.key, func.json_array(args))
+
+    def op_is_not(self, args):
+        return not_(func.json_contains(self.key, func.json_array(args)))
+
+
 def host_item_filter_register(cls: ABCHostItemFilter):
     if cls.NAME not in ALL_HOST_ITEM_FILTERS:
         ALL_HOST_ITEM_FILTERS[cls.NAME] = cls
@@ -129,61 +195,404 @@ class HostItemISSystemEnableFilter(ABCHostItemFilter):
 @host_item_filter_register
 class HostItemIDCFilter(ABCHostItemFilter):
     NAME = "idc"
-    key = orm.t.h.basic.expression["idc"]
+    JSON_PATH = ("basic", "idc")
+    INVENTORY_ATTRIBUTE = "idc"
 
 
 @host_item_filter_register
 class HostItemOKFilter(ABCHostItemFilter):
     NAME = "ok"
     key = orm.t.h.ok.expression
+    INVENTORY_ATTRIBUTE = "ok"
 
 
 @host_item_filter_register
 class HostItemIpFilter(ABCHostItemFilter):
+    """
+    cidr:  ["10.0.1.0/24", ...], hosts in any of the networks
+    range: ["10.0.1.10", "10.0.1.20"], first and last address included
+    both are range scans on the ip_int index
+    """
     NAME = "ip"
-    ENABLED_CONDITIONS = ["in", "not_in", "is", "is_not", "regexp"]
+    ENABLED_CONDITIONS = ["in", "not_in", "is", "is_not", "regexp", "cidr", "range"]
     key = orm.t.h.ip.expression
+    int_key = orm.t.h.ip_int.expression
+    INVENTORY_ATTRIBUTE = "ip"
 
     def op_regexp(self, args):
         if type(args) is not str:
             raise HostFilterItemArgsTypeWrong(f"regexp condition args must be a string pattern")
         return self.key.op("regexp")(args)
 
+    @staticmethod
+    def cidr_ranges(args):
+        if type(args) is not list and type(args) is not tuple and type(args) is not set:
+            raise HostFilterItemArgsTypeWrong("cidr condition args must be an iterable[list,tuple,set] of networks")
+        ranges = []
+        for cidr in args:
+            try:
+                ranges.append(cidr_to_int_range(cidr))
+            except (ValueError, TypeError):
+                raise HostFilterItemArgsTypeWrong(f"{repr(cidr)} is not an ipv4 network")
+        return ranges
+
+    @staticmethod
+    def range_bounds(args):
+        if type(args) is not list and type(args) is not tuple or len(args) != 2:
+            raise HostFilterItemArgsTypeWrong("range condition args must be [first ip, last ip]")
+        first, last = map(ip_to_int, args)
+        if first is None or last is None:
+            raise HostFilterItemArgsTypeWrong(f"range {repr(args)} is not two ipv4 addresses")
+        return first, last
+
+    def op_cidr(self, args):
+        ranges = self.cidr_ranges(args)
+        if not ranges:
+            return false()
+        return or_(*[self.int_key.between(first, last) for first, last in ranges])
+
+    def op_range(self, args):
+        return self.int_key.between(*self.range_bounds(args))
+
 
 @host_item_filter_register
 class HostItemTypeFilter(ABCHostItemFilter):
     NAME = "type"
-    key = orm.t.h.basic.expression["machine_type"]
+    JSON_PATH = ("basic", "machine_type")
+    INVENTORY_ATTRIBUTE = "machine_type"
 
 
 @host_item_filter_register
 class HostItemEnvFilter(ABCHostItemFilter):
     NAME = 'env'
-    key = orm.t.h.basic.expression["env_type"]
+    JSON_PATH = ("basic", "env_type")
+    INVENTORY_ATTRIBUTE = "env_type"
 
 
 @host_item_filter_register
-class HostItemAppnameFilter(ABCHostItemFilter):
+class HostItemAppnameFilter(ABCHostArrayItemFilter):
     NAME = "appname"
-    key = orm.t.h.issystem.expression["appname"]
+    ARRAY_PATH = ("issystem", "app_name")
+    INVENTORY_ATTRIBUTE = "app_name"
 
 
 @host_item_filter_register
-class HostItemApp4Filter(ABCHostItemFilter):
+class HostItemApp4Filter(ABCHostArrayItemFilter):
     NAME = "app4"
-    key = orm.t.h.issystem.expression["app4"]
+    ARRAY_PATH = ("issystem", "app4")
+    INVENTORY_ATTRIBUTE = "app4"
 
 
 @host_item_filter_register
 class HostItemDepartmentFilter(ABCHostItemFilter):
     NAME = "department"
-    key = orm.t.h.issystem["department"]
+    JSON_PATH = ("issystem", "department")
+    INVENTORY_ATTRIBUTE = "department"
 
 
 @host_item_filter_register
 class HostItemZoneFilter(ABCHostItemFilter):
     NAME = "zone"
-    key = orm.t.h.issystem["zone"]
+    JSON_PATH = ("issystem", "zone")
+    INVENTORY_ATTRIBUTE = "zone"
+
+
+def _sort_key(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _canonical_args(args):
+    """deduplicated, sorted tuple of collection args"""
+    return tuple(sorted({_sort_key(v): v for v in args}.values(), key=_sort_key))
+
+
+class ABCHostFilterExpr(metaclass=abc.ABCMeta):
+    """
+    node of a normalised host filter expression, build them by the `of` constructors / parse_filters:
+    AND / OR are flattened, constant-folded, deduplicated and sorted, NOT is pushed down to the items,
+    so equal filters give equal nodes, one sql expression and one digest
+    """
+
+    @abc.abstractmethod
+    def to_dict(self):
+        """canonical form, the same format parse_filters accepts"""
+
+    @abc.abstractmethod
+    def invert(self):
+        """normalised NOT of this node"""
+
+    @abc.abstractmethod
+    def to_sql(self):
+        pass
+
+    @abc.abstractmethod
+    def to_bitmap(self, snapshot):
+        """:raise HostInventoryUnsupported: some item can't be answered by the inventory"""
+
+    def items(self):
+        """HostFilterItem leaves"""
+        return []
+
+    @functools.cached_property
+    def sort_key(self):
+        return _sort_key(self.to_dict())
+
+    def digest(self):
+        return hashlib.sha1(self.sort_key.encode()).hexdigest()
+
+    def __eq__(self, other):
+        return isinstance(other, ABCHostFilterExpr) and self.sort_key == other.sort_key
+
+    def __hash__(self):
+        return hash(self.sort_key)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.sort_key}>"
+
+
+class HostFilterConst(ABCHostFilterExpr):
+
+    def __init__(self, value):
+        self.value = bool(value)
+
+    def to_dict(self):
+        return self.value
+
+    def invert(self):
+        return HostFilterConst(not self.value)
+
+    def to_sql(self):
+        return true() if self.value else false()
+
+    def to_bitmap(self, snapshot):
+        return snapshot.all if self.value else 0
+
+
+class HostFilterItem(ABCHostFilterExpr):
+    """one condition of one host item filter"""
+    # condition -> condition with the same NULL handling that selects the other rows
+    INVERSE_CONDITIONS = {"in": "not_in", "not_in": "in", "is": "is_not", "is_not": "is"}
+    COLLECTION_CONDITIONS = {"in", "not_in", "cidr"}
+    # collection conditions matching any of the args: nothing for no args, OR-ed ones merge
+    ANY_OF_CONDITIONS = {"in", "cidr"}
+
+    def __init__(self, name, condition, args):
+        _ItemFilter = ALL_HOST_ITEM_FILTERS.get(name, None)
+        if not _ItemFilter:
+            raise HostItemFilterNotFound(f"host item `{name}` not found")
+        self.name = name
+        self.condition = condition
+        self.item_filter = _ItemFilter({condition: args})
+        # args checks of the item filter run here, when the filter is parsed
+        self.sql = self.item_filter.condition_sql(condition, args)
+        self.args = _canonical_args(args) if condition in self.COLLECTION_CONDITIONS else args
+
+    @classmethod
+    def of(cls, name, condition, args):
+        item = cls(name, condition, args)
+        if condition in cls.ANY_OF_CONDITIONS and not item.args:
+            return HostFilterConst(False)
+        return item
+
+    @property
+    def key(self):
+        """key of the condition in the old flat condition dict"""
+        return f"{self.name}_{self.condition}"
+
+    @property
+    def is_array(self):
+        return isinstance(self.item_filter, ABCHostArrayItemFilter)
+
+    def to_dict(self):
+        return {self.name: {self.condition: list(self.args) if isinstance(self.args, tuple) else self.args}}
+
+    def invert(self):
+        inverse = self.INVERSE_CONDITIONS.get(self.condition, None)
+        if inverse in self.item_filter.ENABLED_CONDITIONS:
+            return HostFilterItem.of(self.name, inverse, self.args)
+        return HostFilterNot(self)
+
+    def items(self):
+        return [self]
+
+    def to_sql(self):
+        return self.sql
+
+    def to_bitmap(self, snapshot):
+        return self.item_filter.condition_bitmap(snapshot, self.condition, self.args)
+
+
+class HostFilterNot(ABCHostFilterExpr):
+    """NOT of an item without an inverse condition, build it by HostFilterNot.of"""
+
+    def __init__(self, child):
+        self.child = child
+
+    @classmethod
+    def of(cls, child):
+        return child.invert()
+
+    def to_dict(self):
+        return {"not": self.child.to_dict()}
+
+    def invert(self):
+        return self.child
+
+    def items(self):
+        return self.child.items()
+
+    def to_sql(self):
+        return not_(self.child.to_sql())
+
+    def to_bitmap(self, snapshot):
+        # sql NOT keeps rows whose condition is NULL out, a plain bitmap complement would not
+        raise HostInventoryUnsupported(f"not {self.child.sort_key} is not in inventory")
+
+
+class ABCHostFilterGroup(ABCHostFilterExpr):
+    OPERATOR = None
+    # a child equal to ABSORBING makes the whole group ABSORBING, IDENTITY children are dropped
+    ABSORBING = None
+    IDENTITY = None
+
+    def __init__(self, children):
+        self.children = children
+
+    @classmethod
+    def merge_args(cls, item):
+        """function merging the args of two `item`-like items of the group, None -> not mergeable"""
+        return None
+
+    @classmethod
+    def merge(cls, children):
+        merged = {}
+        result = []
+        for child in children:
+            merge = cls.merge_args(child) if isinstance(child, HostFilterItem) else None
+            if merge is None:
+                result.append(child)
+                continue
+            k = (child.name, child.condition)
+            merged[k] = merge(merged[k], child.args) if k in merged else child.args
+        result.extend(HostFilterItem.of(name, condition, args) for (name, condition), args in merged.items())
+        return result
+
+    @classmethod
+    def of(cls, children):
+        flat = []
+        for child in children:
+            flat.extend(child.children if isinstance(child, cls) else [child])
+        kept = {}
+        for child in cls.merge(flat):
+            if isinstance(child, HostFilterConst):
+                if child.value == cls.ABSORBING:
+                    return child
+                continue
+            kept[child.sort_key] = child
+        if not kept:
+            return HostFilterConst(cls.IDENTITY)
+        if len(kept) == 1:
+            return next(iter(kept.values()))
+        return cls([kept[k] for k in sorted(kept)])
+
+    def to_dict(self):
+        return {self.OPERATOR: [child.to_dict() for child in self.children]}
+
+    def items(self):
+        return [item for child in self.children for item in child.items()]
+
+
+class HostFilterAnd(ABCHostFilterGroup):
+    OPERATOR = "and"
+    ABSORBING = False
+    IDENTITY = True
+
+    @classmethod
+    def merge_args(cls, item):
+        if item.condition == "not_in":
+            return lambda a, b: _canonical_args(a + b)
+        # overlaps of both lists is not overlaps of their intersection, only scalar IN lists intersect
+        if item.condition == "in" and not item.is_array:
+            return lambda a, b: tuple(v for v in a if _sort_key(v) in {_sort_key(v) for v in b})
+        return None
+
+    def invert(self):
+        return HostFilterOr.of([child.invert() for child in self.children])
+
+    def to_sql(self):
+        return and_(*[child.to_sql() for child in self.children])
+
+    def to_bitmap(self, snapshot):
+        return functools.reduce(operator.and_, [child.to_bitmap(snapshot) for child in self.children], snapshot.all)
+
+
+class HostFilterOr(ABCHostFilterGroup):
+    OPERATOR = "or"
+    ABSORBING = True
+    IDENTITY = False
+
+    @classmethod
+    def merge_args(cls, item):
+        if item.condition in HostFilterItem.ANY_OF_CONDITIONS:
+            return lambda a, b: _canonical_args(a + b)
+        return None
+
+    def invert(self):
+        return HostFilterAnd.of([child.invert() for child in self.children])
+
+    def to_sql(self):
+        return or_(*[child.to_sql() for child in self.children])
+
+    def to_bitmap(self, snapshot):
+        return functools.reduce(operator.or_, [child.to_bitmap(snapshot) for child in self.children], 0)
+
+
+def parse_filters(filters) -> ABCHostFilterExpr:
+    """
+    normalised expression of a filter definition:
+    - list: AND of its elements(the original format, a list of {item: {condition: args}})
+    - dict: AND of its keys, `and` / `or` take a list, `not` an expression, any other key is a host item
+      whose conditions are ANDed
+    - bool: constant
+    """
+    if isinstance(filters, bool):
+        return HostFilterConst(filters)
+    if isinstance(filters, list):
+        return HostFilterAnd.of([parse_filters(f) for f in filters])
+    if not isinstance(filters, dict):
+        raise HostFilterException(f"filter expression must be a list, dict or bool not {repr(filters)}")
+    terms = []
+    for key, value in filters.items():
+        if key in ("and", "or"):
+            if not isinstance(value, list):
+                raise HostFilterException(f"`{key}` takes a list not {repr(value)}")
+            group = HostFilterAnd if key == "and" else HostFilterOr
+            terms.append(group.of([parse_filters(f) for f in value]))
+        elif key == "not":
+            terms.append(HostFilterNot.of(parse_filters(value)))
+        else:
+            if not isinstance(value, dict):
+                raise HostFilterException(f"conditions of host item `{key}` must be a dict not {repr(value)}")
+            terms.extend(HostFilterItem.of(key, condition, args) for condition, args in value.items())
+    return HostFilterAnd.of(terms)
+
+
+def filter_item_keys(filters) -> set:
+    """
+    f"{item}_{condition}" keys of every condition written in a filter definition(parse_filters format),
+    those under and / or / not included, before NOT push down or constant folding changes or drops them
+    """
+    if isinstance(filters, list):
+        return set().union(*[filter_item_keys(f) for f in filters])
+    if not isinstance(filters, dict):
+        return set()
+    keys = set()
+    for key, value in filters.items():
+        if key in ("and", "or", "not"):
+            keys |= filter_item_keys(value)
+        elif isinstance(value, dict):
+            keys.update(f"{key}_{condition}" for condition in value)
+    return keys
 
 
 class HostFilter(orm.OrmObject):
@@ -207,49 +616,186 @@ class HostFilter(orm.OrmObject):
         regexp: xxx            
     """
 
+    # ANDed to every filter: key -> (item, condition, args),
+    # a filter using the same f"{item}_{condition}" anywhere(see filter_item_keys) replaces the default
     DEFAULT_CONDITIONS = {
-        "machine_type_in": or_(orm.t.h.basic.expression["machine_type"] == "phy",
-                               orm.t.h.basic.expression["machine_type"] == "vmhost",
-                               orm.t.h.basic.expression["machine_type"] == "vm"),
-        "ok_is": orm.t.h.ok,
+        "type_in": ("type", "in", ["phy", "vmhost", "vm"]),
+        "ok_is": ("ok", "is", True),
+    }
+
+    # facet dimension -> host column, array attributes are only counted on the host inventory
+    FACET_DIMENSIONS = {
+        "ok": orm.t.h.ok,
+        "idc": orm.t.h.idc,
+        "machine_type": orm.t.h.machine_type,
+        "env_type": orm.t.h.env_type,
+        "zone": orm.t.h.zone,
+        "department": orm.t.h.department,
     }
+    INVENTORY_FACET_DIMENSIONS = {"app4", "app_name"}
 
     @classmethod
     async def create_by_name_or_id(cls, name=None, id=None, loop=None, orm_session=None):
-        orm_instance = orm_session or cls.__ORM__()
+        orm_instance = cls.__ORM__(session=orm_session)
         if name:
             obj = await orm_instance.only_or_raise(orm.t.hf.name == name)
         else:
-            obj = await orm_instance.only_or_raise(orm.t.hf.id == id)
+            obj = await orm_instance.get_or_raise(id)
         return cls(obj, loop=loop, orm_session=orm_session)
 
     def __init__(self, meta, loop=None, orm_session=None):
         super().__init__(meta, loop=loop, orm_session=orm_session)
         self._host_orm_instance = self.__HOST_ORM__(session=self.orm_session)
-        self._filters = []
+        self._expression = None
 
     @property
-    def filters(self):
-        if not self._filters:
-            logger.debug(self.meta["filters"])
-            for _filter in self.meta['filters']:
-                logger.debug(_filter)
-                for f_name, f_args in _filter.items():
-                    _ItemFilter = ALL_HOST_ITEM_FILTERS.get(f_name, None)
-                    logger.debug(_ItemFilter)
-                    if not _ItemFilter:
-                        raise HostItemFilterNotFound(f"host item `{f_name}` not found")
-                    self._filters.append(_ItemFilter(f_args))
-        return self._filters
+    def expression(self) -> ABCHostFilterExpr:
+        """normalised expression of meta["filters"] with the default conditions"""
+        if self._expression is None:
+            expression = parse_filters(self.meta["filters"])
+            keys = filter_item_keys(self.meta["filters"])
+            defaults = [HostFilterItem.of(*default) for key, default in self.DEFAULT_CONDITIONS.items()
+                        if key not in keys]
+            self._expression = HostFilterAnd.of([expression, *defaults])
+            logger.debug(self._expression)
+        return self._expression
 
     def get_query_condition(self):
-        conditions = {**self.DEFAULT_CONDITIONS}
-        for _filter in self.filters:
-            conditions.update(_filter.query_condition())
-        logger.debug(conditions)
-        return conditions
-
-    async def get_hosts(self, columns=None):
-        """result is a Host list"""
-        conditions = self.get_query_condition()
-        return await self._host_orm_instance.query(*conditions.values(), columns=columns)
+        """one sql expression of the whole filter"""
+        return self.expression.to_sql()
+
+    def get_inventory_bitmap(self, snapshot):
+        """bitmap of the snapshot rows this filter selects, raise HostInventoryUnsupported for sql only filters"""
+        return self.expression.to_bitmap(snapshot)
+
+    async def _inventory_bitmap(self, inventory=None, host_version=None):
+        """
+        :param host_version: see HostInventory.ensure_fresh
+        :return: (snapshot, bitmap) or None when the inventory can't answer
+        """
+        inventory = inventory or host_inventory
+        if not await inventory.ensure_fresh(host_version=host_version):
+            return None
+        snapshot = inventory.snapshot
+        try:
+            return snapshot, self.get_inventory_bitmap(snapshot)
+        except HostInventoryUnsupported as e:
+            logger.debug(f"host filter {self.meta.get('id')} goes to sql: {e}")
+            return None
+
+    async def _inventory_hosts(self, snapshot, bitmap, columns):
+        names = [c.key for c in columns] if columns else None
+        if names and snapshot.COLUMNS.issuperset(names):
+            return snapshot.hosts(bitmap, names)
+        ips = [snapshot.ips[i] for i in snapshot.rows(bitmap)]
+        if not ips:
+            return []
+        return await self._host_orm_instance.query(orm.t.h.ip.in_(ips), columns=columns)
+
+    async def get_hosts_from_inventory(self, columns=None, inventory=None, host_version=None):
+        """Host list from the in-process inventory, None when the inventory can't answer"""
+        answer = await self._inventory_bitmap(inventory, host_version=host_version)
+        if answer is None:
+            return None
+        return await self._inventory_hosts(*answer, columns)
+
+    def validate(self):
+        """
+        compile the filter to a sql expression without running it
+        :raise HostFilterException: unknown item / condition, wrong args or not compilable
+        """
+        try:
+            condition = self.get_query_condition()
+            condition.compile(dialect=orm.engine.dialect)
+        except HostFilterException:
+            raise
+        except Exception as e:
+            raise HostFilterException(f"filters can't compile to sql: {e}")
+        return condition
+
+    async def preview(self, sample_size=10, columns=None, inventory=None):
+        """
+        {"count": number of matching hosts, "sample": at most sample_size of them}
+        counted on the host inventory bitmap when it can answer, COUNT + LIMIT sql otherwise
+        """
+        columns = columns or [orm.t.h.ip, orm.t.h.envs]
+        answer = await self._inventory_bitmap(inventory)
+        if answer is not None:
+            snapshot, bitmap = answer
+            sample_bitmap = 0
+            for i in itertools.islice(snapshot.rows(bitmap), sample_size):
+                sample_bitmap |= 1 << i
+            return {"count": bin(bitmap).count("1"),
+                    "sample": await self._inventory_hosts(snapshot, sample_bitmap, columns) if sample_bitmap else []}
+        condition = self.get_query_condition()
+        sample, _ = await self._host_orm_instance.query_page(condition, columns=columns, limit=sample_size)
+        return {"count": await self._host_orm_instance.count(condition), "sample": sample}
+
+    async def facets(self, dimensions, inventory=None):
+        """
+        {dimension: {value: number of matching hosts}}, hosts without the attribute are counted under None
+        bitmap intersections on the host inventory when it can answer, one GROUP BY over all dimensions otherwise
+        """
+        unknown = set(dimensions) - set(self.FACET_DIMENSIONS) - self.INVENTORY_FACET_DIMENSIONS
+        if unknown:
+            raise HostFilterFacetNotAllow(f"facet dimensions {sorted(unknown)} not allow, "
+                                          f"choose from {[*self.FACET_DIMENSIONS, *self.INVENTORY_FACET_DIMENSIONS]}")
+        if not dimensions:
+            return {}
+        answer = await self._inventory_bitmap(inventory)
+        if answer is not None:
+            snapshot, bitmap = answer
+            return {dimension: snapshot.facet(bitmap, dimension) for dimension in dimensions}
+        inventory_only = [d for d in dimensions if d in self.INVENTORY_FACET_DIMENSIONS]
+        if inventory_only:
+            raise HostFilterFacetNotAllow(f"facet dimensions {inventory_only} need the host inventory, "
+                                          f"which can't answer this filter")
+        rows = await self._host_orm_instance.group_count(
+            self.get_query_condition(), group_by=[self.FACET_DIMENSIONS[d] for d in dimensions])
+        result = {dimension: {} for dimension in dimensions}
+        for row in rows:
+            for dimension in dimensions:
+                result[dimension][row[dimension]] = result[dimension].get(row[dimension], 0) + row["count"]
+        return result
+
+    async def evaluate(self, columns=None, host_version=None):
+        """
+        Host list from the host inventory when it can answer, sql otherwise
+        :param host_version: host_filter_cache version the result is cached under, the inventory catches up to it first
+        """
+        hosts = await self.get_hosts_from_inventory(columns, host_version=host_version)
+        if hosts is not None:
+            return hosts
+        return await self._host_orm_instance.query(self.get_query_condition(), columns=columns)
+
+    async def get_hosts(self, columns=None, use_cache=True):
+        """
+        result is a Host list
+        with explicit columns it goes through host_filter_cache, fresh until the next host refresh,
+        use_cache=False evaluates again and overwrites the cached result
+        (default columns carry datetimes the shared json copy can't keep, they are never cached)
+        """
+        if not columns:
+            return await self.evaluate(columns)
+        return await host_filter_cache.get_or_load(filter_cache_key(self.expression, [c.key for c in columns]),
+                                                   lambda version: self.evaluate(columns, host_version=version),
+                                                   refresh=not use_cache)
+
+    async def get_materialized_hosts(self, columns=None):
+        """
+        hosts through an indexed join on host_filter_membership,
+        only current when meta["materialized_at"] is set(host_filter_membership.HostFilterMembership keeps it)
+        """
+        return await self._host_orm_instance.query(orm.t.hfm.filter_id == self.meta["id"],
+                                                   orm.t.hfm.ip == orm.t.h.ip, columns=columns)
+
+    async def iter_hosts(self, columns=None, chunk_size=None):
+        """yield Host lists of at most chunk_size hosts"""
+        async for hosts in self._host_orm_instance.iter_query(self.get_query_condition(), columns=columns,
+                                                              chunk_size=chunk_size):
+            yield hosts
+
+    async def get_hosts_page(self, columns=None, cursor=None, limit=None):
+        """:return: (Host list, cursor of next page or None)"""
+        return await self._host_orm_instance.query_page(self.get_query_condition(), columns=columns,
+                                                        cursor=cursor, limit=limit)
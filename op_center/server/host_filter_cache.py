@@ -0,0 +1,126 @@
+import collections
+import hashlib
+import json
+import logging
+
+from op_center.basic import cfg, serializer
+
+logger = logging.getLogger(__name__)
+
+
+def filter_cache_key(expression, columns):
+    """
+    :param expression: normalised host filter expression(host_filter.ABCHostFilterExpr)
+    :param columns: column names of the cached hosts
+    """
+    raw = json.dumps([expression.digest(), sorted(columns)])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class HostFilterCache:
+    """
+    host filter results keyed by (host table version, normalised filter + columns)
+
+    crontab/refresh_host bumps the version in redis after it writes the host table,
+    entries of older versions are never read again(redis ones expire by ttl),
+    an in-process LRU sits in front of the redis copy shared by every http process
+    """
+    VERSION_KEY = "host_version"
+    RESULT_PREFIX = "host_filter_result_"
+
+    @property
+    def redis(self):
+        if self._mq is None:
+            # server.mq connects at import, only pay for it once the cache is used
+            from op_center.server.mq import main_mq
+            self._mq = main_mq
+        return self._mq.LINK_POOL
+
+    def __init__(self, mq=None, *, enabled=True, lru_size=256, ttl=86400):
+        self._mq = mq
+        self.enabled = enabled
+        self.lru_size = lru_size
+        self.ttl = ttl
+        self._lru = collections.OrderedDict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "lru_size": len(self._lru),
+        }
+
+    async def version(self) -> int:
+        return int(await self.redis.get(self.VERSION_KEY) or 0)
+
+    async def bump_version(self) -> int:
+        version = await self.redis.incr(self.VERSION_KEY)
+        self._lru.clear()
+        logger.info(f"host version bumped to {version}")
+        return version
+
+    def _lru_get(self, key):
+        hosts = self._lru.get(key, None)
+        if hosts is not None:
+            self._lru.move_to_end(key)
+        return hosts
+
+    def _lru_set(self, key, hosts):
+        self._lru[key] = hosts
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    async def get_or_load(self, key, load, refresh=False):
+        """
+        :param load: async callable evaluating the filter on a miss, called with the host version the entry is
+                     stored under(None: no version, not stored) which the result has to be at least as new as
+        :param refresh: skip the lookup, evaluate and overwrite the entry
+        """
+        if not self.enabled:
+            return await load(None)
+        try:
+            version = await self.version()
+        except Exception as e:
+            # without the version nothing cached can be trusted
+            self.errors += 1
+            logger.warning(f"host filter cache version read failure: {e}")
+            return await load(None)
+        local_key = (version, key)
+        redis_key = f"{self.RESULT_PREFIX}{version}_{key}"
+
+        if not refresh:
+            hosts = self._lru_get(local_key)
+            if hosts is not None:
+                self.hits += 1
+                return list(hosts)
+            try:
+                raw = await self.redis.get(redis_key)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"host filter cache read failure: {e}")
+                raw = None
+            if raw is not None:
+                self.redis_hits += 1
+                hosts = json.loads(raw)
+                self._lru_set(local_key, hosts)
+                return list(hosts)
+
+        self.misses += 1
+        hosts = await load(version)
+        self._lru_set(local_key, hosts)
+        try:
+            await self.redis.set(redis_key, serializer(hosts), expire=self.ttl)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"host filter cache write failure: {e}")
+        return list(hosts)
+
+
+host_filter_cache = HostFilterCache(**cfg.get("host_filter_cache", {}))
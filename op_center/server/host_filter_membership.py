@@ -0,0 +1,78 @@
+import datetime
+import logging
+
+from op_center.server import orm
+from op_center.server.host_filter import HostFilter, HostFilterException
+
+logger = logging.getLogger(__name__)
+
+
+class HostFilterMembership:
+    """
+    keeps host_filter_membership equal to what every saved host filter selects:
+    - refresh_filter: a filter definition changed, that filter is recomputed
+    - refresh_hosts: hosts changed, only they are tested again against the saved filters
+    deltas are {filter_id: (added ips, removed ips)}
+
+    reads go to the primary(router=False), deltas against a lagging replica would be wrong
+    """
+    CHUNK_SIZE = orm.ABCOrm.BULK_BATCH_SIZE
+
+    def __init__(self, orm_session=None):
+        self._orm_membership = orm.HostFilterMembership(session=orm_session, router=False)
+        self.orm_session = self._orm_membership._session
+        self._orm_host_filter = orm.HostFilter(session=self.orm_session, router=False)
+        self._orm_host = orm.Host(session=self.orm_session, router=False)
+
+    async def _matched(self, hf, ips=None):
+        conditions = [hf.get_query_condition()]
+        if ips is not None:
+            conditions.append(orm.t.h.ip.in_(ips))
+        return {h["ip"] for h in await self._orm_host.query(*conditions, columns=[orm.t.h.ip])}
+
+    async def refresh_filter(self, meta):
+        """recompute one filter, :return: (added ips, removed ips)"""
+        hf = HostFilter(meta, orm_session=self.orm_session)
+        matched = await self._matched(hf)
+        members = await self._orm_membership.members(meta["id"])
+        added, removed = matched - members, members - matched
+        await self._orm_membership.apply(meta["id"], added=added, removed=removed)
+        await self._orm_host_filter.query_update(orm.t.hf.id == meta["id"], materialized_at=datetime.datetime.now())
+        logger.info(f"host filter {meta['id']} materialised: +{len(added)} -{len(removed)}")
+        return added, removed
+
+    async def refresh_hosts(self, ips):
+        """
+        test changed hosts against every saved filter, filters never materialised are recomputed
+        :return: deltas of the filters whose membership changed
+        """
+        ips = sorted(ips)
+        deltas = {}
+        for meta in await self._orm_host_filter.query(columns=[orm.t.hf.id, orm.t.hf.filters,
+                                                               orm.t.hf.materialized_at]):
+            try:
+                if meta["materialized_at"] is None:
+                    added, removed = await self.refresh_filter(meta)
+                else:
+                    added, removed = await self._refresh_filter_hosts(meta, ips)
+            except HostFilterException as e:
+                logger.warning(f"host filter {meta['id']} can't be materialised: {e}")
+                continue
+            if added or removed:
+                deltas[meta["id"]] = (added, removed)
+        return deltas
+
+    async def _refresh_filter_hosts(self, meta, ips):
+        hf = HostFilter(meta, orm_session=self.orm_session)
+        added, removed = set(), set()
+        for start in range(0, len(ips), self.CHUNK_SIZE):
+            chunk = ips[start:start + self.CHUNK_SIZE]
+            matched = await self._matched(hf, chunk)
+            members = await self._orm_membership.members(meta["id"], chunk)
+            added |= matched - members
+            removed |= members - matched
+        await self._orm_membership.apply(meta["id"], added=added, removed=removed)
+        return added, removed
+
+    async def remove_filter(self, filter_id):
+        await self._orm_membership.query_delete(orm.t.hfm.filter_id == filter_id)
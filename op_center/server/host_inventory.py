@@ -0,0 +1,267 @@
+import asyncio
+import bisect
+import logging
+import re
+import time
+
+from op_center.basic import cfg, ip_to_int, cidr_to_int_range
+from op_center.server import orm, ServerException
+
+logger = logging.getLogger(__name__)
+
+
+class HostInventoryException(ServerException):
+    pass
+
+
+class HostInventoryUnsupported(HostInventoryException):
+    """the condition can't be answered by the inventory, caller goes to sql"""
+    pass
+
+
+class HostSnapshot:
+    """
+    column-wise copy of the host table, row i is self.ips[i]
+    bitmaps[attr][value] is an int whose bit i is set when row i has that value(array attrs: contains it),
+    present[attr] marks rows where attr is not null, the same rows sql comparisons can match,
+    ip_order is (integer ip, row) sorted for cidr / range bisection
+    """
+    SCALAR_ATTRIBUTES = ["ok", "idc", "machine_type", "env_type", "zone", "department"]
+    # attr -> issystem array key
+    ARRAY_ATTRIBUTES = {"app4": "app4", "app_name": "app_name"}
+    # columns get_hosts can answer without sql
+    COLUMNS = {"ip", "envs", *SCALAR_ATTRIBUTES}
+
+    def __init__(self):
+        self.ips = []
+        self.index = {}
+        self.values = []
+        self.envs = []
+        self.all = 0
+        self.bitmaps = {attr: {} for attr in [*self.SCALAR_ATTRIBUTES, *self.ARRAY_ATTRIBUTES]}
+        self.present = {attr: 0 for attr in self.bitmaps}
+        self.ip_order = []
+
+    def __len__(self):
+        return len(self.ips)
+
+    @classmethod
+    def row_values(cls, row):
+        values = {attr: row[attr] for attr in cls.SCALAR_ATTRIBUTES}
+        values["ok"] = bool(row["ok"])
+        issystem = row.get("issystem") or {}
+        for attr, key in cls.ARRAY_ATTRIBUTES.items():
+            value = issystem.get(key)
+            values[attr] = tuple(value) if isinstance(value, list) else None
+        return values
+
+    def _iter_values(self, attr, value):
+        if value is None:
+            return []
+        return value if attr in self.ARRAY_ATTRIBUTES else [value]
+
+    def _clear(self, i):
+        mask = ~(1 << i)
+        for attr, value in self.values[i].items():
+            for v in self._iter_values(attr, value):
+                bitmap = self.bitmaps[attr][v] & mask
+                if bitmap:
+                    self.bitmaps[attr][v] = bitmap
+                else:
+                    del self.bitmaps[attr][v]
+            self.present[attr] &= mask
+
+    def set(self, row):
+        i = self.index.get(row["ip"], None)
+        if i is None:
+            i = len(self.ips)
+            self.index[row["ip"]] = i
+            self.ips.append(row["ip"])
+            self.values.append({})
+            self.envs.append(None)
+            self.all |= 1 << i
+            ip_int = ip_to_int(row["ip"])
+            if ip_int is not None:
+                bisect.insort(self.ip_order, (ip_int, i))
+        else:
+            self._clear(i)
+        bit = 1 << i
+        values = self.row_values(row)
+        for attr, value in values.items():
+            for v in self._iter_values(attr, value):
+                self.bitmaps[attr][v] = self.bitmaps[attr].get(v, 0) | bit
+            if value is not None:
+                self.present[attr] |= bit
+        self.values[i] = values
+        self.envs[i] = row["envs"]
+
+    # bitmap algebra, one method per ABCHostItemFilter condition
+    def _value_bitmap(self, attr, value):
+        if attr == "ip":
+            i = self.index.get(value, None)
+            return 0 if i is None else 1 << i
+        if attr not in self.bitmaps:
+            raise HostInventoryUnsupported(f"host attribute {attr} is not in inventory")
+        try:
+            return self.bitmaps[attr].get(value, 0)
+        except TypeError:
+            # unhashable args never equal a stored value
+            return 0
+
+    def _present(self, attr):
+        return self.all if attr == "ip" else self.present[attr]
+
+    def bitmap_in(self, attr, args):
+        result = 0
+        for value in args:
+            result |= self._value_bitmap(attr, value)
+        return result
+
+    def bitmap_not_in(self, attr, args):
+        return self._present(attr) & ~self.bitmap_in(attr, args)
+
+    def bitmap_is(self, attr, args):
+        return self._value_bitmap(attr, args)
+
+    def bitmap_is_not(self, attr, args):
+        return self._present(attr) & ~self._value_bitmap(attr, args)
+
+    def bitmap_regexp(self, attr, args):
+        if attr != "ip":
+            raise HostInventoryUnsupported(f"regexp on {attr} is not in inventory")
+        # mysql REGEXP matches anywhere in the value
+        pattern = re.compile(args)
+        result = 0
+        for i, ip in enumerate(self.ips):
+            if pattern.search(ip):
+                result |= 1 << i
+        return result
+
+    def _int_range_bitmap(self, first, last):
+        result = 0
+        start = bisect.bisect_left(self.ip_order, (first, -1))
+        for _, i in self.ip_order[start:bisect.bisect_right(self.ip_order, (last, len(self.ips)))]:
+            result |= 1 << i
+        return result
+
+    def bitmap_cidr(self, attr, args):
+        if attr != "ip":
+            raise HostInventoryUnsupported(f"cidr on {attr} is not in inventory")
+        result = 0
+        for cidr in args:
+            result |= self._int_range_bitmap(*cidr_to_int_range(cidr))
+        return result
+
+    def bitmap_range(self, attr, args):
+        if attr != "ip":
+            raise HostInventoryUnsupported(f"range on {attr} is not in inventory")
+        return self._int_range_bitmap(*map(ip_to_int, args))
+
+    def facet(self, bitmap, attr):
+        """{value: number of bitmap rows having it}, rows without attr are counted under None"""
+        result = {}
+        for value, value_bitmap in self.bitmaps[attr].items():
+            count = bin(bitmap & value_bitmap).count("1")
+            if count:
+                result[value] = count
+        missing = bin(bitmap & ~self.present[attr]).count("1")
+        if missing:
+            result[None] = missing
+        return result
+
+    def rows(self, bitmap):
+        """row numbers of the set bits"""
+        while bitmap:
+            low = bitmap & -bitmap
+            yield low.bit_length() - 1
+            bitmap ^= low
+
+    def hosts(self, bitmap, columns):
+        """:param columns: column names, all in self.COLUMNS"""
+        result = []
+        for i in self.rows(bitmap):
+            row = {"ip": self.ips[i], "envs": self.envs[i], **self.values[i]}
+            result.append({c: row[c] for c in columns})
+        return result
+
+
+class HostInventory:
+    """
+    in-process HostSnapshot kept fresh by m_time:
+    rows changed since the newest m_time seen are re-read every `refresh_interval` seconds,
+    the whole table every `full_refresh_interval` seconds(picks up deleted hosts) into a new snapshot
+    `host_version` is the newest host_filter_cache version the snapshot is known to include
+    """
+    REFRESH_COLUMNS = [orm.t.h.ip, orm.t.h.envs, orm.t.h.issystem, orm.t.h.m_time,
+                       *[getattr(orm.t.h, attr) for attr in HostSnapshot.SCALAR_ATTRIBUTES]]
+
+    def __init__(self, session_maker=None, *, enabled=True, refresh_interval=30, full_refresh_interval=3600):
+        self.session_maker = session_maker
+        self.enabled = enabled
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.snapshot = None
+        self.synced_m_time = None
+        self.refreshed_at = None
+        self.full_refreshed_at = None
+        self.host_version = None
+        self._lock = None
+
+    def _apply(self, snapshot, rows):
+        for row in rows:
+            snapshot.set(row)
+            if self.synced_m_time is None or row["m_time"] > self.synced_m_time:
+                self.synced_m_time = row["m_time"]
+
+    async def refresh(self, full=False):
+        async with orm.UnitOfWork(self.session_maker) as session:
+            host = orm.Host(session=session)
+            if full or self.snapshot is None:
+                snapshot, self.synced_m_time = HostSnapshot(), None
+                async for rows in host.iter_query(columns=self.REFRESH_COLUMNS):
+                    self._apply(snapshot, rows)
+                self.snapshot = snapshot
+                self.full_refreshed_at = time.monotonic()
+                logger.info(f"host inventory loaded {len(snapshot)} hosts")
+            else:
+                # >= : rows written in the same second as the last sync are read again, set() is idempotent
+                conditions = [orm.t.h.m_time >= self.synced_m_time] if self.synced_m_time is not None else []
+                rows = await host.query(*conditions, columns=self.REFRESH_COLUMNS)
+                self._apply(self.snapshot, rows)
+                logger.debug(f"host inventory refreshed {len(rows)} hosts")
+        self.refreshed_at = time.monotonic()
+
+    def _fresh(self, now, host_version):
+        if host_version is not None and (self.host_version is None or self.host_version < host_version):
+            return False
+        return self.refreshed_at is not None and now - self.refreshed_at < self.refresh_interval
+
+    async def ensure_fresh(self, host_version=None):
+        """
+        :param host_version: host_filter_cache version the answer is for, read before this call,
+                             the snapshot is refreshed now unless a refresh already started after it was read
+        :return: snapshot usable or not, refresh failures leave the caller on sql
+        """
+        if not self.enabled:
+            return False
+        if self._fresh(time.monotonic(), host_version):
+            return True
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            if self._fresh(now, host_version):
+                return True
+            try:
+                await self.refresh(full=self.full_refreshed_at is None
+                                   or now - self.full_refreshed_at > self.full_refresh_interval)
+            except Exception as e:
+                logger.warning(f"host inventory refresh failure, fall back to sql: {e}")
+                return False
+            # the version is bumped after the host table is written, a refresh started later reads those writes
+            if host_version is not None and (self.host_version is None or self.host_version < host_version):
+                self.host_version = host_version
+        return True
+
+
+host_inventory = HostInventory(**cfg.get("host_inventory", {}))
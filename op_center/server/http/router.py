@@ -20,12 +20,18 @@ def setup(app):
     # host filter
     # get/post
     app.router.add_route("*", "/api/host-filter/", host_filter.HostFilter)
+    # post, count + sample of an unsaved filter definition
+    app.router.add_route("*", "/api/host-filter/preview/", host_filter.HostFilterPreview)
+    # get, hit/miss counters of the host filter result cache
+    app.router.add_route("*", "/api/host-filter/cache/", host_filter.HostFilterCacheStats)
     # get/post/delete
     app.router.add_route("*", "/api/host-filter/{id}/", host_filter.HostFilterDetail)
     # post
     app.router.add_route("*", "/api/host-filter/{id}/fork/", host_filter.HostFilterFork)
     # get
     app.router.add_route("*", "/api/host-filter/{id}/host/", host_filter.HostFilterHost)
+    # get, ?dimensions=idc,env_type -> host counts per value
+    app.router.add_route("*", "/api/host-filter/{id}/facet/", host_filter.HostFilterFacet)
     #
     # workflow
     # get/post
@@ -56,6 +62,10 @@ def setup(app):
     # task
     # get
     app.router.add_route("*", "/api/task/", task.Task)
+    # get/post, admission limits / usage / rejection and wait time counters
+    app.router.add_route("*", "/api/task/admission/", task.TaskAdmission)
+    # get/post, queue lengths / wait time counters per priority level and group, post sets a group weight
+    app.router.add_route("*", "/api/task/queue/", task.TaskQueue)
     # get/post/delete
     app.router.add_route("*", "/api/task/{id}/", task.TaskDetail)
     # get
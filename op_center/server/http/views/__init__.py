@@ -7,7 +7,7 @@ from aiohttp import web
 from aiohttp_session import get_session
 
 from op_center.basic import serializer, BasicException
-from op_center.server import user, controller
+from op_center.server import user, controller, orm
 from op_center.server.http import HttpException
 
 logger = logging.getLogger(__name__)
@@ -120,6 +120,10 @@ class ABCView(web.View, metaclass=abc.ABCMeta):
     async def on_close(self):
         pass
 
+    async def release(self):
+        """always called once the request is done, whatever happened"""
+        pass
+
     @asyncio.coroutine
     def __iter__(self):
         result = None
@@ -139,10 +143,13 @@ class ABCView(web.View, metaclass=abc.ABCMeta):
             yield from self.on_finish()
             yield from self.on_close()
         except BasicException as e:
-            result = yield from self.response(code=e.code, error=f"{e.type}: {e.msg}")
+            # exceptions may carry a structured `data`, e.g. ServerMQQueueFull capacity
+            result = yield from self.response(code=e.code, error=f"{e.type}: {e.msg}", data=getattr(e, "data", None))
         except Exception as e:
             logger.critical("unknown error occur in view: {}".format(e.args), exc_info=True)
             result = yield from self.response(status=500, code=500, error=str(e))
+        finally:
+            yield from self.release()
         if not result:
             result = yield from self.response(status=500, code=500, error="not response return")
         if not isinstance(result, web.StreamResponse):
@@ -183,8 +190,11 @@ class ABCOpCenterView(ABCView):
     def __init__(self, request):
         super().__init__(request)
         self.controller = None
+        self.unit_of_work = orm.UnitOfWork()
+        self.orm_session = None
 
     async def prepare(self):
+        self.orm_session = await self.unit_of_work.open()
         await multiform_or_json_request_prepare(self)
         logger.debug(f"request.POST {self.request.POST}")
         logger.debug(f"request.query {self.request.query}")
@@ -192,7 +202,33 @@ class ABCOpCenterView(ABCView):
     async def initialize(self):
         if self.user is user.anonymous:
             raise LoginRequired("user cant be anonymous, login first")
-        self.controller = controller.Controller(self.user)
+        self.controller = controller.Controller(self.user, orm_session=self.orm_session)
+
+    async def release(self):
+        await self.unit_of_work.close()
+
+    def page_args(self, cursor_type=str):
+        """
+        keyset pagination args from query string: ?limit=100&cursor=<last pk of previous page>
+        :param cursor_type: type of the pk the cursor is converted to
+        :return: (cursor, limit), limit is None when client doesn't ask for pagination
+        """
+        limit = self.request.query.get("limit")
+        if limit is None:
+            return None, None
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ViewArgsException(f"limit must be int, got {limit}")
+        if limit <= 0:
+            raise ViewArgsException(f"limit must be positive, got {limit}")
+        cursor = self.request.query.get("cursor") or None
+        if cursor is not None:
+            try:
+                cursor = cursor_type(cursor)
+            except ValueError:
+                raise ViewArgsException(f"cursor must be {cursor_type.__name__}, got {cursor}")
+        return cursor, limit
 
     async def response(self, code=0, data=None, status=200, error=None, **kwargs):
         return web.json_response(data={
@@ -205,7 +241,7 @@ class ABCOpCenterView(ABCView):
 
     async def login(self):
         try:
-            self.user = await user.User.login_by_session(self.session)
+            self.user = await user.User.login_by_session(self.session, orm_session=self.orm_session)
             logger.debug(f"after session login user is {self.user}")
         except BasicException as e:
             return await self.response(code=403, error=f"{e.type}: {e.msg}")
@@ -213,7 +249,7 @@ class ABCOpCenterView(ABCView):
         token = self.request.headers.get("X-Auth-Token", None)
         #     raise PrisonViewException("X-Auth-Token or X-Auth-Password header required")
         if token is not None:
-            self.user = await user.User.login_by_token(token) or self.user
+            self.user = await user.User.login_by_token(token, orm_session=self.orm_session) or self.user
         logger.debug(f"after token login token({token}) user is {self.user}")
         if not self.user:
             self.user = user.anonymous
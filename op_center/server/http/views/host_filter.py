@@ -1,4 +1,4 @@
-from op_center.server.http.views import ABCOpCenterView
+from op_center.server.http.views import ABCOpCenterView, RequiredDict
 
 
 class HostFilter(ABCOpCenterView):
@@ -12,6 +12,10 @@ class HostFilter(ABCOpCenterView):
         return await self.response(data=meta)
 
     async def get(self):
+        cursor, limit = self.page_args(cursor_type=int)
+        if limit:
+            data, cursor = await self.controller.get_host_filters_page(cursor=cursor, limit=limit)
+            return await self.response(data=data, cursor=cursor)
         data = await self.controller.get_host_filters()
         return await self.response(data=data)
 
@@ -46,5 +50,33 @@ class HostFilterFork(ABCOpCenterView):
 
 class HostFilterHost(ABCOpCenterView):
     async def get(self):
+        cursor, limit = self.page_args()
+        if limit:
+            data, cursor = await self.controller.get_host_filter_hosts_page(
+                id=int(self.url_args.get("id", required=True)), cursor=cursor, limit=limit)
+            return await self.response(data=data, cursor=cursor)
         data = await self.controller.get_host_filter_hosts(id=int(self.url_args.get("id", required=True)))
         return await self.response(data=data)
+
+
+class HostFilterFacet(ABCOpCenterView):
+    async def get(self):
+        """?dimensions=idc,env_type"""
+        dimensions = RequiredDict(self.request.query).get("dimensions", required=True)
+        data = await self.controller.get_host_filter_facets(id=int(self.url_args.get("id", required=True)),
+                                                            dimensions=[d for d in dimensions.split(",") if d])
+        return await self.response(data=data)
+
+
+class HostFilterCacheStats(ABCOpCenterView):
+    async def get(self):
+        return await self.response(data=await self.controller.get_host_filter_cache_stats())
+
+
+class HostFilterPreview(ABCOpCenterView):
+    async def post(self):
+        data = await self.controller.preview_host_filter(
+            filters=self.request.POST.get("filters", required=True),
+            sample_size=self.request.POST.get("sample_size", default=10),
+            group_id=self.request.POST.get("group_id"))
+        return await self.response(data=data)
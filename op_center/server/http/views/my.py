@@ -7,12 +7,12 @@ from op_center.server.http.views import ABCOpCenterView
 class Auth(ABCOpCenterView):
 
     async def initialize(self):
-        self.controller = controller.Controller(self.user)
+        self.controller = controller.Controller(self.user, orm_session=self.orm_session)
 
     async def post(self):
         username = self.request.POST.get("username", required=True)
         password = self.request.POST.get("password", required=True)
-        self.user = await user.User.login_by_password(username, password)
+        self.user = await user.User.login_by_password(username, password, orm_session=self.orm_session)
         self.session["name"] = self.user.name
         return await self.response()
 
@@ -1,3 +1,4 @@
+from op_center.basic import TASK_PRIORITY_NORMAL
 from op_center.server.http.views import ABCOpCenterView
 
 
@@ -56,6 +57,7 @@ class OperationRun(ABCOpCenterView):
             id=int(self.url_args.get("id", required=True)),
             running_kwargs=self.request.POST.get("running_kwargs"),
             use_cache=self.request.POST.get("use_cache", default=True, required=True),
+            priority=self.request.POST.get("priority", default=TASK_PRIORITY_NORMAL),
         )
         return await self.response(data=result)
 
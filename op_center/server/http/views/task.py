@@ -4,10 +4,37 @@ from op_center.server.http.views import ABCOpCenterView
 class Task(ABCOpCenterView):
 
     async def get(self):
+        cursor, limit = self.page_args()
+        if limit:
+            data, cursor = await self.controller.get_task_page(cursor=cursor, limit=limit)
+            return await self.response(data=data, cursor=cursor)
         data = await self.controller.get_task()
         return await self.response(data=data)
 
 
+class TaskAdmission(ABCOpCenterView):
+
+    async def get(self):
+        return await self.response(data=await self.controller.get_admission())
+
+    async def post(self):
+        data = await self.controller.set_admission_limits(scope=self.request.POST.get("scope", required=True),
+                                                          limits=self.request.POST.get("limits", required=True),
+                                                          group_id=self.request.POST.get("group_id"))
+        return await self.response(data=data)
+
+
+class TaskQueue(ABCOpCenterView):
+
+    async def get(self):
+        return await self.response(data=await self.controller.get_task_queues())
+
+    async def post(self):
+        data = await self.controller.set_task_group_weight(group_id=self.request.POST.get("group_id", required=True),
+                                                           weight=self.request.POST.get("weight"))
+        return await self.response(data=data)
+
+
 class TaskDetail(ABCOpCenterView):
 
     async def get(self):
@@ -1,11 +1,18 @@
 import datetime
 import json
 import logging
-import re
+import time
 
-from op_center.basic import TASK_STATUS_WAIT, functools, BaseJsonEncoder, cfg, asyncio, TASK_STATUS_QUEUE
+import aioredis
+
+from op_center.basic import TASK_STATUS_WAIT, functools, BaseJsonEncoder, cfg, asyncio, TASK_STATUS_QUEUE, \
+    TASK_PRIORITIES, TASK_PRIORITY_NORMAL
 from op_center.mq.redis_async_mq import ABCAsyncRedisMQ
+from op_center.mq.result_codec import result_codec
+from op_center.mq.scripts import SET_TASK_STATUS, ENQUEUE_TASK, DEQUEUE_TASK, ACK_TASK, RECLAIM_EXPIRED_TASKS, \
+    RECLAIM_PROCESSING_TASKS, START_TASK, RELEASE_TASK, REQUEUE_TASK, RENEW_LEASE
 from op_center.server import ServerException
+from op_center.server.task_result import TaskResultView
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +29,22 @@ class ServerMQError(ServerMQException):
     pass
 
 
+class ServerMQQueueFull(ServerMQError):
+    """push rejected by the enqueue admission check, nothing was written"""
+    code = 429
+
+    def __init__(self, msg, *, scope, limit, usage, capacity):
+        super().__init__(msg)
+        self.scope = scope
+        self.limit = limit
+        self.usage = usage
+        self.capacity = capacity
+
+    @property
+    def data(self):
+        return {"scope": self.scope, "limit": self.limit, "usage": self.usage, "capacity": self.capacity}
+
+
 class RedisJsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
@@ -50,12 +73,8 @@ class OperatorWorkerAsyncMQ(ABCAsyncRedisMQ):
 
     RUNNING_TASKS_KEY = "running_tasks"
 
-    TASK_RESULT_PREFIX = "task_result_"
-
-    MAX_RUNNING_TASKS_KEY = "max_running_tasks"
-    MAX_QUEUE_TASKS_KEY = "max_queue_tasks"
-
-    TASK_STATUS_KEY_SPLIT = re.compile(r"^(?P<field>.+)__(?P<action>[^_].+)$")
+    # per task stream of host results, entry: {ip, result(result_codec)}
+    TASK_RESULT_STREAM_PREFIX = "task_result_stream_"
 
     def __init__(self, meta: dict):
         super().__init__(link_kwargs=meta['mq_link']["link_kwargs"])
@@ -64,30 +83,18 @@ class OperatorWorkerAsyncMQ(ABCAsyncRedisMQ):
 
     async def change_task_status(self, task_id, kwargs):
         """
-        ask_status_task_id = {
+        set fields of the task status hash in one atomic call,
+        counters the workers move are changed by the host lifecycle scripts(worker.mq) only
+        task_status_task_id = {
         "total": int,
         "finish": int,
-        "all_status": KEYWORDS.TASK_ALL_STATUS,
+        "task_status": ...,
         KEYWORDS.TASK_STATUS_WAIT: int,
         KEYWORDS.TASK_STATUS_QUEUE: int,
         ...: ...
         """
-        key = self.TASK_STATUS_PREFIX + task_id
-        for k, v in kwargs.items():
-            tmp = self.TASK_STATUS_KEY_SPLIT.match(k)
-            if tmp:
-                field = tmp.groupdict().get("field")
-                action = tmp.groupdict().get("action")
-            else:
-                field = k
-                action = None
-            if not action:
-                await self.LINK_POOL.hset(key, field, v)
-            else:
-                if action == "inc":
-                    await self.LINK_POOL.hincrby(key, field, v)
-                else:
-                    raise RuntimeError(f"action {action} error")
+        args = [v for field_value in kwargs.items() for v in field_value]
+        await self.run_script(SET_TASK_STATUS, keys=[self.TASK_STATUS_PREFIX + task_id], args=args)
 
     # @abc.abstractmethod
     # async def run_task_for_one_host(self, *, task_id, workflow, host, running_kwargs):
@@ -115,59 +122,154 @@ class Server2WorkerMasterAsyncMQ(ABCAsyncRedisMQ):
     """
 
     TASK_INFO_PREFIX = "tasK_info_"
+    # base of the priority / fair share queue keys(mq.scripts _QUEUES), the keys of the queue, lease and
+    # admission scripts are hash tagged {task_queue}: in its slot, a redis cluster runs the scripts on one node
     TASK_QUEUE_KEY = "task_queue"
     TASK_STATUS_PREFIX = "task_status_"
 
     RUNNING_TASKS_KEY = "running_tasks"
 
-    TASK_RESULT_PREFIX = "task_result_"
+    # per task stream of host results, entry: {ip, result(result_codec)}
+    TASK_RESULT_STREAM_PREFIX = "task_result_stream_"
 
-    MAX_RUNNING_TASKS_KEY = "max_running_tasks"
-    MAX_QUEUE_TASKS_KEY = "max_queue_tasks"
+    # admission control(mq.scripts ADMISSION_KEYS), scopes: global / group_<id> / group_default
+    ADMISSION_LIMITS_PREFIX = "{task_queue}_admission_limits_"
+    ADMISSION_USAGE_PREFIX = "{task_queue}_admission_usage_"
+    ADMISSION_TASKS_KEY = "{task_queue}_admission_tasks"
+    ADMISSION_STATS_KEY = "{task_queue}_admission_stats"
+    ADMISSION_LIMIT_FIELDS = ["queued_tasks", "queued_hosts", "running_tasks", "running_hosts"]
 
-    TASK_STATUS_KEY_SPLIT = re.compile(r"^(?P<field>.+)__(?P<action>[^_].+)$")
+    # popped but not acked task ids, one list per worker master
+    TASK_PROCESSING_PREFIX = "{task_queue}_processing_"
+    TASK_LEASES_KEY = "{task_queue}_leases"
+    TASK_LEASE_OWNERS_KEY = "{task_queue}_lease_owners"
+
+    # task done events added by the last host of a task(worker.mq.host_finish), read by the worker masters group
+    TASK_EVENTS_KEY = "task_events"
+    TASK_EVENTS_GROUP = "worker_master"
 
     # running task
     async def get_running_task_ids(self) -> set:
         return await self.LINK_POOL.smembers(self.RUNNING_TASKS_KEY)
 
     async def get_running_task_count(self) -> int:
-        return len(await self.get_running_task_ids())
-
-    async def get_max_running_task_count(self) -> int:
-        return int(await self.LINK_POOL.get(self.MAX_RUNNING_TASKS_KEY))
-
-    async def running_task_full_and_raise(self):
-        running_task_count = await self.get_running_task_count()
-        max_running_task_count = await self.get_max_running_task_count()
-        if running_task_count <= max_running_task_count:
-            return False
-        raise ServerMQError(f"running task is full {running_task_count}/{max_running_task_count}")
-
-    async def running_task_full(self) -> bool:
-        running_task_count = await self.get_running_task_count()
-        max_running_task_count = await self.get_max_running_task_count()
-        if running_task_count <= max_running_task_count:
-            return False
-        return False
+        return await self.LINK_POOL.scard(self.RUNNING_TASKS_KEY)
 
     # task queue
-    async def get_queue_task_ids(self) -> list:
-        return await self.LINK_POOL.lrange(self.TASK_QUEUE_KEY, start=0,
-                                           stop=await self.get_max_queue_task_count())
+    def _queue_key(self, suffix):
+        return f"{{{self.TASK_QUEUE_KEY}}}_{suffix}"
+
+    def _queue_keys(self):
+        """mq.scripts QUEUE_KEYS"""
+        return [self.TASK_QUEUE_KEY, *map(self._queue_key, ["positions", "sched_state", "weights", "signal", "stats"])]
 
     async def get_queue_task_count(self):
-        return await self.LINK_POOL.llen(self.TASK_QUEUE_KEY)
+        return sum(queue["length"] for groups in (await self.get_queues()).values() for queue in groups.values())
+
+    async def get_queues(self) -> dict:
+        """{level: {group: {"length": queued tasks, "weight": group weight}}} of the groups having queued tasks"""
+        weights = await self.LINK_POOL.hgetall(self._queue_key("weights"))
+        result = {}
+        for level in TASK_PRIORITIES:
+            result[level] = {}
+            for group in await self.LINK_POOL.zrange(self._queue_key(f"sched_{level}")):
+                result[level][group] = {"length": await self.LINK_POOL.llen(self._queue_key(f"{level}_{group}")),
+                                        "weight": float(weights.get(group, 1))}
+        return result
+
+    async def get_queue_stats(self) -> dict:
+        """wait time of the dequeued tasks, {level or level:group: {dequeued, wait_seconds, max_wait_seconds, avg}}"""
+        result = {}
+        for field, value in (await self.LINK_POOL.hgetall(self._queue_key("stats"))).items():
+            name, counter = field.rsplit(":", 1)
+            result.setdefault(name, {})[counter] = float(value) if "seconds" in counter else int(value)
+        for counters in result.values():
+            dequeued = counters.get("dequeued", 0)
+            counters["avg_wait_seconds"] = counters.get("wait_seconds", 0) / dequeued if dequeued else None
+        return result
+
+    async def set_group_weight(self, group_id, weight=None):
+        """fair share weight of a group in every level, None -> default 1"""
+        if weight is None:
+            await self.LINK_POOL.hdel(self._queue_key("weights"), group_id)
+        elif weight <= 0:
+            raise ServerMQError(f"group weight must be > 0, got {weight}")
+        else:
+            await self.LINK_POOL.hset(self._queue_key("weights"), group_id, weight)
+
+    # admission
+    @staticmethod
+    def _task_group(task):
+        return task.get("group_id") or "none"
 
-    async def get_max_queue_task_count(self) -> int:
-        return int(await self.LINK_POOL.get(self.MAX_QUEUE_TASKS_KEY))
+    def _admission_keys(self, group_id):
+        return [self.ADMISSION_LIMITS_PREFIX + "global", self.ADMISSION_USAGE_PREFIX + "global",
+                self.ADMISSION_LIMITS_PREFIX + f"group_{group_id}", self.ADMISSION_USAGE_PREFIX + f"group_{group_id}",
+                self.ADMISSION_LIMITS_PREFIX + "group_default", self.ADMISSION_TASKS_KEY, self.ADMISSION_STATS_KEY]
 
-    async def queue_full_and_raise(self):
-        queue_task_count = await self.get_queue_task_count()
-        max_queue_task_count = await self.get_max_queue_task_count()
-        if queue_task_count <= max_queue_task_count:
+    async def start_task(self, task, master=None) -> tuple:
+        """
+        running admission check of a popped task, its usage moves from queued to running
+        :param master: only start it while the lease of this master holds
+        :return: (True, seconds waited since enqueued) or (False, (scope, limit field, usage, limit))
+                 or (None, None) the lease of `master` was reclaimed
+        """
+        keys = self._admission_keys(self._task_group(task))
+        if master is not None:
+            keys += [self.TASK_LEASE_OWNERS_KEY, self.TASK_PROCESSING_PREFIX + master]
+        admitted, *detail = await self.run_script(
+            START_TASK, keys=keys, args=[task["id"], len(task["hosts"]), time.time(), self._task_group(task)])
+        if admitted == -1:
+            return None, None
+        if admitted:
+            return True, float(detail[0])
+        return False, tuple(detail)
+
+    async def release_task(self, task_id) -> bool:
+        """give the queued / running usage of a task back, :return: False when it held none"""
+        entry = await self.LINK_POOL.hget(self.ADMISSION_TASKS_KEY, task_id)
+        if entry is None:
             return False
-        raise ServerMQError(f"task queue is full {queue_task_count}/{max_queue_task_count}")
+        group_id = entry.split(":", 3)[3]
+        return bool(await self.run_script(RELEASE_TASK, keys=self._admission_keys(group_id), args=[task_id]))
+
+    def _admission_scope_key(self, scope, group_id=None):
+        if scope == "group":
+            return f"group_{group_id}"
+        if scope in ("global", "group_default"):
+            return scope
+        raise ServerMQError(f"unknown admission scope {scope}")
+
+    async def set_admission_limits(self, scope, limits: dict, group_id=None, overwrite=True):
+        """
+        :param scope: global / group_default / group
+        :param limits: {limit field: int or None(unlimited)}
+        :param overwrite: False -> only set the limits that are not set yet
+        """
+        unknown = set(limits) - set(self.ADMISSION_LIMIT_FIELDS)
+        if unknown:
+            raise ServerMQError(f"unknown admission limits {sorted(unknown)}")
+        key = self.ADMISSION_LIMITS_PREFIX + self._admission_scope_key(scope, group_id)
+        for field, limit in limits.items():
+            if limit is None:
+                await self.LINK_POOL.hdel(key, field)
+            elif overwrite:
+                await self.LINK_POOL.hset(key, field, int(limit))
+            else:
+                await self.LINK_POOL.hsetnx(key, field, int(limit))
+
+    async def get_admission(self) -> dict:
+        """limits / usage per scope and the rejection / wait time counters"""
+        result = {"limits": {}, "usage": {}}
+        for prefix, name in [(self.ADMISSION_LIMITS_PREFIX, "limits"), (self.ADMISSION_USAGE_PREFIX, "usage")]:
+            async for key in self.LINK_POOL.iscan(match=prefix + "*"):
+                result[name][key[len(prefix):]] = {field: int(value) for field, value in
+                                                   (await self.LINK_POOL.hgetall(key)).items()}
+        stats = await self.LINK_POOL.hgetall(self.ADMISSION_STATS_KEY)
+        result["stats"] = {field: float(value) if "seconds" in field else int(value) for field, value in stats.items()}
+        started = result["stats"].get("started", 0)
+        result["stats"]["avg_wait_seconds"] = result["stats"].get("wait_seconds", 0) / started if started else None
+        return result
 
     async def get_task_status(self, task_id):
         # if task_info key exist and task not complete can find status in mq
@@ -177,37 +279,39 @@ class Server2WorkerMasterAsyncMQ(ABCAsyncRedisMQ):
         return await self.LINK_POOL.hgetall(self.TASK_STATUS_PREFIX + task_id) or {}
 
     # task result
+    async def read_task_result(self, task_id, after="0", count=1000) -> list:
+        """
+        result stream entries of a task added after entry `after`, XREAD without BLOCK
+        :return: [(entry id, result_codec.decode_entry), ...]
+        """
+        # results are bytes of result_codec, not utf-8
+        reply = await self.LINK_POOL.execute(b"XREAD", b"COUNT", count,
+                                             b"STREAMS", self.TASK_RESULT_STREAM_PREFIX + task_id, after,
+                                             encoding=None)
+        if not reply:
+            return []
+        return [(entry_id.decode(), result_codec.decode_entry(dict(zip(fields[::2], fields[1::2]))))
+                for entry_id, fields in reply[0][1]]
+
     async def get_task_result(self, task_id):
-        result = await self.LINK_POOL.hgetall(self.TASK_RESULT_PREFIX + task_id)
-        return {ip: json.loads(r) for ip, r in result.items()}
+        """every host result of a task, the whole stream is read, see task_result.task_result_reader"""
+        return (await TaskResultView(task_id).sync(self)).results
 
     # task status
     async def change_task_status(self, task_id, kwargs):
         """
-        ask_status_task_id = {
+        set fields of the task status hash in one atomic call,
+        counters the workers move are changed by the host lifecycle scripts(worker.mq) only
+        task_status_task_id = {
         "total": int,
         "finish": int,
-        "all_status": KEYWORDS.TASK_ALL_STATUS,
+        "task_status": ...,
         KEYWORDS.TASK_STATUS_WAIT: int,
         KEYWORDS.TASK_STATUS_QUEUE: int,
         ...: ...
         """
-        key = self.TASK_STATUS_PREFIX + task_id
-        for k, v in kwargs.items():
-            tmp = self.TASK_STATUS_KEY_SPLIT.match(k)
-            if tmp:
-                field = tmp.groupdict().get("field")
-                action = tmp.groupdict().get("action")
-            else:
-                field = k
-                action = None
-            if not action:
-                await self.LINK_POOL.hset(key, field, v)
-            else:
-                if action == "inc":
-                    await self.LINK_POOL.hincrby(key, field, v)
-                else:
-                    raise RuntimeError(f"action {action} error")
+        args = [v for field_value in kwargs.items() for v in field_value]
+        await self.run_script(SET_TASK_STATUS, keys=[self.TASK_STATUS_PREFIX + task_id], args=args)
 
     async def close_task_by_id(self, task_id):
         # pop task_id from running task collection
@@ -215,82 +319,159 @@ class Server2WorkerMasterAsyncMQ(ABCAsyncRedisMQ):
         # delete running task info
         await self.LINK_POOL.delete(self.TASK_INFO_PREFIX + task_id)
 
-    async def set_max_queue_task_count(self, c):
-        await self.LINK_POOL.set(self.MAX_QUEUE_TASKS_KEY, c)
-
-    async def set_max_running_task_count(self, c):
-        await self.LINK_POOL.set(self.MAX_RUNNING_TASKS_KEY, c)
-
-    async def push_task_to_queue(self, task: dict) -> None or Exception:
+    async def push_task_to_queue(self, task: dict, priority=TASK_PRIORITY_NORMAL) -> None or Exception:
         """
         把 task 丢进任务准备队列 server 端转有方法
         task.status.task_status:  wait -> queue
-        task_status = origin task status
-        task_info_task[id] = task
-        task_queue + task[id]
+        one script(ENQUEUE_TASK) checks the queued limits(global and the task group) and writes all of:
+            admission usage + task, weight: host count
+            task_info_task[id] = task
+            task_status_task[id] = origin task status
+            {task_queue}_<priority>_<group> + task[id]
+        :param priority: queue level, one of TASK_PRIORITIES
+        :raise ServerMQQueueFull: a queued limit is reached, nothing written
         """
         # check task status
         if task['status']["task_status"] != TASK_STATUS_WAIT:
             raise ServerMQTaskError(f"task {task} status is not wait can't push to queue...")
-
-        # check tasks queue is not full
-        await self.queue_full_and_raise()
-
-        # write task info
-        await self.LINK_POOL.set(self.TASK_INFO_PREFIX + str(task["id"]), serializer(task))
-
-        # write task origin status
-        await self.LINK_POOL.hmset_dict(self.TASK_STATUS_PREFIX + task["id"],
-                                        {
-                                            "task_status": TASK_STATUS_QUEUE,
-                                            "total": len(task["hosts"]),
-                                            "finish": 0,
-                                            TASK_STATUS_QUEUE: len(task["hosts"]),
-                                            TASK_STATUS_WAIT: 0,
-                                        })
-
-        # add task_id to task_queue task collection
-        await self.LINK_POOL.rpush(self.TASK_QUEUE_KEY, task["id"])
+        if priority not in TASK_PRIORITIES:
+            raise ServerMQTaskError(f"unknown task priority {priority}, one of {TASK_PRIORITIES}")
+
+        status = {
+            "task_status": TASK_STATUS_QUEUE,
+            "total": len(task["hosts"]),
+            "finish": 0,
+            TASK_STATUS_QUEUE: len(task["hosts"]),
+            TASK_STATUS_WAIT: 0,
+        }
+        pushed, *rejection = await self.run_script(
+            ENQUEUE_TASK,
+            keys=[*self._admission_keys(self._task_group(task)), *self._queue_keys(),
+                  self.TASK_INFO_PREFIX + str(task["id"]), self.TASK_STATUS_PREFIX + task["id"]],
+            args=[task["id"], len(task["hosts"]), time.time(), self._task_group(task), priority, serializer(task),
+                  *[v for field_value in status.items() for v in field_value]])
+        if not pushed:
+            scope, limit, usage, capacity = rejection
+            raise ServerMQQueueFull(f"task queue is full, {scope} {limit} {usage}/{capacity}",
+                                    scope=scope, limit=limit, usage=usage, capacity=capacity)
 
     async def remove_task(self, task_id):
         await self.LINK_POOL.delete(self.TASK_STATUS_PREFIX + task_id)
-        await self.LINK_POOL.delete(self.TASK_RESULT_PREFIX + task_id)
+        await self.LINK_POOL.delete(self.TASK_RESULT_STREAM_PREFIX + task_id)
         await self.LINK_POOL.srem(self.RUNNING_TASKS_KEY, task_id)
 
-    async def pop_task_or_none(self):
-        if await self.running_task_full():
-            logger.debug("running task full...")
-            return None
-        task_id = await self.LINK_POOL.lpop(self.TASK_QUEUE_KEY)
-        logger.debug(f"lpop task {task_id} from task_queue")
-        if not task_id:
-            return None
+    def _lease_keys(self, master):
+        """mq.scripts LEASE_KEYS"""
+        return [*self._queue_keys(), self.TASK_PROCESSING_PREFIX + master, self.TASK_LEASES_KEY,
+                self.TASK_LEASE_OWNERS_KEY]
+
+    async def _dequeue(self, master, lease_timeout):
+        now = time.time()
+        return await self.run_script(DEQUEUE_TASK, keys=self._lease_keys(master),
+                                     args=[now, now + lease_timeout, *TASK_PRIORITIES])
+
+    async def pop_task(self, master, *, timeout=1, lease_timeout=60, reject_delay=0.1):
+        """
+        next task by priority level, then fair share of the groups in the level(DEQUEUE_TASK),
+        moved into the processing list of `master` and leased for `lease_timeout` seconds,
+        ack_task it once it is running
+        a task over a running limit(start_task) goes back to its queue
+        :param master: worker master name
+        :param timeout: seconds to wait for a push on empty queues
+        :param reject_delay: seconds to wait after a rejection, the queues may hold nothing else
+        :return: task or None(timeout / running limit reached / broken task info)
+        """
+        popped = await self._dequeue(master, lease_timeout)
+        if not popped:
+            # every push adds a signal token, block on it instead of polling the queues
+            if not await self.LINK_POOL.brpop(self._queue_key("signal"), timeout=timeout):
+                return None
+            popped = await self._dequeue(master, lease_timeout)
+            if not popped:
+                return None
+        task_id, level, group, waited = popped
+        logger.debug(f"pop task {task_id} from {level} queue of group {group} after {waited}s, leased to {master}")
         task_string = await self.LINK_POOL.get(self.TASK_INFO_PREFIX + task_id)
         if task_string:
-            logger.debug(f"get task info {task_id} success")
             try:
                 task = json.loads(task_string)
             except json.JSONDecodeError:
                 logger.critical(f"json load task {task_id} failure, task_string is --->>> {task_string}")
+            else:
+                logger.debug(f"json load task {task_id} success")
+                admitted, detail = await self.start_task(task, master)
+                if admitted:
+                    logger.info(f"task {task_id} starts after {detail:.3f}s in queue")
+                    return task
+                if admitted is None:
+                    logger.warning(f"task {task_id} lease of {master} expired before it started")
+                    return None
+                logger.debug(f"task {task_id} can't start, {detail}")
+                await self.run_script(REQUEUE_TASK, keys=self._lease_keys(master), args=[task_id, time.time()])
+                await asyncio.sleep(reject_delay)
                 return None
-            logger.debug(f"json load task {task_id} success")
-            await self.LINK_POOL.sadd(self.RUNNING_TASKS_KEY, task_id)
-            # await self.LINK_POOL.hmset_dict(self.TASK_STATUS_PREFIX + task_id,
-            #                                 {"task_status": TASK_STATUS_,
-            #                                  KEYWORDS.TASK_STATUS_QUEUE: 0,
-            #                                  KEYWORDS.TASK_STATUS_RUNNING: 0,
-            #                                  KEYWORDS.TASK_STATUS_ROUTER: len(task["hosts"])})
-            return task
         else:
             logger.critical(f"get task {task_id} is empty...")
-            return None
+        # broken task never runs, don't hand it out again
+        await self.ack_task(master, task_id, running=False)
+        await self.release_task(task_id)
+        return None
+
+    async def ack_task(self, master, task_id, *, running=True) -> bool:
+        """
+        processing -> running tasks, the lease is released
+        :param running: add the task to the running tasks
+        :return: False when the lease had expired and the task went back to the queue, nothing is changed
+        """
+        keys = self._lease_keys(master) + ([self.RUNNING_TASKS_KEY] if running else [])
+        return bool(await self.run_script(ACK_TASK, keys=keys, args=[task_id]))
+
+    async def renew_lease(self, master, task_id, lease_timeout=60) -> bool:
+        """:return: False when the lease had expired and the task was reclaimed"""
+        return bool(await self.run_script(RENEW_LEASE, keys=self._lease_keys(master),
+                                          args=[task_id, time.time() + lease_timeout]))
+
+    async def reclaim_expired_tasks(self) -> list:
+        """task ids of expired leases(any master) back to their queues"""
+        # the processing list of each task is in the lease owners hash, any master name will do
+        return await self.run_script(RECLAIM_EXPIRED_TASKS, keys=self._lease_keys(""), args=[time.time()])
+
+    async def reclaim_processing_tasks(self, master) -> list:
+        """every task id left in the processing list of `master` back to their queues, on master startup"""
+        return await self.run_script(RECLAIM_PROCESSING_TASKS, keys=self._lease_keys(master), args=[time.time()])
+
+    async def write_host_result(self, task_id, host_ip, result: dict):
+        await self.LINK_POOL.xadd(self.TASK_RESULT_STREAM_PREFIX + task_id,
+                                  {"ip": host_ip, "result": result_codec.encode(result)})
+
+    # task events
+    async def create_task_events_group(self):
+        try:
+            await self.LINK_POOL.xgroup_create(self.TASK_EVENTS_KEY, self.TASK_EVENTS_GROUP,
+                                               latest_id="$", mkstream=True)
+        except aioredis.errors.ReplyError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+
+    async def read_task_events(self, master, *, pending_after=None, timeout=1, count=100) -> list:
+        """
+        task done events for `master`, every event goes to one master of the group and stays pending until acked
+        :param pending_after: None -> new events,
+                              event id -> events after it read before but not acked by `master`("0" for all)
+        :param timeout: seconds to block when there is no new event
+        :return: [(event id, {"task_id": xxx, "event": "done"}), ...]
+        """
+        events = await self.LINK_POOL.xread_group(self.TASK_EVENTS_GROUP, master, [self.TASK_EVENTS_KEY],
+                                                  timeout=int(timeout * 1000), count=count,
+                                                  latest_ids=[pending_after or ">"])
+        return [(event_id, fields) for _, event_id, fields in events]
 
-    async def write_host_result(self, task_id, host_ip, result):
-        await self.LINK_POOL.hset(self.TASK_RESULT_PREFIX + task_id,
-                                  host_ip, result)
+    async def ack_task_events(self, *event_ids):
+        await self.LINK_POOL.xack(self.TASK_EVENTS_KEY, self.TASK_EVENTS_GROUP, *event_ids)
 
 
 main_mq = Server2WorkerMasterAsyncMQ(link_kwargs=cfg["mq"]["main"])
 asyncio.get_event_loop().run_until_complete(main_mq.init_mq_conn())
-asyncio.get_event_loop().run_until_complete(main_mq.set_max_running_task_count(10))
-asyncio.get_event_loop().run_until_complete(main_mq.set_max_queue_task_count(50))
+# defaults only, limits changed at runtime(admission api) are kept
+for _scope, _limits in cfg.get("admission", {}).items():
+    asyncio.get_event_loop().run_until_complete(main_mq.set_admission_limits(_scope, _limits, overwrite=False))
@@ -1,8 +1,9 @@
 import uuid
 
-from op_center.basic import TASK_STATUS_WAIT, TASK_STATUS_QUEUE
+from op_center.basic import TASK_STATUS_WAIT, TASK_STATUS_QUEUE, TASK_PRIORITY_NORMAL
 from op_center.server import orm
 from op_center.server.host_filter import HostFilter
+from op_center.server.host_filter_membership import HostFilterMembership
 from op_center.server.mq import main_mq
 
 
@@ -40,18 +41,16 @@ class Operation(orm.OrmObject):
 
     async def get_host_filter(self):
         if not self._host_filter:
-            meta = await self._orm_host_filter.only_or_raise(orm.t.hf.id == self.meta["host_filter_id"])
-            self._host_filter = HostFilter(meta)
+            meta = await self._orm_host_filter.get_or_raise(self.meta["host_filter_id"])
+            self._host_filter = HostFilter(meta, orm_session=self.orm_session)
         return self._host_filter
 
     @classmethod
     async def create_by_id_or_name(cls, *, id=None, name=None,
                                    loop=None, user, orm_session=None, use_cache=False):
         if id:
-            orm_session = orm_session or orm.DBSession()
-            meta = await orm.Operation(session=orm_session).only_or_raise(orm.t.optn.id == id)
+            meta = await orm.Operation(session=orm_session).get_or_raise(id)
         elif name:
-            orm_session = orm_session or orm.DBSession()
             meta = await orm.Operation(session=orm_session).only_or_raise(orm.t.optn.name == name)
         else:
             raise RuntimeError()
@@ -76,7 +75,8 @@ class Operation(orm.OrmObject):
         self._hosts = None
         self._host_ips = None
 
-    async def run(self, running_kwargs: dict = None, hosts=None):
+    async def run(self, running_kwargs: dict = None, hosts=None, priority=TASK_PRIORITY_NORMAL):
+        """:param priority: task queue level, one of TASK_PRIORITIES"""
         workflow = await self.get_workflow(use_cache=self.use_cache)
         running_kwargs = running_kwargs or {}
         running_kwargs = {**workflow["args"], **running_kwargs}
@@ -95,40 +95,36 @@ class Operation(orm.OrmObject):
         )
         task_id = await self._orm_task.create(**task_meta)
         task = await self._orm_task.only_or_raise(orm.t.tsk.id == task_id)
-        await main_mq.push_task_to_queue({**task, "hosts": self._hosts})
+        await main_mq.push_task_to_queue({**task, "hosts": self._hosts}, priority=priority)
         await self._orm_task.query_update(orm.t.tsk.id == task_id,
                                           status={"task_status": TASK_STATUS_QUEUE})
         task = await self._orm_task.only_or_raise(orm.t.tsk.id == task_id)
         return task
 
     async def get_hosts(self, use_cache=None):
+        """
+        hosts of the operation's host filter read from its materialised membership,
+        host refresh and filter changes keep it current,
+        a filter not materialised yet or use_cache=False recomputes the membership first
+        """
         if not self._hosts:
-            if use_cache:
-                self._host_ips = self.meta["cache"]["hosts"]
-                self._hosts = await self._orm_host.query(orm.t.h.ip.in_(self._host_ips),
-                                                         columns=[orm.t.h.ip, orm.t.h.envs])
-            else:
-                host_filter = await self.get_host_filter()
-                self._hosts = await host_filter.get_hosts(columns=[orm.t.h.ip, orm.t.h.envs])
-                self._host_ips = [h["ip"] for h in self._hosts]
+            host_filter = await self.get_host_filter()
+            if use_cache is False or host_filter.meta.get("materialized_at") is None:
+                await HostFilterMembership(orm_session=self.orm_session).refresh_filter(host_filter.meta)
+            self._hosts = await host_filter.get_materialized_hosts(columns=[orm.t.h.ip, orm.t.h.envs])
+            self._host_ips = [h["ip"] for h in self._hosts]
         return self._hosts
 
     async def get_workflow(self, use_cache=None):
-        if use_cache:
-            return self.meta["cache"]["workflow"]
-        else:
-            workflow = await self._orm_workflow.only_or_raise(orm.t.wf.id == self.meta["workflow_id"],
-                                                              columns=[orm.t.wf.id, orm.t.wf.name,
-                                                                       orm.t.wf.basic, orm.t.wf.description,
-                                                                       orm.t.wf.type, orm.t.wf.steps,
-                                                                       orm.t.wf.envs, orm.t.wf.args])
-            return workflow
+        """workflow is read by primary key every run, the operation `cache` json is not used any more"""
+        workflow = await self._orm_workflow.only_or_raise(orm.t.wf.id == self.meta["workflow_id"],
+                                                          columns=[orm.t.wf.id, orm.t.wf.name,
+                                                                   orm.t.wf.basic, orm.t.wf.description,
+                                                                   orm.t.wf.type, orm.t.wf.steps,
+                                                                   orm.t.wf.envs, orm.t.wf.args])
+        return workflow
 
     async def refresh_cache(self):
-        cache = {
-            "hosts": [h["ip"] for h in await self.get_hosts(use_cache=False)],
-            "workflow": await self.get_workflow(use_cache=False),
-        }
-
-        await self._orm_operation.query_update(orm.t.optn.id == self.meta["id"], cache=cache)
-        self._meta = await self._orm_operation.only_or_raise(orm.t.optn.id == self.meta["id"])
+        """re-evaluate the host filter and rewrite its membership"""
+        self._hosts = None
+        await self.get_hosts(use_cache=False)
@@ -88,13 +88,10 @@ class OperatorManager:
     def mq(self):
         return self._mq
 
-    @property
-    def orm_operator(self):
-        return orm.Operator()
-
     async def get_operator_by_id(self, id) -> ABCOperator:
         if id not in self.operators:
-            meta = await self.orm_operator.only_or_none(orm.t.optr.id == id)
+            async with orm.UnitOfWork() as session:
+                meta = await orm.Operator(session=session).only_or_none(orm.t.optr.id == id)
             if not meta:
                 raise OperatorException(f"operator(id={id} not found)")
             operator_cls = ABCOperator.ALL_OPERATORS.get(meta["type"], None)
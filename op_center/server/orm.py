@@ -1,13 +1,18 @@
 import abc
 import asyncio
 import concurrent.futures
+import copy
 import functools
 import logging
+import time
 
 import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine, create_async_engine
+from sqlalchemy.orm import sessionmaker, Session
 
-from op_center.basic import cfg, gen_token, password_encode, PMS_TYPE_OVERALL
+from op_center.basic import cfg, serializer, gen_token, password_encode, PMS_TYPE_OVERALL, DB_ENGINE_THREAD, \
+    DB_ENGINE_ASYNC, DB_ENGINES, TASK_STATUS_NOT_BEGIN, TASK_STATUS_SUCCESS, TASK_STATUS_FAILURE
 from op_center.server import ServerException
 from op_center.server import table, Object
 
@@ -26,9 +31,216 @@ class QueryResultException(OrmException):
     pass
 
 
-engine = sa.create_engine("mysql+pymysql://{user}:{password}@{host}:{port}/{db}?charset=utf8".format_map(cfg["db"]),
-                          pool_size=20, pool_pre_ping=True)
-DBSession = sessionmaker(bind=engine, autoflush=True, autocommit=False)
+DB_DRIVERS = {
+    DB_ENGINE_THREAD: "mysql+pymysql",
+    DB_ENGINE_ASYNC: "mysql+aiomysql",
+}
+
+
+def create_session_maker(url, *, mode=DB_ENGINE_THREAD, **engine_kwargs):
+    """
+    :param url: sqlalchemy database url, driver must match mode
+    :param mode: thread -> blocking driver called from ABCOrm.SESSION_EXECUTOR, the default:
+                           test_orm.TestEngineBenchmark measures it faster than async on sqlite
+                 async  -> asyncio driver awaited directly on the event loop,
+                           sessions have to be closed by an awaited UnitOfWork.close() / ABCOrm.close()
+    :return: (engine, session maker)
+    """
+    if mode not in DB_ENGINES:
+        raise OrmException(f"db engine {mode} not in {DB_ENGINES}")
+    # json columns accept what the api serializer does, LazyJson values included
+    engine_kwargs.setdefault("json_serializer", serializer)
+    if mode == DB_ENGINE_ASYNC:
+        _engine = create_async_engine(url, **engine_kwargs)
+        return _engine, sessionmaker(bind=_engine, class_=AsyncSession, autoflush=True, expire_on_commit=False)
+    _engine = sa.create_engine(url, **engine_kwargs)
+    return _engine, sessionmaker(bind=_engine, autoflush=True, autocommit=False)
+
+
+def db_url(db_cfg, mode=DB_ENGINE_THREAD):
+    return "{driver}://{user}:{password}@{host}:{port}/{db}?charset=utf8".format(driver=DB_DRIVERS[mode], **db_cfg)
+
+
+DB_ENGINE = cfg["db"].get("engine", DB_ENGINE_THREAD)
+engine, DBSession = create_session_maker(db_url(cfg["db"], DB_ENGINE), mode=DB_ENGINE, pool_size=20,
+                                         pool_pre_ping=True)
+
+
+class PoolMetrics:
+    """
+    checkout / checkin / overflow counters of an engine's connection pool,
+    a connection held longer than `hold_warning` seconds is logged when it comes back
+    """
+    CHECKOUT_AT_KEY = "op_center_checkout_at"
+
+    def __init__(self, _engine, hold_warning):
+        self.pool = (_engine.sync_engine if isinstance(_engine, AsyncEngine) else _engine).pool
+        self.hold_warning = hold_warning
+        self.checkout = 0
+        self.checkin = 0
+        self.long_held = 0
+        self.max_checked_out = 0
+        self.max_overflow = 0
+        sa.event.listen(self.pool, "checkout", self.on_checkout)
+        sa.event.listen(self.pool, "checkin", self.on_checkin)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkout += 1
+        connection_record.info[self.CHECKOUT_AT_KEY] = time.monotonic()
+        self.max_checked_out = max(self.max_checked_out, self.checkout - self.checkin)
+        if hasattr(self.pool, "overflow"):
+            self.max_overflow = max(self.max_overflow, self.pool.overflow())
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        self.checkin += 1
+        checkout_at = connection_record.info.pop(self.CHECKOUT_AT_KEY, None)
+        if checkout_at is not None and time.monotonic() - checkout_at > self.hold_warning:
+            self.long_held += 1
+            logger.warning(f"db connection held {time.monotonic() - checkout_at:.2f}s "
+                           f"(> {self.hold_warning}s), pool: {self.pool.status()}")
+
+    def snapshot(self):
+        return {
+            "checkout": self.checkout,
+            "checkin": self.checkin,
+            "checked_out": self.checkout - self.checkin,
+            "max_checked_out": self.max_checked_out,
+            "overflow": self.pool.overflow() if hasattr(self.pool, "overflow") else None,
+            "max_overflow": self.max_overflow,
+            "long_held": self.long_held,
+            "status": self.pool.status(),
+        }
+
+
+SESSION_HOLD_WARNING = cfg["db"].get("session_hold_warning", 5)
+pool_metrics = PoolMetrics(engine, SESSION_HOLD_WARNING)
+
+# statements issued by one session(one request), see ABCOrm.statement_count
+STATEMENT_COUNT_KEY = "statement_count"
+_SESSION_INFO_KEY = "op_center_session_info"
+
+
+@sa.event.listens_for(Session, "after_begin")
+def _bind_session_info(session, transaction, connection):
+    connection.info[_SESSION_INFO_KEY] = session.info
+
+
+@sa.event.listens_for(sa.pool.Pool, "checkin")
+def _unbind_session_info(dbapi_connection, connection_record):
+    connection_record.info.pop(_SESSION_INFO_KEY, None)
+
+
+# set once a session(one unit of work) wrote, its reads stay on primary from then on
+WRITTEN_KEY = "written"
+
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    session_info = conn.info.get(_SESSION_INFO_KEY, None)
+    if session_info is not None:
+        session_info[STATEMENT_COUNT_KEY] = session_info.get(STATEMENT_COUNT_KEY, 0) + 1
+        if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+            session_info[WRITTEN_KEY] = True
+
+
+def mysql_replica_lag(connection):
+    """seconds the replica is behind its source, None when replication is not running"""
+    row = connection.exec_driver_sql("SHOW REPLICA STATUS").mappings().first()
+    if row is None:
+        return None
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    return float(lag) if lag is not None else None
+
+
+class ReplicaRouter:
+    """
+    hands out read sessions on replica engines, round robin over the replicas whose lag is within `max_lag`
+    lag is checked through `lag_check(connection) -> seconds or None` at most once per `check_interval`
+    no usable replica -> None, the caller reads from primary
+    """
+
+    def __init__(self, session_makers=None, *, max_lag=5, check_interval=1, lag_check=mysql_replica_lag):
+        self.session_makers = list(session_makers or [])
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag_check = lag_check
+        self.fallback = 0
+        # replica index -> (checked at, lag)
+        self._lags = {}
+        self._next = 0
+
+    def __bool__(self):
+        return bool(self.session_makers)
+
+    @classmethod
+    def from_cfg(cls, db_cfg, mode=DB_ENGINE_THREAD):
+        """
+        cfg["db"]["replicas"] is a list of overrides of the primary's host/port/user/password
+        """
+        makers = [create_session_maker(db_url({**db_cfg, **replica}, mode), mode=mode, pool_size=20,
+                                       pool_pre_ping=True)[1]
+                  for replica in db_cfg.get("replicas", [])]
+        return cls(makers, max_lag=db_cfg.get("replica_max_lag", 5),
+                   check_interval=db_cfg.get("replica_lag_check_interval", 1))
+
+    def lag(self, index, session):
+        checked_at, lag = self._lags.get(index, (None, None))
+        if checked_at is None or time.monotonic() - checked_at > self.check_interval:
+            try:
+                lag = self.lag_check(session.connection())
+            except Exception as e:
+                logger.warning(f"replica {index} lag check failure: {e}")
+                lag = None
+            self._lags[index] = (time.monotonic(), lag)
+        return lag
+
+    def session(self):
+        """runs inside an op_* function, the lag check is a blocking call"""
+        for i in range(len(self.session_makers)):
+            index = (self._next + i) % len(self.session_makers)
+            session = self.session_makers[index]()
+            sync_session = session.sync_session if isinstance(session, AsyncSession) else session
+            lag = self.lag(index, sync_session)
+            if lag is not None and lag <= self.max_lag:
+                self._next = index + 1
+                return session
+            logger.debug(f"replica {index} lag {lag} over {self.max_lag}s, skip it")
+            sync_session.close()
+        self.fallback += 1
+        return None
+
+
+replica_router = ReplicaRouter.from_cfg(cfg["db"], DB_ENGINE)
+READ_SESSION_KEY = "read_session"
+
+
+IDENTITY_MAP_KEY = "identity_map"
+
+
+class IdentityMap:
+    """
+    rows already read by one session(one request), keyed by (table name, primary key)
+    get/set hand out deep copies so callers can't change what is cached, json values(status, hosts...) included
+    """
+
+    def __init__(self):
+        self._rows = {}
+
+    def get(self, table_name, pk):
+        row = self._rows.get((table_name, pk), None)
+        return copy.deepcopy(row) if row is not None else None
+
+    def set(self, table_name, pk, row):
+        self._rows[(table_name, pk)] = copy.deepcopy(dict(row))
+
+    def invalidate(self, table_name):
+        for key in [k for k in self._rows if k[0] == table_name]:
+            del self._rows[key]
+
+
+CARDINALITY_NONE = 0
+CARDINALITY_ONE = 1
+CARDINALITY_MANY = 2
 
 
 class t:
@@ -37,10 +249,12 @@ class t:
     gp = table.GroupPermission
     h = table.Host
     hf = table.HostFilter
+    hfm = table.HostFilterMembership
     wf = table.Workflow
     optr = table.Operator
     optn = table.Operation
     tsk = table.Task
+    thr = table.TaskHostResult
 
 
 class ABCOrm(metaclass=abc.ABCMeta):
@@ -50,32 +264,119 @@ class ABCOrm(metaclass=abc.ABCMeta):
     SESSION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=10,
                                                              thread_name_prefix="db-executor")
 
+    # rows per statement of bulk_upsert / bulk_update
+    BULK_BATCH_SIZE = cfg["db"].get("bulk_batch_size", 1000)
+    # rows per chunk of iter_query / query_page
+    QUERY_CHUNK_SIZE = cfg["db"].get("query_chunk_size", 1000)
+
     @property
     def session(self):
+        """the sync session every op_* function works on"""
+        if self.is_async:
+            return self._session.sync_session
         return self._session
 
-    def __init__(self, session=None):
+    @property
+    def is_async(self):
+        return isinstance(self._session, AsyncSession)
+
+    @property
+    def read_session(self):
+        """
+        the sync session query/count/exists/only_or_* read from:
+        a replica picked by the router, primary once this session wrote or when no replica is usable
+        """
+        info = self.session.info
+        if info.get(WRITTEN_KEY) or not self._router:
+            return self.session
+        read_session = info.get(READ_SESSION_KEY, None)
+        if read_session is None:
+            read_session = self._router.session()
+            if read_session is None:
+                return self.session
+            info[READ_SESSION_KEY] = read_session
+        return read_session.sync_session if isinstance(read_session, AsyncSession) else read_session
+
+    @property
+    def identity_map(self) -> IdentityMap:
+        return self.session.info.setdefault(IDENTITY_MAP_KEY, IdentityMap())
+
+    @property
+    def statement_count(self):
+        """sql statements issued so far by the session this orm works on"""
+        return self.session.info.get(STATEMENT_COUNT_KEY, 0)
+
+    def __init__(self, session=None, router=None):
+        # only close the session we create, a given one belongs to its UnitOfWork/creator
+        self._own_session = session is None
         self._session = session or DBSession()
+        self._router = replica_router if router is None else router
 
     def __del__(self):
+        if not self._own_session:
+            return
+        if self.is_async:
+            # an AsyncSession can only be closed awaited on its event loop, never from the garbage collector
+            logger.warning(f"{self.__class__.__name__} async db session is not closed, use UnitOfWork / close()")
+            return
+        read_session = self.session.info.pop(READ_SESSION_KEY, None)
+        if read_session is not None and not isinstance(read_session, AsyncSession):
+            read_session.close()
         self.session.close()
 
+    async def close(self):
+        """close the session this orm created, a given one is closed by its UnitOfWork/creator"""
+        if self._own_session:
+            self._own_session = False
+            await close_session(self._session)
+
     async def _execute(self, *fs):
-        def mf():
+        def mf(*_):
             result = None
-            for f in fs:
-                result = f()
-            self.session.commit()
+            sessions = [self.session]
+            try:
+                for f in fs:
+                    result = f()
+                read_session = self.session.info.get(READ_SESSION_KEY, None)
+                if read_session is not None:
+                    # end the replica transaction too, its connection goes back to the pool
+                    sessions.append(read_session.sync_session if isinstance(read_session, AsyncSession)
+                                    else read_session)
+                for session in sessions:
+                    session.commit()
+            except Exception:
+                for session in sessions:
+                    session.rollback()
+                raise
             return result
 
+        if self.is_async:
+            # op_* functions run inside the async session's greenlet, no thread hop
+            return await self._session.run_sync(mf)
         return await asyncio.get_event_loop().run_in_executor(self.SESSION_EXECUTOR, mf)
 
     @staticmethod
     def _f(f, *args, **kwargs):
         return functools.partial(f, *args, **kwargs)
 
-    def gen_query_columns(self, columns: list):
-        return columns or list(self.TABLE._sa_class_manager.values())
+    @staticmethod
+    def _batches(rows, batch_size):
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+
+    def _bulk_table(self, _table=None):
+        _table = _table or self.TABLE
+        return getattr(_table, "__table__", _table)
+
+    def gen_query_columns(self, columns: list, include_large=False):
+        """
+        explicit columns as given, otherwise every column of the table,
+        large ones(column info["large"]) only with include_large
+        """
+        if columns:
+            return columns
+        return [attr for attr in self.TABLE._sa_class_manager.values()
+                if include_large or not attr.property.columns[0].info.get("large", False)]
 
     def op_create(self, **kwargs):
         obj = self.TABLE()
@@ -88,26 +389,113 @@ class ABCOrm(metaclass=abc.ABCMeta):
         logger.debug(f"create instance ok result {self.PK} is: {result}")
         return result
 
+    def op_bulk_upsert(self, rows: list, *, key=None, update_columns=None, table=None, batch_size=None):
+        """
+        insert rows, rows already existing(same unique key) are updated in place
+        one statement per batch:
+            mysql  -> INSERT ... ON DUPLICATE KEY UPDATE
+            sqlite -> INSERT ... ON CONFLICT (key) DO UPDATE
+        :param rows: list of dict, every row has the same keys
+        :param key: column names identify a row, default [PK]
+        :param update_columns: columns overwritten for existing rows, default every column not in key,
+                               [] -> existing rows are left as they are(insert ignore)
+        :param table: target table, default self.TABLE
+        """
+        _table = self._bulk_table(table)
+        key = key or [self.PK]
+        if update_columns is None:
+            update_columns = [c for c in rows[0] if c not in key]
+        dialect = self.session.get_bind().dialect.name
+        for batch in self._batches(rows, batch_size or self.BULK_BATCH_SIZE):
+            if dialect == "mysql":
+                sql = mysql.insert(_table).values(batch)
+                if update_columns:
+                    sql = sql.on_duplicate_key_update({c: sql.inserted[c] for c in update_columns})
+                else:
+                    sql = sql.prefix_with("IGNORE")
+            elif dialect == "sqlite":
+                sql = sqlite.insert(_table).values(batch)
+                if update_columns:
+                    sql = sql.on_conflict_do_update(index_elements=key,
+                                                    set_={c: sql.excluded[c] for c in update_columns})
+                else:
+                    sql = sql.on_conflict_do_nothing(index_elements=key)
+            else:
+                raise SqlException(f"bulk upsert is not supported by {dialect}")
+            self.session.execute(sql)
+
+    def op_bulk_update(self, rows: list, *, key=None, table=None, batch_size=None):
+        """
+        update many rows, each row is located by its `key` columns and the other columns are set,
+        sent as one executemany per batch
+        :param rows: list of dict, every row has the same keys
+        :param key: column names identify a row, default [PK]
+        """
+        _table = self._bulk_table(table)
+        key = key or [self.PK]
+        columns = [c for c in rows[0] if c not in key]
+        sql = sa.update(_table). \
+            where(sa.and_(*[_table.c[k] == sa.bindparam(f"_key_{k}") for k in key])). \
+            values({c: sa.bindparam(f"_value_{c}") for c in columns})
+        for batch in self._batches(rows, batch_size or self.BULK_BATCH_SIZE):
+            self.session.execute(sql, [{**{f"_key_{k}": r[k] for k in key},
+                                        **{f"_value_{c}": r[c] for c in columns}} for r in batch])
+
     def op_query_delete(self, *conditions):
         self.session.query(self.TABLE).filter(*conditions).delete(synchronize_session="fetch")
 
     def op_query_update(self, *conditions, **kwargs):
         self.session.query(self.TABLE).filter(*conditions).update(kwargs, synchronize_session="fetch")
 
-    def op_query(self, *conditions, limit=None, columns=None):
-        sql = self.session.query(*self.gen_query_columns(columns)).filter(*conditions)
+    def op_query(self, *conditions, limit=None, columns=None, include_large=False):
+        sql = self.read_session.query(*self.gen_query_columns(columns, include_large)).filter(*conditions)
         if limit:
             sql = sql.limit(limit)
         return [r._asdict() for r in sql.all()]
 
+    def op_query_after(self, *conditions, after=None, limit, columns=None, include_large=False):
+        """
+        one keyset page: rows ordered by PK whose PK > after,
+        PK is always selected because the next page starts from it
+        """
+        pk = getattr(self.TABLE, self.PK)
+        columns = self.gen_query_columns(columns, include_large)
+        if self.PK not in {getattr(c, "key", None) for c in columns}:
+            columns = [*columns, pk]
+        sql = self.read_session.query(*columns).filter(*conditions)
+        if after is not None:
+            sql = sql.filter(pk > after)
+        return [r._asdict() for r in sql.order_by(pk).limit(limit).all()]
+
     def op_count(self, *conditions):
-        return self.session.query(getattr(self.TABLE, self.PK)).filter(*conditions).count()
+        return self.read_session.query(getattr(self.TABLE, self.PK)).filter(*conditions).count()
+
+    def op_group_count(self, *conditions, group_by):
+        """:return: [{**values of the group_by columns, "count": rows in the group}]"""
+        sql = self.read_session.query(*group_by, sa.func.count().label("count")).filter(*conditions)
+        return [r._asdict() for r in sql.group_by(*group_by).all()]
+
+    def op_exists(self, *conditions):
+        sub_query = self.read_session.query(getattr(self.TABLE, self.PK)).filter(*conditions)
+        return self.read_session.query(sub_query.exists()).scalar()
+
+    def op_fetch_cardinality(self, *conditions, columns=None):
+        """
+        answer none / exactly one / more than one with a single `LIMIT 2` select
+        :return: (CARDINALITY_NONE|CARDINALITY_ONE|CARDINALITY_MANY, the row if exactly one else None)
+        """
+        # single row reads carry the large columns, they are decoded only when used
+        rows = self.op_query(*conditions, limit=2, columns=columns, include_large=True)
+        if len(rows) == 1:
+            return CARDINALITY_ONE, rows[0]
+        return (CARDINALITY_NONE if not rows else CARDINALITY_MANY), None
 
     def op_only_or_raise(self, *conditions, columns=None):
-        count = self.op_count(*conditions)
-        if count != 1:
-            raise QueryResultException(f"acquire 1 row {count} found")
-        return self.op_query(*conditions, columns=columns)[0]
+        cardinality, row = self.op_fetch_cardinality(*conditions, columns=columns)
+        if cardinality != CARDINALITY_ONE:
+            raise QueryResultException(f"acquire 1 row "
+                                       f"{'more than 1' if cardinality == CARDINALITY_MANY else 0} found")
+        return row
 
     def op_only_or_none(self, *conditions, columns=None):
         try:
@@ -118,33 +506,93 @@ class ABCOrm(metaclass=abc.ABCMeta):
     async def create(self, **kwargs):
         return await self._execute(self._f(self.op_create, **kwargs))
 
+    async def get_or_raise(self, pk):
+        """
+        only_or_raise by primary key, served from the session's identity map
+        when this request already read the row
+        """
+        row = self.identity_map.get(self.TABLE.__tablename__, pk)
+        if row is None:
+            row = await self.only_or_raise(getattr(self.TABLE, self.PK) == pk)
+            self.identity_map.set(self.TABLE.__tablename__, pk, row)
+        return row
+
     async def exists(self, *conditions):
-        return await self.count(*conditions) != 0
-        # return await self._execute(self._f(self.op_exists, *conditions))
+        return await self._execute(self._f(self.op_exists, *conditions))
 
     async def not_exist_or_raise(self, *conditions):
         if await self.exists(*conditions):
             raise OrmException("target already exist")
         return True
 
+    async def bulk_upsert(self, rows: list, *, key=None, update_columns=None, table=None, batch_size=None):
+        if not rows:
+            return
+        await self._execute(self._f(self.op_bulk_upsert, rows, key=key, update_columns=update_columns,
+                                    table=table, batch_size=batch_size))
+        self.identity_map.invalidate(self._bulk_table(table).name)
+
+    async def bulk_update(self, rows: list, *, key=None, table=None, batch_size=None):
+        if not rows:
+            return
+        await self._execute(self._f(self.op_bulk_update, rows, key=key, table=table, batch_size=batch_size))
+        self.identity_map.invalidate(self._bulk_table(table).name)
+
     async def query_delete(self, *conditions):
-        return await self._execute(self._f(self.op_query_delete, *conditions))
+        result = await self._execute(self._f(self.op_query_delete, *conditions))
+        self.identity_map.invalidate(self.TABLE.__tablename__)
+        return result
 
     async def query_update(self, *conditions, **kwargs):
-        return await self._execute(self._f(self.op_query_update, *conditions, **kwargs))
+        result = await self._execute(self._f(self.op_query_update, *conditions, **kwargs))
+        self.identity_map.invalidate(self.TABLE.__tablename__)
+        return result
 
-    async def query(self, *conditions, columns=None):
-        return await self._execute(self._f(self.op_query, *conditions, columns=columns))
+    async def query(self, *conditions, columns=None, include_large=False):
+        return await self._execute(self._f(self.op_query, *conditions, columns=columns, include_large=include_large))
 
     async def count(self, *conditions):
         return await self._execute(self._f(self.op_count, *conditions))
 
+    async def group_count(self, *conditions, group_by):
+        return await self._execute(self._f(self.op_group_count, *conditions, group_by=group_by))
+
+    async def query_page(self, *conditions, columns=None, cursor=None, limit=None, include_large=False):
+        """
+        :param cursor: PK of the last row of the previous page, None for the first page
+        :return: (rows, cursor of the next page or None when no more rows)
+        """
+        limit = limit or self.QUERY_CHUNK_SIZE
+        rows = await self._execute(self._f(self.op_query_after, *conditions, after=cursor, limit=limit,
+                                           columns=columns, include_large=include_large))
+        return rows, rows[-1][self.PK] if len(rows) == limit else None
+
+    async def iter_query(self, *conditions, columns=None, chunk_size=None, include_large=False):
+        """
+        async generator of row lists(at most chunk_size rows each) ordered by PK,
+        every chunk is a short keyset query so memory and connection hold time stay bounded
+
+            async for rows in orm.Host().iter_query(orm.t.h.ok == True):
+                ...
+        """
+        cursor = None
+        while True:
+            rows, cursor = await self.query_page(*conditions, columns=columns, cursor=cursor, limit=chunk_size,
+                                                 include_large=include_large)
+            if rows:
+                yield rows
+            if cursor is None:
+                break
+
     async def only_or_raise(self, *conditions, columns=None):
         return await self._execute(self._f(self.op_only_or_raise, *conditions, columns=columns))
 
     async def only_or_none(self, *conditions, columns=None):
         return await self._execute(self._f(self.op_only_or_none, *conditions, columns=columns))
 
+    async def fetch_cardinality(self, *conditions, columns=None):
+        return await self._execute(self._f(self.op_fetch_cardinality, *conditions, columns=columns))
+
 
 class User(ABCOrm):
     TABLE = table.User
@@ -252,27 +700,14 @@ class Group(ABCOrm):
 
     def op_set_or_update_permissions(self, group_id=None, type=None, *, ps: list):
         group = self.op_only_or_raise(self.TABLE.id == group_id)
-        eps = self.op_get_permissions(group_id=group_id, type=type)
-        eps_p_dict = {i["permission"]: {"character": i["character"]} for i in eps}
-        for item in ps:
-            # {character: xxx, permission: xxx}
-            if item["permission"] not in eps_p_dict:
-                new_p = table.GroupPermission(group_id=group["id"],
-                                              type=type,
-                                              permission=item["permission"],
-                                              character=item["character"])
-                self.session.add(new_p)
-            else:
-                # item["permission"] already in check character
-                if item["character"] != eps_p_dict[item["permission"]]["character"]:
-                    # character update
-                    self.session.query(table.GroupPermission). \
-                        filter(table.GroupPermission.group_id == group["id"],
-                               table.GroupPermission.type == type,
-                               table.GroupPermission.permission == item["permission"]). \
-                        update({"character": item["character"]},
-                               synchronize_session="fetch")
-        self.session.flush()
+        # {character: xxx, permission: xxx}
+        if ps:
+            self.op_bulk_upsert([{"group_id": group["id"],
+                                  "type": type,
+                                  "permission": item["permission"],
+                                  "character": item["character"]} for item in ps],
+                                key=["group_id", "type", "permission"],
+                                table=table.GroupPermission)
 
     def op_query_delete_permissions(self, *conditions, group_id, type):
         self.session.query(table.GroupPermission). \
@@ -306,25 +741,13 @@ class Group(ABCOrm):
 
     def op_add_or_update_users(self, group_id=None, *, users: list):
         group = self.op_only_or_raise(self.TABLE.id == group_id)
-        eps = self.op_get_users(group_id=group_id)
-        eps_p_dict = {i["user_id"]: i for i in eps}
-        for item in users:
-            # {character: xxx, user_id: xxx}
-            if item["user_id"] not in eps_p_dict:
-                new_p = table.UserGroupRelation(group_id=group["id"],
-                                                user_id=item["user_id"],
-                                                character=item["character"])
-                self.session.add(new_p)
-            else:
-                # item["permission"] already in check character
-                if item["character"] != eps_p_dict[item["user_id"]]["character"]:
-                    # character update
-                    self.session.query(table.UserGroupRelation). \
-                        filter(table.UserGroupRelation.group_id == group["id"],
-                               table.UserGroupRelation.user_id == item["user_id"]). \
-                        update({"character": item["character"]},
-                               synchronize_session="fetch")
-        self.session.flush()
+        # {character: xxx, user_id: xxx}
+        if users:
+            self.op_bulk_upsert([{"group_id": group["id"],
+                                  "user_id": item["user_id"],
+                                  "character": item["character"]} for item in users],
+                                key=["group_id", "user_id"],
+                                table=table.UserGroupRelation)
 
     def op_query_delete_users(self, *conditions, group_id=None):
         self.session.query(table.UserGroupRelation). \
@@ -356,6 +779,31 @@ class HostFilter(ABCOrm):
     TABLE = table.HostFilter
 
 
+class HostFilterMembership(ABCOrm):
+    TABLE = table.HostFilterMembership
+    KEY = ["filter_id", "ip"]
+
+    def op_apply(self, filter_id, *, added, removed):
+        """add / remove member ips of a filter in one transaction"""
+        for batch in self._batches(sorted(removed), self.BULK_BATCH_SIZE):
+            self.op_query_delete(self.TABLE.filter_id == filter_id, self.TABLE.ip.in_(batch))
+        if added:
+            self.op_bulk_upsert([{"filter_id": filter_id, "ip": ip} for ip in sorted(added)], key=self.KEY)
+
+    async def apply(self, filter_id, *, added, removed):
+        if not added and not removed:
+            return
+        await self._execute(self._f(self.op_apply, filter_id, added=added, removed=removed))
+        self.identity_map.invalidate(self.TABLE.__tablename__)
+
+    async def members(self, filter_id, ips=None):
+        """member ips of a filter, only among `ips` when given"""
+        conditions = [self.TABLE.filter_id == filter_id]
+        if ips is not None:
+            conditions.append(self.TABLE.ip.in_(ips))
+        return {r["ip"] for r in await self.query(*conditions, columns=[self.TABLE.ip])}
+
+
 class Operator(ABCOrm):
     TABLE = table.Operator
 
@@ -367,6 +815,102 @@ class Operation(ABCOrm):
 class Task(ABCOrm):
     TABLE = table.Task
 
+    def op_archive(self, task_id, *, hosts: list, status: dict, results: dict, f_time):
+        """
+        write every host's result into task_host_result and close the task in one transaction,
+        task.result is left empty
+        :param hosts: task hosts(ip list), hosts without result are archived as not_begin
+        :param results: {ip: result dict from mq}
+        """
+        ips = list(dict.fromkeys([*hosts, *results]))
+        rows = [TaskHostResult.to_row(task_id, ip, results.get(ip)) for ip in ips]
+        if rows:
+            self.op_bulk_upsert(rows, key=["task_id", "ip"], table=table.TaskHostResult)
+        self.op_query_update(self.TABLE.id == task_id, status=status, result={}, f_time=f_time)
+
+    async def archive(self, task_id, *, hosts: list, status: dict, results: dict, f_time):
+        await self._execute(self._f(self.op_archive, task_id, hosts=hosts, status=status,
+                                    results=results, f_time=f_time))
+        self.identity_map.invalidate(self.TABLE.__tablename__)
+        self.identity_map.invalidate(table.TaskHostResult.__tablename__)
+
+
+class TaskHostResult(ABCOrm):
+    TABLE = table.TaskHostResult
+    PK = "ip"
+
+    @staticmethod
+    def to_row(task_id, ip, result=None):
+        """mq host result -> task_host_result row"""
+        result = result or {}
+        return {
+            "task_id": task_id,
+            "ip": ip,
+            "status": result.get("status") or TASK_STATUS_NOT_BEGIN,
+            "code": result.get("code"),
+            "worker": result.get("worker"),
+            "c_time": result.get("c_time"),
+            "f_time": result.get("f_time"),
+            "output": {
+                "history": result.get("history") or [],
+                "stdout": result.get("stdout"),
+                "stderr": result.get("stderr"),
+            },
+        }
+
+    @staticmethod
+    def from_row(row):
+        """task_host_result row -> host result dict the same shape as mq result"""
+        output = row.get("output") or {}
+        return {
+            "ip": row["ip"],
+            "status": row["status"],
+            "c_time": row["c_time"],
+            "f_time": row["f_time"],
+            "worker": row["worker"],
+            "history": output.get("history", []),
+            "code": row["code"],
+            "stdout": output.get("stdout"),
+            "stderr": output.get("stderr"),
+        }
+
+    def gen_parse_conditions(self, task_id, *, finish=None, success=None, failure=None,
+                             cost_gt=None, cost_lt=None, code=None, retry=None):
+        """
+        Task.parse_task_result filters as sql conditions, served by the (task_id, status/code) indexes
+        retry is accepted but not recorded per host yet, same as the json result scan
+        """
+        conditions = [self.TABLE.task_id == task_id]
+        if finish is not None:
+            conditions.append(self.TABLE.f_time.isnot(None) if finish else self.TABLE.f_time.is_(None))
+        if success is not None:
+            conditions.append(self.TABLE.status == TASK_STATUS_SUCCESS if success
+                              else self.TABLE.status != TASK_STATUS_SUCCESS)
+        if failure is not None:
+            conditions.append(self.TABLE.status == TASK_STATUS_FAILURE if failure
+                              else self.TABLE.status != TASK_STATUS_FAILURE)
+        if cost_gt is not None:
+            conditions.append(self.TABLE.f_time - self.TABLE.c_time >= cost_gt)
+        if cost_lt is not None:
+            conditions.append(self.TABLE.f_time - self.TABLE.c_time <= cost_lt)
+        if code is not None:
+            conditions.append(self.TABLE.code == code)
+        return conditions
+
+    def op_code_map(self, task_id):
+        result = self.session.query(self.TABLE.code, sa.func.count()). \
+            filter(self.TABLE.task_id == task_id). \
+            group_by(self.TABLE.code).all()
+        return {code: count for code, count in result}
+
+    async def code_map(self, task_id):
+        """{code: host count}, code None means the host has no code"""
+        return await self._execute(self._f(self.op_code_map, task_id))
+
+    async def parse(self, task_id, **kwargs):
+        rows = await self.query(*self.gen_parse_conditions(task_id, **kwargs))
+        return [self.from_row(r) for r in sorted(rows, key=lambda r: r["ip"])]
+
 
 class OrmObject(Object, metaclass=abc.ABCMeta):
     __ORM__ = ABCOrm
@@ -377,5 +921,54 @@ class OrmObject(Object, metaclass=abc.ABCMeta):
 
     def __init__(self, meta: dict, loop=None, orm_session=None):
         super().__init__(meta, loop=loop)
-        self.orm_session = orm_session or DBSession()
-        self._orm_instance = self.__ORM__(session=self.orm_session)
+        self._orm_instance = self.__ORM__(session=orm_session)
+        self.orm_session = self._orm_instance._session
+
+
+async def close_session(session):
+    read_session = (session.sync_session if isinstance(session, AsyncSession) else session).info. \
+        pop(READ_SESSION_KEY, None)
+    if read_session is not None:
+        await close_session(read_session)
+    if isinstance(session, AsyncSession):
+        await session.close()
+    else:
+        # close may roll back on the connection, keep it off the event loop
+        await asyncio.get_event_loop().run_in_executor(ABCOrm.SESSION_EXECUTOR, session.close)
+
+
+class UnitOfWork:
+    """
+    a session with a deterministic end:
+
+        async with orm.UnitOfWork() as session:
+            await orm.Task(session=session).query_update(...)
+
+    open()/close() do the same for callers which can't use `async with`
+    """
+
+    def __init__(self, session_maker=None):
+        self._session_maker = session_maker or DBSession
+        self.session = None
+        self._open_at = None
+
+    async def open(self):
+        self.session = self._session_maker()
+        self._open_at = time.monotonic()
+        return self.session
+
+    async def close(self):
+        if self.session is None:
+            return
+        session, self.session = self.session, None
+        await close_session(session)
+        held = time.monotonic() - self._open_at
+        if held > SESSION_HOLD_WARNING:
+            logger.warning(f"db session held {held:.2f}s (> {SESSION_HOLD_WARNING}s), "
+                           f"statements: {session.info.get(STATEMENT_COUNT_KEY, 0)}")
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -1,11 +1,31 @@
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 
-from op_center.basic import USER_TYPE_LDAP, WORKFLOW_TYPE_SERVER
+from op_center.basic import USER_TYPE_LDAP, WORKFLOW_TYPE_SERVER, LazyJson, ip_to_int
 
 meta = declarative_base()
 
 
+class LazyJSON(sa.types.TypeDecorator):
+    """json column read back as LazyJson, decoded only when the value is used"""
+    impl = sa.JSON
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return value.value if isinstance(value, LazyJson) else value
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            return LazyJson(value) if value is not None else None
+
+        return process
+
+
+# large columns are lazily decoded and left out of default list projections(ABCOrm.gen_query_columns)
+LARGE = {"large": True}
+
+
 class ABCTable(meta):
     __abstract__ = True
 
@@ -69,16 +89,55 @@ class Workflow(ABCTable):
     m_time = sa.Column("m_time", sa.DateTime, server_default="NOW()", server_onupdate="NOW()")
 
 
+def json_generated_column(name, column, path, length=50):
+    """stored generated column holding a scalar json attribute, b-tree indexed"""
+    return sa.Column(name, sa.String(length), sa.Computed(f"`{column}` ->> '$.{path}'", persisted=True),
+                     index=True)
+
+
+def _host_ip_int(context):
+    return ip_to_int(context.get_current_parameters()["ip"])
+
+
 class Host(ABCTable):
     __tablename__ = "host"
     ip = sa.Column("ip", sa.String(20), primary_key=True)
-    basic = sa.Column("basic", sa.JSON, nullable=False, index=True)
-    issystem = sa.Column("issystem", sa.JSON, nullable=True, index=True)
-    envs = sa.Column("envs", sa.JSON, nullable=False, index=True)
+    # INET_ATON(ip), set on insert(ip never changes), cidr / range host filters scan its index
+    ip_int = sa.Column("ip_int", sa.BigInteger().with_variant(mysql.INTEGER(unsigned=True), "mysql"),
+                       nullable=True, index=True, default=_host_ip_int)
+    basic = sa.Column("basic", sa.JSON, nullable=False)
+    issystem = sa.Column("issystem", LazyJSON, nullable=True, info=LARGE)
+    envs = sa.Column("envs", sa.JSON, nullable=False)
     ok = sa.Column("ok", sa.Boolean, nullable=False, index=True, default=False)
     c_time = sa.Column("c_time", sa.DateTime, server_default="NOW()")
     m_time = sa.Column("m_time", sa.DateTime, server_default="NOW()", server_onupdate="NOW()")
 
+    # hot json attributes host filters query, (json column, path) -> generated column
+    JSON_GENERATED_COLUMNS = {
+        ("basic", "idc"): "idc",
+        ("basic", "machine_type"): "machine_type",
+        ("basic", "env_type"): "env_type",
+        ("issystem", "zone"): "zone",
+        ("issystem", "department"): "department",
+    }
+    # json array attributes with a multi-valued index(mysql >= 8.0.17), index name -> (json column, path)
+    JSON_ARRAY_INDEXES = {
+        "ix_host_app4": ("issystem", "app4"),
+        "ix_host_app_name": ("issystem", "app_name"),
+    }
+
+    idc = json_generated_column("idc", "basic", "idc")
+    machine_type = json_generated_column("machine_type", "basic", "machine_type")
+    env_type = json_generated_column("env_type", "basic", "env_type")
+    zone = json_generated_column("zone", "issystem", "zone")
+    department = json_generated_column("department", "issystem", "department", length=100)
+
+
+for _name, (_column, _path) in Host.JSON_ARRAY_INDEXES.items():
+    sa.event.listen(Host.__table__, "after_create",
+                    sa.DDL(f"CREATE INDEX `{_name}` ON `host` "
+                           f"((CAST(`{_column}` -> '$.{_path}' AS CHAR(64) ARRAY)))").execute_if(dialect="mysql"))
+
 
 class HostFilter(ABCTable):
     __tablename__ = "host_filter"
@@ -87,10 +146,19 @@ class HostFilter(ABCTable):
     description = sa.Column("description", sa.Text(), nullable=True)
     group_id = sa.Column("group_id", sa.ForeignKey("group.id"), nullable=True, index=True)
     filters = sa.Column("filters", sa.JSON, nullable=False)
+    # last full recompute of host_filter_membership, NULL -> not materialised yet
+    materialized_at = sa.Column("materialized_at", sa.DateTime, nullable=True)
     c_time = sa.Column("c_time", sa.DateTime, server_default="NOW()")
     m_time = sa.Column("m_time", sa.DateTime, server_default="NOW()", server_onupdate="NOW()")
 
 
+class HostFilterMembership(ABCTable):
+    """materialised result of the saved host filters, one row per (filter, matching host)"""
+    __tablename__ = "host_filter_membership"
+    filter_id = sa.Column("filter_id", sa.ForeignKey("host_filter.id", ondelete="CASCADE"), primary_key=True)
+    ip = sa.Column("ip", sa.String(20), primary_key=True, index=True)
+
+
 class Operator(ABCTable):
     __tablename__ = "operator"
     id = sa.Column("id", sa.Integer, primary_key=True, autoincrement=True)
@@ -112,7 +180,7 @@ class Operation(ABCTable):
     workflow_id = sa.Column("workflow_id", sa.ForeignKey("workflow.id"), nullable=False, index=True)
     host_filter_id = sa.Column("host_filter_id", sa.ForeignKey("host_filter.id"), nullable=False, index=True)
     operator_id = sa.Column("operator_id", sa.ForeignKey("operator.id"), nullable=True, index=True)
-    cache = sa.Column("cache", sa.JSON, nullable=False, index=False)
+    cache = sa.Column("cache", LazyJSON, nullable=False, index=False, info=LARGE)
     c_time = sa.Column("c_time", sa.DateTime, server_default="NOW()")
     m_time = sa.Column("m_time", sa.DateTime, server_default="NOW()", server_onupdate="NOW()")
 
@@ -122,13 +190,32 @@ class Task(ABCTable):
     id = sa.Column("id", sa.String(50), primary_key=True)
     operation_id = sa.Column("operation_id", sa.ForeignKey("operation.id"), nullable=False, index=True)
     group_id = sa.Column("group_id", sa.ForeignKey("group.id"), nullable=True, index=True)
-    hosts = sa.Column("hosts", sa.JSON, nullable=True, index=True)
-    workflow = sa.Column("workflow", sa.JSON, nullable=False, index=True)
+    hosts = sa.Column("hosts", LazyJSON, nullable=True, info=LARGE)
+    workflow = sa.Column("workflow", LazyJSON, nullable=False, info=LARGE)
     operator_id = sa.Column("operator_id", sa.ForeignKey("operator.id"), nullable=True, index=True)
     running_kwargs = sa.Column("running_kwargs", sa.JSON, nullable=True, index=True)
     runner = sa.Column("runner", sa.String(50), nullable=False, index=True)
     status = sa.Column("status", sa.JSON, nullable=False, index=True)
-    result = sa.Column("result", sa.JSON, nullable=False, index=True)
+    result = sa.Column("result", LazyJSON, nullable=False, info=LARGE)
     c_time = sa.Column("c_time", sa.DateTime, server_default="NOW()")
     m_time = sa.Column("m_time", sa.DateTime, server_default="NOW()", server_onupdate="NOW()")
     f_time = sa.Column("f_time", sa.DateTime, nullable=True, index=True)
+
+
+class TaskHostResult(ABCTable):
+    """one row per host of a finished task, replaces the per task `result` json blob"""
+    __tablename__ = "task_host_result"
+    task_id = sa.Column("task_id", sa.ForeignKey("task.id"), primary_key=True)
+    ip = sa.Column("ip", sa.String(20), primary_key=True)
+    status = sa.Column("status", sa.String(20), nullable=False)
+    code = sa.Column("code", sa.Integer, nullable=True)
+    worker = sa.Column("worker", sa.String(100), nullable=True)
+    c_time = sa.Column("c_time", sa.Float, nullable=True)
+    f_time = sa.Column("f_time", sa.Float, nullable=True)
+    # {"history": [...], "stdout": str, "stderr": str}
+    output = sa.Column("output", sa.JSON, nullable=False)
+
+    __table_args__ = (
+        sa.Index("ix_task_host_result_task_id_status", "task_id", "status"),
+        sa.Index("ix_task_host_result_task_id_code", "task_id", "code"),
+    )
@@ -6,6 +6,7 @@ from op_center.basic import TASK_STATUS_QUEUE, TASK_STATUS_WAIT, TASK_STATUS_SUC
     TASK_RETURN_CODE_UNKNOWN
 from op_center.server import orm, ServerException, host_filter
 from op_center.server.mq import main_mq
+from op_center.server.task_result import task_result_reader
 
 logger = logging.getLogger(__name__)
 
@@ -21,10 +22,19 @@ class Task(orm.OrmObject):
     def orm_operation(self):
         return orm.Operation(self.orm_session)
 
+    @property
+    def orm_task_host_result(self):
+        return orm.TaskHostResult(self.orm_session)
+
     @property
     def mq(self):
         return main_mq
 
+    @property
+    def archived(self):
+        """finished task whose per host results live in task_host_result instead of task.result"""
+        return self.meta.get("f_time") is not None and not self.meta.get("result")
+
     # def __init__(self, meta: dict, loop=None, orm_session=None):
     #     super().__init__(meta, loop=loop)
     #     self.orm_session = orm_session or DBSession()
@@ -32,17 +42,25 @@ class Task(orm.OrmObject):
 
     @classmethod
     async def create_by_id(cls, id, loop=None, orm_session=None):
-        orm_session = orm_session or orm.DBSession()
         orm_instance = orm.Task(session=orm_session)
-        task = await orm_instance.only_or_raise(orm.t.tsk.id == id)
+        task = await orm_instance.get_or_raise(id)
         if task["status"]["task_status"] == TASK_STATUS_QUEUE \
                 or task["status"]["task_status"] == TASK_STATUS_WAIT:
             queue_status = await main_mq.get_task_status(task_id=id)
-            queue_result = await main_mq.get_task_result(task_id=id)
+            # only the result entries added since the last read of this task
+            result_view = await task_result_reader.get(id)
             task["status"] = queue_status
-            task["result"] = queue_result
+            task["result"] = dict(result_view.results)
+            task["result_aggregates"] = result_view.aggregates()
         return cls(task, loop=loop, orm_session=orm_session)
 
+    async def get_result(self):
+        """{ip: host result}"""
+        if self.archived:
+            rows = await self.orm_task_host_result.parse(self.meta["id"])
+            return {r["ip"]: r for r in rows}
+        return self.meta["result"]
+
     async def parse_task_result(self, **kwargs):
         """
         cost_gt int
@@ -77,6 +95,13 @@ class Task(orm.OrmObject):
             "details": {},
         }
 
+        if self.archived:
+            for ip_result in await self.orm_task_host_result.parse(self.meta["id"], **kwargs):
+                result["count"] += 1
+                result["ips"].append(ip_result["ip"])
+                result["details"][ip_result["ip"]] = ip_result
+            return result
+
         for ip in hosts:
 
             # result data
@@ -135,8 +160,7 @@ class Task(orm.OrmObject):
         #                                                    columns=[orm.t.optn.id])
         target_hosts_filter = target_hosts_filter or {}
         if target_hosts_filter:
-            target_hosts = (await self.parse_task_result(id=self.meta["id"],
-                                                         **target_hosts_filter))["ips"]
+            target_hosts = (await self.parse_task_result(**target_hosts_filter))["ips"]
         else:
             target_hosts = self.meta["hosts"]
 
@@ -166,9 +190,23 @@ class Task(orm.OrmObject):
     async def code_map(self):
         result = collections.defaultdict(lambda: 0)
 
+        if self.archived:
+            for code, count in (await self.orm_task_host_result.code_map(self.meta["id"])).items():
+                result[code if code is not None else TASK_RETURN_CODE_UNKNOWN] += count
+            return result
+
+        if "result_aggregates" in self.meta:
+            # counted as the results arrived, hosts not finished yet have no code
+            finished = 0
+            for code, count in self.meta["result_aggregates"]["code"].items():
+                result[code if code is not None else TASK_RETURN_CODE_UNKNOWN] += count
+                finished += count
+            if len(self.meta["hosts"]) > finished:
+                result[TASK_RETURN_CODE_UNKNOWN] += len(self.meta["hosts"]) - finished
+            return result
+
         for ip in self.meta['hosts']:
             ip_code = self.meta["result"].get(ip, {}).get("code", None)
             code = ip_code if ip_code is not None else TASK_RETURN_CODE_UNKNOWN
             result[code] += 1
-
         return result
@@ -0,0 +1,96 @@
+import asyncio
+import collections
+import logging
+
+from op_center.basic import cfg
+from op_center.mq.result_codec import result_codec
+
+logger = logging.getLogger(__name__)
+
+
+class TaskResultView:
+    """
+    results of one task folded from its result stream(worker.mq.write_host_delta / write_host_result),
+    an entry is a delta of one host result or the whole of it, `last_id` is where the next read starts,
+    host counts by status / by code(finished hosts) are kept up to date entry by entry
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.last_id = "0"
+        self.results = {}
+        self.status_count = collections.Counter()
+        self.code_count = collections.Counter()
+        self._lock = None
+
+    def _count(self, result, n):
+        self.status_count[result.get("status")] += n
+        if result.get("f_time"):
+            self.code_count[result.get("code")] += n
+
+    def apply(self, ip, result):
+        old = self.results.get(ip, None)
+        if old is not None:
+            self._count(old, -1)
+        self.results[ip] = result
+        self._count(result, 1)
+
+    def aggregates(self):
+        return {
+            "hosts": len(self.results),
+            "status": dict(+self.status_count),
+            "code": dict(+self.code_count),
+        }
+
+    async def sync(self, mq, batch_size=1000):
+        """
+        read the entries added since the last sync
+        :param mq: server.mq.Server2WorkerMasterAsyncMQ
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # one reader at a time, an older batch applied late would overwrite newer results
+        async with self._lock:
+            while True:
+                entries = await mq.read_task_result(self.task_id, after=self.last_id, count=batch_size)
+                for entry_id, fields in entries:
+                    if "delta" in fields:
+                        self.apply(fields["ip"], result_codec.fold(self.results.get(fields["ip"]), fields["delta"]))
+                    else:
+                        self.apply(fields["ip"], fields["result"])
+                    self.last_id = entry_id
+                if len(entries) < batch_size:
+                    return self
+
+
+class TaskResultReader:
+    """TaskResultView of the recently read tasks, a request only pays for the entries added since the last one"""
+
+    @property
+    def mq(self):
+        if self._mq is None:
+            # server.mq connects at import, only pay for it once results are read
+            from op_center.server.mq import main_mq
+            self._mq = main_mq
+        return self._mq
+
+    def __init__(self, mq=None, *, lru_size=1024, batch_size=1000):
+        self._mq = mq
+        self.lru_size = lru_size
+        self.batch_size = batch_size
+        self._views = collections.OrderedDict()
+
+    async def get(self, task_id) -> TaskResultView:
+        view = self._views.get(task_id, None)
+        if view is None:
+            view = self._views[task_id] = TaskResultView(task_id)
+            while len(self._views) > self.lru_size:
+                self._views.popitem(last=False)
+        self._views.move_to_end(task_id)
+        return await view.sync(self.mq, batch_size=self.batch_size)
+
+    def forget(self, task_id):
+        self._views.pop(task_id, None)
+
+
+task_result_reader = TaskResultReader(**cfg.get("task_result_reader", {}))
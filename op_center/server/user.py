@@ -40,7 +40,6 @@ class User(orm.OrmObject):
 
     @classmethod
     async def login_by_password(cls, username: str, password: str, orm_session=None):
-        orm_session = orm_session or orm.DBSession()
         orm_instance = cls.__ORM__(session=orm_session)
         meta = await orm_instance.only_or_none(t.u.name == username)
         if not meta:
@@ -54,7 +53,6 @@ class User(orm.OrmObject):
 
     @classmethod
     async def login_by_token(cls, token: str, orm_session=None):
-        orm_session = orm_session or orm.DBSession()
         orm_instance = cls.__ORM__(session=orm_session)
         meta = await orm_instance.only_or_none(t.u.token == token)
         if not meta:
@@ -68,7 +66,6 @@ class User(orm.OrmObject):
         logger.debug(session)
         name = session.get("name", None)
         if name:
-            orm_session = orm_session or orm.DBSession()
             orm_instance = cls.__ORM__(session=orm_session)
             meta = await orm_instance.only_or_none(t.u.name == name)
             if meta:
@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import socket
+import time
 
 import sqlalchemy.exc
 
@@ -15,35 +17,62 @@ class WorkerMaster:
     """
     后台管理者。 负责把queue里的task搞出来丢给后端worker
     对应task status变化 queue -> router
+
+    tasks are popped into the processing list of this master(`name`) and leased for `lease_timeout` seconds
+    until they are running, renewed while their hosts are routed,
+    leases of crashed masters expire and are reclaimed every `reclaim_interval` seconds,
+    what this master left in its own processing list is reclaimed on startup
+
+    tasks are archived by one coordinator(task_event_loop) reading the done events the workers add
+    when the finish counter of a task reaches its total
     """
 
     @property
     def mq(self):
         return self._mq
 
-    def __init__(self):
+    def __init__(self, *, name=None, pop_timeout=1, lease_timeout=60, reclaim_interval=10, admission_retry_delay=0.1):
         self._mq = main_mq
-        self._check_delay = 1
+        self.name = name or socket.gethostname()
+        self.pop_timeout = pop_timeout
+        self.lease_timeout = lease_timeout
+        self.reclaim_interval = reclaim_interval
+        self.admission_retry_delay = admission_retry_delay
+        self.reclaimed_at = None
         self.loop = asyncio.get_event_loop()
         self.working_on = False
         self.worker = None
+        self.event_worker = None
         self.operator_manager = operator_manager
 
     async def link_start(self):
         await self.mq.init_mq_conn()
         logger.debug("worker master mq link start ok")
 
+    async def reclaim_tasks(self, startup=False):
+        try:
+            if startup:
+                reclaimed = await self.mq.reclaim_processing_tasks(self.name)
+                if reclaimed:
+                    logger.warning(f"reclaim tasks {reclaimed} left by the last run of {self.name}")
+            reclaimed = await self.mq.reclaim_expired_tasks()
+            if reclaimed:
+                logger.warning(f"reclaim tasks {reclaimed} of expired leases")
+        except Exception as e:
+            logger.error(f"reclaim tasks failure: {e}")
+        self.reclaimed_at = time.monotonic()
+
     async def task_generator(self):
         logger.debug(f"task_generator start...")
         while self.working_on:
-            task = await self.mq.pop_task_or_none()
+            if time.monotonic() - self.reclaimed_at > self.reclaim_interval:
+                await self.reclaim_tasks()
+            # blocks until a task is pushed, at most pop_timeout seconds
+            task = await self.mq.pop_task(self.name, timeout=self.pop_timeout, lease_timeout=self.lease_timeout,
+                                          reject_delay=self.admission_retry_delay)
             if task:
                 logger.debug(f"get task {task['id']} ...")
                 yield task
-                continue
-            else:
-                logger.debug(f"get task {task}...")
-                await asyncio.sleep(self._check_delay)
         logger.debug(f"task_generator exit...")
 
     async def _work_loop(self):
@@ -52,51 +81,116 @@ class WorkerMaster:
         async for task in generator:
             logger.debug(f"create future for task {task['id']}...")
             asyncio.ensure_future(self.do_task(task))
-            asyncio.ensure_future(self.hold_task(task["id"]))
         logger.debug("task work loop closed...")
 
     async def work_start(self):
         logger.debug("worker master start")
         self.working_on = True
         await self.link_start()
+        await self.reclaim_tasks(startup=True)
+        await self.mq.create_task_events_group()
+        await self.finish_missed_tasks()
         self.worker = asyncio.ensure_future(self._work_loop(), loop=self.loop)
+        self.event_worker = asyncio.ensure_future(self.task_event_loop(), loop=self.loop)
+
+    async def renew_lease(self, task_id):
+        while True:
+            await asyncio.sleep(self.lease_timeout / 3)
+            try:
+                if not await self.mq.renew_lease(self.name, task_id, self.lease_timeout):
+                    logger.critical(f"task {task_id} lease lost while its hosts are routed, it may run twice")
+                    return
+            except Exception as e:
+                logger.error(f"renew lease of task {task_id} failure: {e}")
 
     async def do_task(self, task):
         logger.debug(f"do task {task}")
-        await self.operator_manager.run_task(task)
+        # routing a large host list can outlast the lease, reclaimed it would be started again
+        renewing = asyncio.ensure_future(self.renew_lease(task["id"]))
+        try:
+            await self.operator_manager.run_task(task)
+        finally:
+            renewing.cancel()
+        # hosts are routed, the task can't be lost any more
+        if not await self.mq.ack_task(self.name, task["id"]):
+            logger.warning(f"task {task['id']} lease expired before it was running, it may run twice")
+        if not task["hosts"]:
+            # no host ever finishes, no done event
+            await self.finish_task(task["id"])
 
     async def close(self):
         if self.working_on:
             self.working_on = False
             await self.worker
+            await self.event_worker
         logger.debug(f"worker master closed")
 
-    async def hold_task(self, task_id):
-        while True:
-            await asyncio.sleep(1)
-            status = await self.mq.get_task_status(task_id) or {}
-            logger.debug(f"hold task {task_id} status is {status}")
-            total = status.get("total", None)
-            finish = status.get(TASK_STATUS_FINISH, None)
-            if total is not None and finish is not None and total == finish:
-                logger.info(f"hold task {task_id} {finish}/{total} task done...")
-                await self.mq.change_task_status(task_id, dict(task_status=TASK_STATUS_FINISH))
-                await self.task_done(task_id)
-                logger.info(f"task {task_id} done and exit this task holder")
-                break
+    async def task_event_loop(self):
+        """
+        the coordinator: finish the tasks of done events,
+        first the events this master read but didn't ack before it stopped, then new ones
+        """
+        logger.debug(f"task event loop start...")
+        pending_after = "0"
+        while self.working_on:
+            try:
+                events = await self.mq.read_task_events(self.name, pending_after=pending_after,
+                                                        timeout=self.pop_timeout)
+            except Exception as e:
+                logger.error(f"read task events failure: {e}")
+                await asyncio.sleep(self.pop_timeout)
+                continue
+            if pending_after is not None:
+                # page through the pending list, failed ones stay pending until the next start
+                pending_after = events[-1][0] if events else None
+                await asyncio.gather(*[self.finish_task(event["task_id"], event_id) for event_id, event in events])
+                continue
+            for event_id, event in events:
+                logger.debug(f"task event {event_id}: {event}")
+                asyncio.ensure_future(self.finish_task(event["task_id"], event_id))
+        logger.debug(f"task event loop exit...")
+
+    async def finish_missed_tasks(self):
+        """running tasks already done, their events were trimmed from the stream or added before the group existed"""
+        for task_id in await self.mq.get_running_task_ids():
+            status = await self.mq.get_task_status(task_id)
+            if "total" in status and int(status.get(TASK_STATUS_FINISH, -1)) == int(status["total"]):
+                logger.warning(f"task {task_id} done without event")
+                await self.finish_task(task_id)
+
+    async def finish_task(self, task_id, event_id=None):
+        try:
+            logger.info(f"task {task_id} done...")
+            # every host finished, they no longer count against the running limits,
+            # released first so a failing archive doesn't hold the slot(a second release is a no-op)
+            await self.mq.release_task(task_id)
+            await self.mq.change_task_status(task_id, dict(task_status=TASK_STATUS_FINISH))
+            await self.task_done(task_id)
+        except Exception as e:
+            # not acked, read again as pending on the next start
+            logger.critical(f"finish task {task_id} failure: {e}")
+            return
+        if event_id is not None:
+            await self.mq.ack_task_events(event_id)
 
     async def task_done(self, task_id):
         logger.debug(f"now do archive task {task_id}")
         for i in range(3):
             try:
-                task_orm = orm.Task()
-                await task_orm.query_update(orm.t.tsk.id == task_id,
-                                            status=await self.mq.get_task_status(task_id),
-                                            result=await self.mq.get_task_result(task_id),
-                                            f_time=Now().instance())
+                async with orm.UnitOfWork() as session:
+                    orm_task = orm.Task(session=session)
+                    task = await orm_task.only_or_raise(orm.t.tsk.id == task_id, columns=[orm.t.tsk.hosts])
+                    await orm_task.archive(task_id,
+                                           hosts=task["hosts"] or [],
+                                           status=await self.mq.get_task_status(task_id),
+                                           results=await self.mq.get_task_result(task_id),
+                                           f_time=Now().instance())
+                break
             except sqlalchemy.exc.OperationalError:
                 logger.critical(f"task {task_id} archive failure {i}")
-                continue
+                if i == 2:
+                    # results are kept in the mq, finish_task leaves the event pending to replay it
+                    raise
 
         await self.mq.remove_task(task_id)
         logger.debug(f"task {task_id} archive ok...")
@@ -71,6 +71,7 @@ CREATE TABLE `group_permission` (
 
 CREATE TABLE `host` (
   `ip`     VARCHAR(20) NOT NULL PRIMARY KEY,
+  `ip_int` INT UNSIGNED NULL,
   `basic`  JSON        NOT NULL,
   `issystem` JSON        NOT NULL,
   `envs`   JSON        NOT NULL,
@@ -78,7 +79,22 @@ CREATE TABLE `host` (
   `c_time` DATETIME    NOT NULL             DEFAULT CURRENT_TIMESTAMP,
   `m_time` DATETIME    NOT NULL             DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
 
-  INDEX (`ok`, `c_time`, `m_time`)
+  `idc`          VARCHAR(50)  AS (`basic` ->> '$.idc') STORED,
+  `machine_type` VARCHAR(50)  AS (`basic` ->> '$.machine_type') STORED,
+  `env_type`     VARCHAR(50)  AS (`basic` ->> '$.env_type') STORED,
+  `zone`         VARCHAR(50)  AS (`issystem` ->> '$.zone') STORED,
+  `department`   VARCHAR(100) AS (`issystem` ->> '$.department') STORED,
+
+  INDEX (`ok`, `c_time`, `m_time`),
+  INDEX `ix_host_ip_int` (`ip_int`),
+  INDEX `ix_host_idc` (`idc`),
+  INDEX `ix_host_machine_type` (`machine_type`),
+  INDEX `ix_host_env_type` (`env_type`),
+  INDEX `ix_host_zone` (`zone`),
+  INDEX `ix_host_department` (`department`),
+  -- multi-valued indexes, mysql >= 8.0.17
+  INDEX `ix_host_app4` ((CAST(`issystem` -> '$.app4' AS CHAR(64) ARRAY))),
+  INDEX `ix_host_app_name` ((CAST(`issystem` -> '$.app_name' AS CHAR(64) ARRAY)))
 
 );
 
@@ -110,6 +126,7 @@ CREATE TABLE `host_filter` (
   `description` TEXT        NULL,
   `group_id`    INT         NULL,
   `filters`     JSON        NOT NULL,
+  `materialized_at` DATETIME NULL,
   `c_time`      DATETIME    NOT NULL             DEFAULT CURRENT_TIMESTAMP,
   `m_time`      DATETIME    NOT NULL             DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
 
@@ -122,6 +139,19 @@ CREATE TABLE `host_filter` (
   INDEX (`id`, `name`, `group_id`, `c_time`, `m_time`)
 );
 
+CREATE TABLE `host_filter_membership` (
+  `filter_id` INT         NOT NULL,
+  `ip`        VARCHAR(20) NOT NULL,
+
+  PRIMARY KEY (`filter_id`, `ip`),
+
+  FOREIGN KEY (`filter_id`) REFERENCES `host_filter` (`id`)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+
+  INDEX `ix_host_filter_membership_ip` (`ip`)
+);
+
 CREATE TABLE `operator` (
   `id`          INT         NOT NULL             AUTO_INCREMENT PRIMARY KEY,
   `name`        VARCHAR(50) NOT NULL UNIQUE,
@@ -196,4 +226,23 @@ CREATE TABLE `task` (
 
   INDEX (`id`, `group_id`, `c_time`, `m_time`, `f_time`, `runner`)
 
-);
\ No newline at end of file
+);
+CREATE TABLE `task_host_result` (
+  `task_id` VARCHAR(50)  NOT NULL,
+  `ip`      VARCHAR(20)  NOT NULL,
+  `status`  VARCHAR(20)  NOT NULL,
+  `code`    INT          NULL,
+  `worker`  VARCHAR(100) NULL,
+  `c_time`  DOUBLE       NULL,
+  `f_time`  DOUBLE       NULL,
+  `output`  JSON         NOT NULL,
+
+  PRIMARY KEY (`task_id`, `ip`),
+
+  FOREIGN KEY (`task_id`) REFERENCES `task` (`id`)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+
+  INDEX `ix_task_host_result_task_id_status` (`task_id`, `status`),
+  INDEX `ix_task_host_result_task_id_code` (`task_id`, `code`)
+);
@@ -0,0 +1,19 @@
+-- upgrade an existing database: materialised host filter results
+-- filters are materialised on their next save / use or by the next host refresh
+USE `op-center`;
+
+ALTER TABLE `host_filter`
+  ADD COLUMN `materialized_at` DATETIME NULL AFTER `filters`;
+
+CREATE TABLE IF NOT EXISTS `host_filter_membership` (
+  `filter_id` INT         NOT NULL,
+  `ip`        VARCHAR(20) NOT NULL,
+
+  PRIMARY KEY (`filter_id`, `ip`),
+
+  FOREIGN KEY (`filter_id`) REFERENCES `host_filter` (`id`)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+
+  INDEX `ix_host_filter_membership_ip` (`ip`)
+);
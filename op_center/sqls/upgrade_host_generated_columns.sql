@@ -0,0 +1,19 @@
+-- upgrade an existing database: indexed generated columns for the host json attributes host filters query
+-- multi-valued indexes need mysql >= 8.0.17
+USE `op-center`;
+
+ALTER TABLE `host`
+  ADD COLUMN `idc`          VARCHAR(50)  AS (`basic` ->> '$.idc') STORED,
+  ADD COLUMN `machine_type` VARCHAR(50)  AS (`basic` ->> '$.machine_type') STORED,
+  ADD COLUMN `env_type`     VARCHAR(50)  AS (`basic` ->> '$.env_type') STORED,
+  ADD COLUMN `zone`         VARCHAR(50)  AS (`issystem` ->> '$.zone') STORED,
+  ADD COLUMN `department`   VARCHAR(100) AS (`issystem` ->> '$.department') STORED;
+
+ALTER TABLE `host`
+  ADD INDEX `ix_host_idc` (`idc`),
+  ADD INDEX `ix_host_machine_type` (`machine_type`),
+  ADD INDEX `ix_host_env_type` (`env_type`),
+  ADD INDEX `ix_host_zone` (`zone`),
+  ADD INDEX `ix_host_department` (`department`),
+  ADD INDEX `ix_host_app4` ((CAST(`issystem` -> '$.app4' AS CHAR(64) ARRAY))),
+  ADD INDEX `ix_host_app_name` ((CAST(`issystem` -> '$.app_name' AS CHAR(64) ARRAY)));
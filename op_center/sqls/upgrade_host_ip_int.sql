@@ -0,0 +1,9 @@
+-- upgrade an existing database: integer ip column for cidr / range host filters
+USE `op-center`;
+
+ALTER TABLE `host`
+  ADD COLUMN `ip_int` INT UNSIGNED NULL AFTER `ip`,
+  ADD INDEX `ix_host_ip_int` (`ip_int`);
+
+-- new rows get it from the application on insert
+UPDATE `host` SET `ip_int` = INET_ATON(`ip`) WHERE `ip_int` IS NULL;
@@ -0,0 +1,22 @@
+-- upgrade an existing database: per host task results move out of task.result
+USE `op-center`;
+
+CREATE TABLE IF NOT EXISTS `task_host_result` (
+  `task_id` VARCHAR(50)  NOT NULL,
+  `ip`      VARCHAR(20)  NOT NULL,
+  `status`  VARCHAR(20)  NOT NULL,
+  `code`    INT          NULL,
+  `worker`  VARCHAR(100) NULL,
+  `c_time`  DOUBLE       NULL,
+  `f_time`  DOUBLE       NULL,
+  `output`  JSON         NOT NULL,
+
+  PRIMARY KEY (`task_id`, `ip`),
+
+  FOREIGN KEY (`task_id`) REFERENCES `task` (`id`)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+
+  INDEX `ix_task_host_result_task_id_status` (`task_id`, `status`),
+  INDEX `ix_task_host_result_task_id_code` (`task_id`, `code`)
+);
@@ -1,6 +1,7 @@
-import re
-
+from op_center.basic import TASK_STATUS_ROUTER, TASK_STATUS_RUNNING, TASK_STATUS_FINISH
 from op_center.mq.redis_sync_mq import ABCSyncRedisOneLinkMQ
+from op_center.mq.result_codec import result_codec
+from op_center.mq.scripts import MOVE_HOST, FINISH_HOST
 
 
 class WorkerMQ(ABCSyncRedisOneLinkMQ):
@@ -10,43 +11,38 @@ class WorkerMQ(ABCSyncRedisOneLinkMQ):
 
     RUNNING_TASKS_KEY = "running_tasks"
 
-    TASK_RESULT_PREFIX = "task_result_"
+    # per task stream of host results, entry: {ip, delta(result_codec)} or a whole result {ip, result(result_codec)}
+    TASK_RESULT_STREAM_PREFIX = "task_result_stream_"
+
+    TASK_EVENTS_KEY = "task_events"
+    TASK_EVENTS_MAX_LEN = 10000
 
-    MAX_RUNNING_TASKS_KEY = "max_running_tasks"
-    MAX_QUEUE_TASKS_KEY = "max_queue_tasks"
+    def write_host_delta(self, task_id, host_ip, delta: dict):
+        """what changed in the host result(result_codec.diff), readers fold the stream(server.task_result)"""
+        self.conn.xadd(self.TASK_RESULT_STREAM_PREFIX + task_id,
+                       {"ip": host_ip, "delta": result_codec.encode(delta, whole=False)})
 
-    TASK_STATUS_KEY_SPLIT = re.compile(r"^(?P<field>.+)__(?P<action>[^_].+)$")
+    def write_host_result(self, task_id, host_ip, result: dict):
+        """the whole latest result of the host, replaces what the readers have"""
+        self.conn.xadd(self.TASK_RESULT_STREAM_PREFIX + task_id,
+                       {"ip": host_ip, "result": result_codec.encode(result)})
 
-    def write_host_result(self, task_id, host_ip, result):
-        key = self.TASK_RESULT_PREFIX + task_id
-        self.conn.hset(key, host_ip, result)
+    # host lifecycle, one atomic script per transition
+    def host_running(self, task_id):
+        """router -> running"""
+        self.run_script(MOVE_HOST, keys=[self.TASK_STATUS_PREFIX + task_id],
+                        args=[TASK_STATUS_ROUTER, TASK_STATUS_RUNNING])
 
-    def change_task_status(self, task_id, status_map: dict):
+    def host_finish(self, task_id, status):
         """
-        task_status_task_id = {
-        "total": int,
-        "finish": int,
-        "task_status": ...,
-        KEYWORDS.TASK_STATUS_WAIT: int,
-        KEYWORDS.TASK_STATUS_QUEUE: int,
-        ...: ...
+        running -> finish, counted in `status`(success / failure),
+        the last host of the task adds its done event to TASK_EVENTS_KEY
+        :return: (finish, total) of the task after this host
         """
-        key = self.TASK_STATUS_PREFIX + task_id
-        for k, v in status_map.items():
-            tmp = self.TASK_STATUS_KEY_SPLIT.match(k)
-            if tmp:
-                field = tmp.groupdict().get("field")
-                action = tmp.groupdict().get("action")
-            else:
-                field = k
-                action = None
-            if not action:
-                self.conn.hset(key, field, v)
-            else:
-                if action == "inc":
-                    self.conn.hincrby(key, field, v)
-                else:
-                    raise RuntimeError(f"action {action} error")
+        finish, total = self.run_script(FINISH_HOST, keys=[self.TASK_STATUS_PREFIX + task_id, self.TASK_EVENTS_KEY],
+                                        args=[TASK_STATUS_RUNNING, TASK_STATUS_FINISH, status, "total",
+                                              task_id, self.TASK_EVENTS_MAX_LEN])
+        return int(finish), int(total) if total is not None else None
 
     def init_mq_conn(self):
         pass
@@ -1,9 +1,8 @@
 import abc
-import json
 
-from op_center.basic import cfg, TASK_STATUS_SUCCESS, Now, TASK_STATUS_FAILURE, TASK_STATUS_ROUTER, \
-    TASK_STATUS_RUNNING, \
-    TASK_STATUS_FINISH, TASK_RETURN_CODE_SYSTEM_ERROR, TASK_RETURN_CODE_UNKNOWN_ERROR
+from op_center.basic import cfg, TASK_STATUS_SUCCESS, Now, TASK_STATUS_FAILURE, TASK_STATUS_RUNNING, \
+    TASK_RETURN_CODE_SYSTEM_ERROR, TASK_RETURN_CODE_UNKNOWN_ERROR
+from op_center.mq.result_codec import result_codec
 from op_center.worker.mq import WorkerMQ
 from op_center.workflow import WorkflowManager
 
@@ -28,16 +27,28 @@ class ABCWorker(metaclass=abc.ABCMeta):
             "stdout": None,
             "stderr": None,
         }
+        # stdout + stderr chars of the history, capped by result_codec.max_output
+        self._output_size = 0
+        # top level fields / history steps of _result already in the result stream
+        self._written = {}
+        self._written_steps = 0
         self.wf_works = None
         self.wf_envs = None
         self.wf_control = None
 
     def update_result(self, **kwargs):
         self._result.update(kwargs)
-        self.worker_mq.write_host_result(self.task_id, self.host["ip"],
-                                         json.dumps(self._result))
+        # only what changed goes to the stream, a step is never written twice
+        delta = result_codec.diff(self._written, self._written_steps, self._result)
+        if not delta:
+            return
+        self.worker_mq.write_host_delta(self.task_id, self.host["ip"], delta)
+        self._written = {k: v for k, v in self._result.items() if k != "history"}
+        self._written_steps = len(self._result["history"])
 
     def update_history(self, r, *rs):
+        for step in [r, *rs]:
+            self._output_size = result_codec.cap_output(step, self._output_size)
         self._result["history"].extend([r, *rs])
         self.update_result()
 
@@ -65,10 +76,6 @@ class ABCWorker(metaclass=abc.ABCMeta):
                 if result["code"] != 0:
                     success = False
                     break
-        if not success:
-            self.set_status_failure()
-        else:
-            self.set_status_success()
         self.work_done()
 
     def change_workflow_to_works(self):
@@ -88,24 +95,8 @@ class ABCWorker(metaclass=abc.ABCMeta):
         self.wf_works = result["works"]
         self.wf_control = {}
 
-    def set_status_success(self):
-        self.worker_mq.change_task_status(self.task_id,
-                                          {
-                                              TASK_STATUS_SUCCESS + "__inc": 1,
-                                          })
-
-    def set_status_failure(self):
-        self.worker_mq.change_task_status(self.task_id,
-                                          {
-                                              TASK_STATUS_FAILURE + "__inc": 1,
-                                          })
-
     def work_init(self) -> bool:
-        self.worker_mq.change_task_status(self.task_id,
-                                          {
-                                              TASK_STATUS_ROUTER + "__inc": -1,
-                                              TASK_STATUS_RUNNING + "__inc": 1,
-                                          })
+        self.worker_mq.host_running(self.task_id)
         self.update_result(c_time=Now().timestamp(), status=TASK_STATUS_RUNNING)
         self.change_workflow_to_works()
         return True
@@ -126,6 +117,7 @@ class ABCWorker(metaclass=abc.ABCMeta):
         """
         if not result:
             if self._result["history"]:
+                # stored once, result_codec leaves the joined outputs out of the stream entry
                 result = {
                     "code": self._result["history"][-1]["code"],
                     "stdout": "".join([h.get("stdout", "") for h in self._result['history']]),
@@ -138,11 +130,8 @@ class ABCWorker(metaclass=abc.ABCMeta):
         else:
             status = TASK_STATUS_FAILURE
         self.update_result(f_time=Now().timestamp(), status=status, **result)
-        self.worker_mq.change_task_status(self.task_id,
-                                          {
-                                              TASK_STATUS_FINISH + "__inc": 1,
-                                              TASK_STATUS_RUNNING + "__inc": -1,
-                                          })
+        # success / failure and finish counters move together
+        self.worker_mq.host_finish(self.task_id, status)
         self.worker_mq.close()
 
     def work_raise(self, e: Exception):
@@ -48,7 +48,7 @@ setup(
         # "PyYAML",
         # "bson", install and raise an error pymongo has it own bson pkg
         "aiomysql",
-        "sqlalchemy",
+        "sqlalchemy>=1.4",
         "pymysql",
         "ldap3",
         "aiohttp",
@@ -57,14 +57,16 @@ setup(
         "aioredis",
         'paramiko',
         "redis",
+        "msgpack",
         "aiohttp_session[aioredis]",
     ],
 
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
-        'test': ['coverage',],
+        'test': ['coverage', 'aiosqlite', 'fakeredis[lua]'],
         "worker": ["eventlet",],
+        "zstd": ["zstandard"],
         "server": [],
     },
 
@@ -74,6 +74,18 @@ class TestController(unittest.TestCase):
         await self.controller.delete_workflow(wf["id"])
         await self.controller.delete_workflow(wf_fork["id"])
 
+    @async_run
+    async def test_identity_map(self):
+        wf = await self.controller.create_workflow(name="test",
+                                                   description="test desc",
+                                                   steps=[], basic={}, envs={}, args={})
+        before = self.controller.orm_workflow.statement_count
+        self.assertEqual((await self.controller.orm_workflow.get_or_raise(wf["id"]))["name"], "test")
+        self.assertEqual(self.controller.orm_workflow.statement_count, before)
+        await self.controller.update_workflow(id=wf['id'], name="test2")
+        self.assertEqual((await self.controller.orm_workflow.get_or_raise(wf["id"]))["name"], "test2")
+        await self.controller.delete_workflow(wf["id"])
+
     @async_run
     async def test_operator(self):
         meta = await self.controller.create_operator(name="test",
@@ -1,6 +1,8 @@
 import logging
 import unittest
 
+from sqlalchemy.dialects import mysql
+
 from op_center.server import host_filter
 from op_center.server.host_filter import HostFilterException
 from test import async_run
@@ -86,5 +88,93 @@ class TestHostFilter(unittest.TestCase):
             await self.target_error2.get_hosts()
 
 
+    def test_generated_columns(self):
+        condition = host_filter.HostFilter({"id": None, "filters": [
+            {"idc": {"in": ["idc1"]}},
+            {"app4": {"in": ["a.b", "c.d"]}},
+        ]}).get_query_condition()
+        sql = str(condition.compile(dialect=mysql.dialect()))
+        self.assertIn("host.idc IN", sql)
+        self.assertIn("host.machine_type IN", sql)
+        self.assertIn("json_overlaps(json_extract(host.issystem, %s), json_array(%s, %s))", sql)
+        self.assertNotIn("JSON_EXTRACT(host.basic", sql)
+
+
+    def test_default_conditions(self):
+        def expression(filters):
+            return host_filter.HostFilter({"id": None, "filters": filters}).expression.to_dict()
+
+        self.assertDictEqual(expression([{"type": {"in": ["docker"]}}]),
+                             {"and": [{"ok": {"is": True}}, {"type": {"in": ["docker"]}}]})
+        # conditions under or / not count too
+        self.assertDictEqual(expression({"or": [{"type": {"in": ["docker"]}}, {"idc": {"is": "a"}}]}),
+                             {"and": [{"ok": {"is": True}}, {"or": [{"idc": {"is": "a"}},
+                                                                    {"type": {"in": ["docker"]}}]}]})
+        self.assertDictEqual(expression({"not": {"ok": {"is": True}}}),
+                             {"and": [{"ok": {"is_not": True}}, {"type": {"in": ["phy", "vm", "vmhost"]}}]})
+        # even when folded away
+        self.assertIs(expression([{"type": {"in": []}}]), False)
+        self.assertDictEqual(expression([{"idc": {"is": "a"}}]),
+                             {"and": [{"idc": {"is": "a"}}, {"ok": {"is": True}},
+                                      {"type": {"in": ["phy", "vm", "vmhost"]}}]})
+
+
+class TestHostFilterExpr(unittest.TestCase):
+
+    def test_normalise(self):
+        legacy = host_filter.parse_filters([{"idc": {"in": ["idc2", "idc1", "idc1"]}}, {"ip": {"regexp": "^10"}}])
+        self.assertEqual(legacy, host_filter.parse_filters({"and": [{"ip": {"regexp": "^10"}},
+                                                                    {"idc": {"in": {"idc1", "idc2"}}}]}))
+        self.assertEqual(legacy.digest(), host_filter.parse_filters(legacy.to_dict()).digest())
+        self.assertNotEqual(legacy, host_filter.parse_filters([{"idc": {"in": ["idc1"]}}, {"ip": {"regexp": "^10"}}]))
+
+        # IN lists merge: union under OR, intersection under AND(scalar items only)
+        self.assertDictEqual(host_filter.parse_filters({"or": [{"idc": {"in": ["a", "b"]}},
+                                                               {"idc": {"in": ["c", "b"]}}]}).to_dict(),
+                             {"idc": {"in": ["a", "b", "c"]}})
+        self.assertDictEqual(host_filter.parse_filters([{"idc": {"in": ["a", "b"]}}, {"idc": {"in": ["c", "b"]}}])
+                             .to_dict(), {"idc": {"in": ["b"]}})
+        self.assertEqual(len(host_filter.parse_filters([{"app4": {"in": ["a", "b"]}},
+                                                        {"app4": {"in": ["c"]}}]).to_dict()["and"]), 2)
+
+        # constant folding
+        self.assertIs(host_filter.parse_filters([{"idc": {"in": ["a"]}}, {"idc": {"in": ["b"]}}]).to_dict(), False)
+        self.assertIs(host_filter.parse_filters({"or": [True, {"idc": {"is": "a"}}]}).to_dict(), True)
+        self.assertIs(host_filter.parse_filters({"and": []}).to_dict(), True)
+
+        # NOT goes down to the items
+        self.assertDictEqual(host_filter.parse_filters({"not": {"or": [{"idc": {"is": "a"}},
+                                                                       {"env": {"in": ["test"]}}]}}).to_dict(),
+                             {"and": [{"env": {"not_in": ["test"]}}, {"idc": {"is_not": "a"}}]})
+        self.assertDictEqual(host_filter.parse_filters({"not": {"not": {"ip": {"regexp": "^10"}}}}).to_dict(),
+                             {"ip": {"regexp": "^10"}})
+
+        with self.assertRaises(HostFilterException):
+            host_filter.parse_filters([{"idc": ["a"]}])
+        with self.assertRaises(HostFilterException):
+            host_filter.parse_filters({"or": {"idc": {"is": "a"}}})
+
+    def test_default_conditions(self):
+        expression = host_filter.HostFilter({"id": None, "filters": [{"ok": {"is": False}}]}).expression
+        self.assertDictEqual(expression.to_dict(), {"and": [{"ok": {"is": False}},
+                                                            {"type": {"in": ["phy", "vm", "vmhost"]}}]})
+        sql = str(host_filter.HostFilter({"id": None, "filters": {"or": [{"idc": {"is": "a"}}, {"zone": {"is": "z"}}]}})
+                  .get_query_condition().compile(dialect=mysql.dialect()))
+        self.assertIn("host.idc = %s OR host.zone = %s", sql)
+
+    def test_ip_int(self):
+        condition = host_filter.HostFilter({"id": None, "filters": [
+            {"ip": {"cidr": ["10.0.1.0/24"], "range": ["10.0.0.1", "10.0.0.9"]}},
+        ]}).get_query_condition()
+        sql = condition.compile(dialect=mysql.dialect())
+        self.assertIn("host.ip_int BETWEEN %s AND %s", str(sql))
+        self.assertIn(167772416, sql.params.values())
+        self.assertIn(167772671, sql.params.values())
+        for args in [{"cidr": "10.0.1.0/24"}, {"cidr": ["10.0.1.0/33"]}, {"range": ["10.0.0.1"]}]:
+            with self.assertRaises(HostFilterException):
+                host_filter.parse_filters({"ip": args})
+        self.assertIs(host_filter.parse_filters({"ip": {"cidr": []}}).to_dict(), False)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,59 @@
+import logging
+import unittest
+
+from op_center.server.host_filter import parse_filters
+from op_center.server.host_filter_cache import HostFilterCache, filter_cache_key
+from test import async_run
+
+logger = logging.getLogger(__name__)
+
+
+class TestFilterCacheKey(unittest.TestCase):
+
+    def test_x(self):
+        expression = parse_filters([{"idc": {"in": ["idc2", "idc1", "idc1"]}}, {"ip": {"regexp": "^10"}}])
+        key = filter_cache_key(expression, ["ip", "envs"])
+        self.assertEqual(key, filter_cache_key(parse_filters({"and": [{"ip": {"regexp": "^10"}},
+                                                                      {"idc": {"in": {"idc1", "idc2"}}}]}),
+                                               ["envs", "ip"]))
+        self.assertNotEqual(key, filter_cache_key(parse_filters([{"idc": {"in": ["idc1"]}}, {"ip": {"regexp": "^10"}}]),
+                                                  ["ip", "envs"]))
+        self.assertNotEqual(key, filter_cache_key(expression, ["ip"]))
+
+
+class TestHostFilterCache(unittest.TestCase):
+    """against the main redis like the mq tests"""
+
+    @async_run
+    async def setUp(self):
+        self.target = HostFilterCache(lru_size=2)
+        self.loads = 0
+
+    async def load(self, version):
+        self.loads += 1
+        return [{"ip": "10.0.0.1", "envs": {"ARGS_LOAD": self.loads}}]
+
+    @async_run
+    async def test_x(self):
+        await self.target.bump_version()
+        first = await self.target.get_or_load("k1", self.load)
+        self.assertListEqual(await self.target.get_or_load("k1", self.load), first)
+        self.assertEqual(self.target.stats()["hits"], 1)
+
+        # another process only has the redis copy
+        other = HostFilterCache()
+        self.assertListEqual(await other.get_or_load("k1", self.load), first)
+        self.assertEqual(other.stats()["redis_hits"], 1)
+        self.assertEqual(self.loads, 1)
+
+        # host refresh makes every entry stale
+        await other.bump_version()
+        self.assertNotEqual(await self.target.get_or_load("k1", self.load), first)
+        self.assertEqual(self.loads, 2)
+        await self.target.get_or_load("k1", self.load, refresh=True)
+        self.assertEqual(self.loads, 3)
+        self.assertEqual(self.target.stats()["misses"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+from op_center.server import orm, table, host_filter
+from op_center.server.host_filter_membership import HostFilterMembership
+from test import async_run
+
+logger = logging.getLogger(__name__)
+
+
+class TestHostFilterMembership(unittest.TestCase):
+    """membership deltas against a sqlite host table, compared with evaluating the filters again"""
+
+    @async_run
+    async def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.db_dir.name, "test.sqlite")
+        self.engine, self.session_maker = orm.create_session_maker(f"sqlite:///{self.db_file}")
+        table.meta.metadata.create_all(self.engine, tables=[table.Host.__table__, table.HostFilter.__table__,
+                                                            table.HostFilterMembership.__table__])
+        self.now = datetime.datetime(2020, 1, 1)
+        self.session = self.session_maker()
+        self.host = orm.Host(session=self.session)
+        await self.host.bulk_upsert([self.mk_host(i) for i in range(20)])
+        self.filters = {1: [{"idc": {"is": "idc0"}}],
+                        2: {"or": [{"env": {"is": "test"}}, {"ip": {"cidr": ["10.0.1.0/24"]}}]}}
+        await orm.HostFilter(session=self.session).bulk_upsert([
+            {"id": id, "name": f"hf{id}", "filters": filters, "c_time": self.now, "m_time": self.now}
+            for id, filters in self.filters.items()])
+        self.target = HostFilterMembership(orm_session=self.session)
+
+    def mk_host(self, i, idc=None):
+        return {"ip": f"10.0.{i // 10}.{i % 10}",
+                "basic": {"idc": idc or f"idc{i % 2}", "machine_type": "vm", "env_type": "prod" if i % 3 else "test"},
+                "issystem": {}, "envs": {}, "ok": True,
+                "c_time": self.now, "m_time": self.now}
+
+    async def expect(self, filter_id):
+        hf = host_filter.HostFilter({"id": filter_id, "filters": self.filters[filter_id]}, orm_session=self.session)
+        return {h["ip"] for h in await self.host.query(hf.get_query_condition(), columns=[orm.t.h.ip])}
+
+    async def members(self, filter_id):
+        return await orm.HostFilterMembership(session=self.session).members(filter_id)
+
+    @async_run
+    async def test_x(self):
+        # nothing materialised yet, the first host refresh recomputes every filter
+        deltas = await self.target.refresh_hosts([])
+        self.assertSetEqual(deltas[1][0], await self.expect(1))
+        for filter_id in self.filters:
+            self.assertSetEqual(await self.members(filter_id), await self.expect(filter_id))
+
+        # only the changed hosts are tested again
+        await self.host.bulk_upsert([self.mk_host(0, idc="idc9"), self.mk_host(1, idc="idc0"), self.mk_host(30)])
+        deltas = await self.target.refresh_hosts(["10.0.0.0", "10.0.0.1", "10.0.3.0"])
+        self.assertSetEqual(deltas[1][0], {"10.0.0.1", "10.0.3.0"})
+        self.assertSetEqual(deltas[1][1], {"10.0.0.0"})
+        self.assertSetEqual(deltas[2][0], {"10.0.3.0"})
+        for filter_id in self.filters:
+            self.assertSetEqual(await self.members(filter_id), await self.expect(filter_id))
+
+        # the materialised read is an indexed join
+        meta = await orm.HostFilter(session=self.session).get_or_raise(1)
+        self.assertIsNotNone(meta["materialized_at"])
+        hosts = await host_filter.HostFilter(meta, orm_session=self.session).get_materialized_hosts(
+            columns=[orm.t.h.ip, orm.t.h.envs])
+        self.assertSetEqual({h["ip"] for h in hosts}, await self.expect(1))
+
+        # a changed definition is recomputed as a delta
+        self.filters[1] = [{"idc": {"in": ["idc0", "idc9"]}}]
+        added, removed = await self.target.refresh_filter({"id": 1, "filters": self.filters[1]})
+        self.assertSetEqual(added, {"10.0.0.0"})
+        self.assertSetEqual(removed, set())
+
+        await self.target.remove_filter(1)
+        self.assertSetEqual(await self.members(1), set())
+
+    @async_run
+    async def tearDown(self):
+        self.engine.dispose()
+        self.db_dir.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
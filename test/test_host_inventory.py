@@ -0,0 +1,155 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+from op_center.server import orm, table, host_filter
+from op_center.server.host_inventory import HostInventory
+from test import async_run
+
+logger = logging.getLogger(__name__)
+
+
+class TestHostInventory(unittest.TestCase):
+    """bitmap evaluation against a sqlite host table, compared with what the sql filter means"""
+
+    @async_run
+    async def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.db_dir.name, "test.sqlite")
+        self.engine, self.session_maker = orm.create_session_maker(f"sqlite:///{self.db_file}")
+        table.meta.metadata.create_all(self.engine, tables=[table.Host.__table__])
+        self.now = datetime.datetime(2020, 1, 1)
+        self.host = orm.Host(session=self.session_maker())
+        await self.host.bulk_upsert([self.mk_host(i) for i in range(40)])
+        self.inventory = HostInventory(self.session_maker, refresh_interval=0)
+
+    def mk_host(self, i, m_time=None):
+        return {"ip": f"10.0.{i // 10}.{i % 10}",
+                "basic": {"idc": f"idc{i % 2}", "machine_type": "vm" if i % 5 else "docker",
+                          "env_type": "prod" if i % 3 else "test"},
+                "issystem": {"zone": "z1", "app4": [f"app.{i % 4}", "app.all"]},
+                "envs": {"ARGS_IP": f"10.0.{i // 10}.{i % 10}"},
+                "ok": i != 1,
+                "c_time": self.now, "m_time": m_time or self.now}
+
+    def mk_filter(self, *filters):
+        return host_filter.HostFilter({"id": None, "filters": list(filters)}, orm_session=self.session_maker())
+
+    async def ips(self, hf, columns=None, inventory=None):
+        hosts = await hf.get_hosts_from_inventory(columns=columns or [orm.t.h.ip, orm.t.h.envs],
+                                                  inventory=inventory or self.inventory)
+        return sorted(h["ip"] for h in hosts)
+
+    def expect(self, f):
+        return sorted(h["ip"] for h in map(self.mk_host, range(40))
+                      if h["ok"] and h["basic"]["machine_type"] != "docker" and f(h))
+
+    @async_run
+    async def test_x(self):
+        self.assertListEqual(await self.ips(self.mk_filter({"idc": {"in": ["idc0"]}})),
+                             self.expect(lambda h: h["basic"]["idc"] == "idc0"))
+        self.assertListEqual(await self.ips(self.mk_filter({"env": {"is_not": "test"}},
+                                                           {"app4": {"in": ["app.1", "app.2"]}})),
+                             self.expect(lambda h: h["basic"]["env_type"] != "test"
+                                         and {"app.1", "app.2"} & set(h["issystem"]["app4"])))
+        self.assertListEqual(await self.ips(self.mk_filter({"ip": {"regexp": r"^10\.0\.1\.", "not_in": ["10.0.1.2"]}})),
+                             self.expect(lambda h: h["ip"].startswith("10.0.1.") and h["ip"] != "10.0.1.2"))
+        # columns outside the snapshot are read by primary key
+        ips = await self.ips(self.mk_filter({"zone": {"is": "z1"}}), columns=[orm.t.h.ip, orm.t.h.basic])
+        self.assertListEqual(ips, self.expect(lambda h: True))
+        self.assertListEqual(await self.ips(self.mk_filter({"or": [{"idc": {"is": "idc0"}},
+                                                                   {"not": {"app4": {"in": ["app.0", "app.1"]}}}]})),
+                             self.expect(lambda h: h["basic"]["idc"] == "idc0"
+                                         or not {"app.0", "app.1"} & set(h["issystem"]["app4"])))
+        # bisection on the integer ip
+        cidr = self.mk_filter({"ip": {"cidr": ["10.0.1.0/30", "10.0.2.9/32"]}})
+        self.assertListEqual(await self.ips(cidr), self.expect(lambda h: h["ip"] in {
+            "10.0.1.0", "10.0.1.1", "10.0.1.2", "10.0.1.3", "10.0.2.9"}))
+        ip_range = self.mk_filter({"ip": {"range": ["10.0.0.8", "10.0.1.2"]}})
+        self.assertListEqual(await self.ips(ip_range), self.expect(lambda h: h["ip"] in {
+            "10.0.0.8", "10.0.0.9", "10.0.1.0", "10.0.1.1", "10.0.1.2"}))
+        # and the same on the indexed ip_int column
+        for hf in [cidr, ip_range]:
+            self.assertEqual((await hf.preview(inventory=HostInventory(enabled=False)))["count"],
+                             len(await self.ips(hf)))
+        # sql only filters fall back
+        self.assertIsNone(await self.mk_filter({"in_issystem": {"is": True}}).get_hosts_from_inventory(
+            inventory=self.inventory))
+        self.assertIsNone(await self.mk_filter({"not": {"ip": {"regexp": "^10"}}}).get_hosts_from_inventory(
+            inventory=self.inventory))
+
+    @async_run
+    async def test_refresh(self):
+        hf = self.mk_filter({"idc": {"is": "idc9"}})
+        self.assertListEqual(await self.ips(hf), [])
+        later = self.now + datetime.timedelta(seconds=1)
+        await self.host.bulk_upsert([{**self.mk_host(2, later), "basic": {"idc": "idc9", "machine_type": "vm"}},
+                                     {**self.mk_host(99, later), "basic": {"idc": "idc9", "machine_type": "phy"}}])
+        self.assertListEqual(await self.ips(hf), ["10.0.0.2", "10.0.9.9"])
+        self.assertEqual(len(self.inventory.snapshot), 41)
+        # the old value of the updated host is gone from its bitmaps
+        self.assertNotIn("10.0.0.2", await self.ips(self.mk_filter({"idc": {"is": "idc0"}})))
+
+    @async_run
+    async def test_host_version(self):
+        inventory = HostInventory(self.session_maker, refresh_interval=3600)
+        hf = self.mk_filter({"idc": {"is": "idc9"}})
+        self.assertListEqual(await self.ips(hf, inventory=inventory), [])
+        later = self.now + datetime.timedelta(seconds=1)
+        await self.host.bulk_upsert([{**self.mk_host(2, later), "basic": {"idc": "idc9", "machine_type": "vm"}}])
+        # within refresh_interval the snapshot is still the old table
+        self.assertListEqual(await self.ips(hf, inventory=inventory), [])
+        # a result cached under the version bumped after the write waits for the write
+        hosts = await hf.get_hosts_from_inventory([orm.t.h.ip], inventory=inventory, host_version=1)
+        self.assertListEqual([h["ip"] for h in hosts], ["10.0.0.2"])
+        self.assertEqual(inventory.host_version, 1)
+        refreshed_at = inventory.refreshed_at
+        await hf.get_hosts_from_inventory([orm.t.h.ip], inventory=inventory, host_version=1)
+        self.assertEqual(inventory.refreshed_at, refreshed_at)
+
+    @async_run
+    async def test_preview(self):
+        expect = self.expect(lambda h: h["basic"]["idc"] == "idc1")
+        hf = self.mk_filter({"idc": {"in": ["idc1"]}})
+        for inventory in [self.inventory, HostInventory(enabled=False)]:
+            preview = await hf.preview(sample_size=3, inventory=inventory)
+            self.assertEqual(preview["count"], len(expect))
+            self.assertEqual(len(preview["sample"]), 3)
+            self.assertTrue({h["ip"] for h in preview["sample"]}.issubset(expect))
+        preview = await self.mk_filter({"idc": {"is": "idc9"}}).preview(inventory=self.inventory)
+        self.assertDictEqual(preview, {"count": 0, "sample": []})
+
+    @async_run
+    async def test_facets(self):
+        hf = self.mk_filter({"zone": {"is": "z1"}})
+        hosts = [h for h in map(self.mk_host, range(40)) if h["ok"] and h["basic"]["machine_type"] != "docker"]
+        facets = await hf.facets(["idc", "env_type", "app4"], inventory=self.inventory)
+        self.assertDictEqual(facets["idc"], {"idc0": sum(h["basic"]["idc"] == "idc0" for h in hosts),
+                                             "idc1": sum(h["basic"]["idc"] == "idc1" for h in hosts)})
+        self.assertEqual(facets["app4"]["app.all"], len(hosts))
+        # one GROUP BY gives the same counts
+        sql_facets = await hf.facets(["idc", "env_type", "department"], inventory=HostInventory(enabled=False))
+        self.assertDictEqual(sql_facets["idc"], facets["idc"])
+        self.assertDictEqual(sql_facets["env_type"], facets["env_type"])
+        self.assertDictEqual(sql_facets["department"], {None: len(hosts)})
+        with self.assertRaises(host_filter.HostFilterFacetNotAllow):
+            await hf.facets(["app4"], inventory=HostInventory(enabled=False))
+        with self.assertRaises(host_filter.HostFilterFacetNotAllow):
+            await hf.facets(["basic"], inventory=self.inventory)
+
+    def test_validate(self):
+        self.mk_filter({"idc": {"in": ["idc1"]}}, {"ip": {"regexp": "^10"}}).validate()
+        for filters in [[{"no_such_item": {"is": 1}}], [{"idc": {"no_such_condition": 1}}], ["idc"]]:
+            with self.assertRaises(host_filter.HostFilterException):
+                self.mk_filter(*filters).validate()
+
+    @async_run
+    async def tearDown(self):
+        self.engine.dispose()
+        self.db_dir.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
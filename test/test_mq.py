@@ -0,0 +1,288 @@
+import logging
+import threading
+import unittest
+
+import fakeredis
+
+from op_center.basic import cfg, TASK_STATUS_ROUTER, TASK_STATUS_RUNNING, TASK_STATUS_FINISH, TASK_STATUS_SUCCESS, \
+    TASK_STATUS_FAILURE, TASK_PRIORITIES, TASK_PRIORITY_NORMAL, TASK_PRIORITY_URGENT, TASK_PRIORITY_BULK
+from op_center.mq.scripts import SET_TASK_STATUS, ENQUEUE_TASK, DEQUEUE_TASK, ACK_TASK, RECLAIM_EXPIRED_TASKS, \
+    RECLAIM_PROCESSING_TASKS, START_TASK, RELEASE_TASK, REQUEUE_TASK, RENEW_LEASE
+from op_center.worker.mq import WorkerMQ
+
+logger = logging.getLogger(__name__)
+
+
+class TestWorkerMQ(unittest.TestCase):
+    """lua scripts on a fakeredis stand-in(lupa runs the lua)"""
+
+    def setUp(self):
+        self.target = WorkerMQ(link_kwargs=cfg["mq"]["main"])
+        self.target.conn = fakeredis.FakeRedis(decode_responses=True)
+        self.key = self.target.TASK_STATUS_PREFIX + "t1"
+
+    def status(self):
+        return {k: int(v) for k, v in self.target.conn.hgetall(self.key).items() if v.lstrip("-").isdigit()}
+
+    def test_x(self):
+        self.target.run_script(SET_TASK_STATUS, keys=[self.key],
+                               args=["task_status", TASK_STATUS_RUNNING, "total", 3, TASK_STATUS_ROUTER, 3])
+        for _ in range(3):
+            self.target.host_running("t1")
+        self.assertEqual(self.status()[TASK_STATUS_RUNNING], 3)
+        self.assertEqual(self.status()[TASK_STATUS_ROUTER], 0)
+
+        self.assertTupleEqual(self.target.host_finish("t1", TASK_STATUS_SUCCESS), (1, 3))
+        # scripts are loaded again after a redis restart
+        self.target.conn.script_flush()
+        self.assertTupleEqual(self.target.host_finish("t1", TASK_STATUS_FAILURE), (2, 3))
+        self.assertEqual(self.target.conn.xlen(self.target.TASK_EVENTS_KEY), 0)
+        self.assertTupleEqual(self.target.host_finish("t1", TASK_STATUS_SUCCESS), (3, 3))
+        # the last host adds the done event
+        events = self.target.conn.xrange(self.target.TASK_EVENTS_KEY)
+        self.assertListEqual([fields for _, fields in events], [{"task_id": "t1", "event": "done"}])
+        self.assertDictEqual(self.status(), {"total": 3, TASK_STATUS_ROUTER: 0, TASK_STATUS_RUNNING: 0,
+                                             TASK_STATUS_FINISH: 3, TASK_STATUS_SUCCESS: 2, TASK_STATUS_FAILURE: 1})
+        self.assertEqual(self.target.conn.hget(self.key, "task_status"), TASK_STATUS_RUNNING)
+
+
+class TestAdmission(unittest.TestCase):
+    """admission scripts, ENQUEUE_TASK from concurrent clients of one fakeredis server"""
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.conn = self.mk_mq().conn
+
+    def mk_mq(self):
+        mq = WorkerMQ(link_kwargs=cfg["mq"]["main"])
+        mq.conn = fakeredis.FakeRedis(server=self.server, decode_responses=True)
+        return mq
+
+    @staticmethod
+    def keys(group):
+        return ["{task_queue}_admission_limits_global", "{task_queue}_admission_usage_global",
+                f"{{task_queue}}_admission_limits_group_{group}", f"{{task_queue}}_admission_usage_group_{group}",
+                "{task_queue}_admission_limits_group_default", "{task_queue}_admission_tasks",
+                "{task_queue}_admission_stats"]
+
+    @staticmethod
+    def queue_keys():
+        return ["task_queue", *(f"{{task_queue}}_{suffix}"
+                                for suffix in ["positions", "sched_state", "weights", "signal", "stats"])]
+
+    @classmethod
+    def enqueue(cls, mq, task_id, group="g1", weight=1, now=100, level=TASK_PRIORITY_NORMAL):
+        return mq.run_script(ENQUEUE_TASK,
+                             keys=[*cls.keys(group), *cls.queue_keys(),
+                                   "tasK_info_" + task_id, "task_status_" + task_id],
+                             args=[task_id, weight, now, group, level, f'{{"id": "{task_id}"}}', "task_status", "queue",
+                                   "total", weight])
+
+    def start(self, task_id, group="g1", weight=1, now=110):
+        return self.mk_mq().run_script(START_TASK, keys=self.keys(group), args=[task_id, weight, now, group])
+
+    def release(self, task_id, group="g1"):
+        return self.mk_mq().run_script(RELEASE_TASK, keys=self.keys(group), args=[task_id])
+
+    def usage(self, scope):
+        return {k: int(v) for k, v in self.conn.hgetall("{task_queue}_admission_usage_" + scope).items()}
+
+    def test_concurrent_enqueue(self):
+        capacity = 5
+        mq = self.mk_mq()
+        # no limit -> unlimited
+        self.assertListEqual(self.enqueue(mq, "t0"), [1, 1])
+        self.assertEqual(self.release("t0"), 1)
+        mq.conn.delete("{task_queue}_normal_g1")
+        mq.conn.hset("{task_queue}_admission_limits_global", "queued_tasks", capacity)
+
+        results = {}
+
+        def push(n):
+            client = self.mk_mq()
+            for i in range(10):
+                task_id = f"t{n}_{i}"
+                results[task_id] = self.enqueue(client, task_id)
+
+        threads = [threading.Thread(target=push, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        accepted = sorted(task_id for task_id, result in results.items() if result[0])
+        self.assertEqual(len(accepted), capacity)
+        self.assertListEqual(sorted(mq.conn.lrange("{task_queue}_normal_g1", 0, -1)), accepted)
+        self.assertEqual(self.usage("global")["queued_tasks"], capacity)
+        for task_id, result in results.items():
+            if not result[0]:
+                self.assertListEqual(result, [0, "global", "queued_tasks", capacity, capacity])
+            # a rejected push writes nothing
+            self.assertEqual(mq.conn.exists("tasK_info_" + task_id, "task_status_" + task_id),
+                             2 if result[0] else 0)
+        self.assertEqual(int(mq.conn.hget("{task_queue}_admission_stats", "global:rejected_queued")), 80 - capacity)
+
+    def test_x(self):
+        mq = self.mk_mq()
+        self.conn.hset("{task_queue}_admission_limits_global", mapping={"running_tasks": 3, "running_hosts": 100})
+        self.conn.hset("{task_queue}_admission_limits_group_default", "running_tasks", 1)
+        self.conn.hset("{task_queue}_admission_limits_group_g2", "running_tasks", 2)
+        for task_id, group, weight in [("a1", "g1", 10), ("a2", "g1", 10),
+                                       ("b1", "g2", 80), ("b2", "g2", 20), ("big", "g3", 500)]:
+            self.assertEqual(self.enqueue(mq, task_id, group=group, weight=weight)[0], 1)
+        self.assertDictEqual(self.usage("global"), {"queued_tasks": 5, "queued_hosts": 620})
+
+        self.assertListEqual(self.start("a1", weight=10), [1, "10"])
+        # group default limit
+        self.assertListEqual(self.start("a2", weight=10), [0, "group", "running_tasks", 1, 1])
+        self.assertEqual(self.start("b1", group="g2", weight=80)[0], 1)
+        # weighted by hosts: 10 + 80 + 20 > 100
+        self.assertListEqual(self.start("b2", group="g2", weight=20), [0, "global", "running_hosts", 90, 100])
+        self.assertDictEqual(self.usage("global"), {"queued_tasks": 3, "queued_hosts": 530,
+                                                    "running_tasks": 2, "running_hosts": 90})
+        # started again after a lease expired, not counted twice
+        self.assertEqual(self.start("b1", group="g2", weight=80)[0], 1)
+        self.assertEqual(self.usage("group_g2")["running_tasks"], 1)
+
+        self.assertEqual(self.release("a1"), 1)
+        self.assertEqual(self.release("a1"), 0)
+        self.assertEqual(self.release("b1", group="g2"), 1)
+        self.assertEqual(self.start("b2", group="g2", weight=20, now=130)[0], 1)
+        self.assertEqual(self.release("b2", group="g2"), 1)
+        # heavier than the host limit, runs when it is alone
+        self.assertEqual(self.start("big", group="g3", weight=500)[0], 1)
+        self.assertDictEqual(self.usage("global"), {"queued_tasks": 1, "queued_hosts": 10,
+                                                    "running_tasks": 1, "running_hosts": 500})
+
+        stats = self.conn.hgetall("{task_queue}_admission_stats")
+        self.assertEqual(stats["group:rejected_running"], "1")
+        self.assertEqual(stats["global:rejected_running"], "1")
+        self.assertEqual(stats["started"], "4")
+        self.assertEqual(float(stats["wait_seconds"]), 10 + 10 + 30 + 10)
+        self.assertEqual(float(stats["max_wait_seconds"]), 30)
+
+
+class TestTaskQueue(unittest.TestCase):
+    """priority levels, fair share between groups and leases of the dequeue scripts"""
+    LEASES = "{task_queue}_leases"
+    OWNERS = "{task_queue}_lease_owners"
+
+    def setUp(self):
+        self.target = WorkerMQ(link_kwargs=cfg["mq"]["main"])
+        self.target.conn = fakeredis.FakeRedis(decode_responses=True)
+
+    def enqueue(self, task_id, group, weight=1, level=TASK_PRIORITY_NORMAL, now=100):
+        self.assertEqual(TestAdmission.enqueue(self.target, task_id, group=group, weight=weight, now=now,
+                                               level=level)[0], 1)
+
+    def lease_keys(self, master):
+        return [*TestAdmission.queue_keys(), "{task_queue}_processing_" + master, self.LEASES, self.OWNERS]
+
+    def pop(self, master="m1", now=110, deadline=200):
+        popped = self.target.run_script(DEQUEUE_TASK, keys=self.lease_keys(master),
+                                        args=[now, deadline, *TASK_PRIORITIES])
+        return popped[0] if popped else None
+
+    def ack(self, master, task_id):
+        return self.target.run_script(ACK_TASK, keys=[*self.lease_keys(master), "running_tasks"], args=[task_id])
+
+    def reclaim_expired(self, now):
+        return self.target.run_script(RECLAIM_EXPIRED_TASKS, keys=self.lease_keys(""), args=[now])
+
+    def test_fair_share(self):
+        # a mass rollout queued first does not hold back the small tasks of another group
+        for i in range(3):
+            self.enqueue(f"big{i}", "g1", weight=1000)
+        for i in range(3):
+            self.enqueue(f"small{i}", "g2", weight=1)
+        self.assertListEqual([self.pop() for _ in range(6)], ["big0", "small0", "small1", "small2", "big1", "big2"])
+        self.assertIsNone(self.pop())
+
+        # urgent first, weights: g1 counts 1000 times g2
+        self.target.conn.flushall()
+        self.target.conn.hset("{task_queue}_weights", "g1", 1000)
+        for i in range(2):
+            self.enqueue(f"g1_{i}", "g1", weight=1000)
+            self.enqueue(f"g2_{i}", "g2", weight=1)
+        self.enqueue("bulk", "g2", level=TASK_PRIORITY_BULK)
+        self.enqueue("fix", "g3", level=TASK_PRIORITY_URGENT)
+        self.assertListEqual([self.pop() for _ in range(6)], ["fix", "g1_0", "g2_0", "g1_1", "g2_1", "bulk"])
+
+        stats = self.target.conn.hgetall("{task_queue}_stats")
+        self.assertEqual(stats["normal:dequeued"], "4")
+        self.assertEqual(stats["normal:g2:dequeued"], "2")
+        self.assertEqual(float(stats["urgent:g3:wait_seconds"]), 10)
+        # a push leaves a signal token for blocked masters
+        self.assertEqual(self.target.conn.llen("{task_queue}_signal"), 6)
+
+    def test_lease(self):
+        for task_id in ["t1", "t2", "t3"]:
+            self.enqueue(task_id, "g1")
+        self.assertEqual(self.pop("m1", deadline=100), "t1")
+        self.assertEqual(self.pop("m2", deadline=200), "t2")
+        self.assertEqual(self.ack("m2", "t2"), 1)
+        self.assertSetEqual(self.target.conn.smembers("running_tasks"), {"t2"})
+        self.assertFalse(self.target.conn.hexists("{task_queue}_positions", "t2"))
+
+        # m1 crashed, its lease expires and t1 is the next one popped
+        self.assertListEqual(self.reclaim_expired(150), ["t1"])
+        self.assertEqual(self.ack("m1", "t1"), 0)
+        self.assertEqual(self.pop("m2", deadline=300), "t1")
+        self.assertEqual(self.pop("m2", deadline=300), "t3")
+
+        # m2 restarts: both go back in the order they were popped
+        reclaimed = self.target.run_script(RECLAIM_PROCESSING_TASKS, keys=self.lease_keys("m2"), args=[160])
+        self.assertListEqual(sorted(reclaimed), ["t1", "t3"])
+        self.assertEqual(self.target.conn.zcard(self.LEASES), 0)
+        self.assertEqual(self.target.conn.hlen(self.OWNERS), 0)
+        self.assertEqual(self.pop("m2", deadline=400), "t1")
+        self.assertEqual(self.pop("m2", deadline=400), "t3")
+        self.assertListEqual(self.reclaim_expired(350), [])
+
+        # rejected by admission: back to its queue
+        self.assertEqual(self.target.run_script(REQUEUE_TASK, keys=self.lease_keys("m2"), args=["t3", 170]), 1)
+        self.assertEqual(self.pop("m1", deadline=500), "t3")
+
+        # left in the single fifo queue by an older version
+        self.target.conn.lpush("task_queue", "old")
+        self.assertEqual(self.pop("m1"), "old")
+        self.assertIsNone(self.pop("m1"))
+
+        # but the per task keys every key is in the slot of task_queue, a redis cluster runs the scripts on one node
+        per_task = ("tasK_info_", "task_status_", "running_tasks")
+        for key in self.target.conn.keys():
+            if not key.startswith(per_task):
+                self.assertTrue(key.startswith("{task_queue}_"), key)
+
+
+    def test_renew(self):
+        def renew(master, deadline):
+            return self.target.run_script(RENEW_LEASE, keys=self.lease_keys(master), args=["t1", deadline])
+
+        def start(master):
+            return self.target.run_script(START_TASK, keys=[*TestAdmission.keys("g1"), self.OWNERS,
+                                                            "{task_queue}_processing_" + master],
+                                          args=["t1", 1, 360, "g1"])
+
+        self.enqueue("t1", "g1")
+        self.assertEqual(self.pop("m1", deadline=100), "t1")
+        self.assertEqual(renew("m2", 300), 0)
+        self.assertEqual(renew("m1", 300), 1)
+        self.assertListEqual(self.reclaim_expired(150), [])
+
+        # m1 stalled past its deadline, the task is leased to m2
+        self.assertListEqual(self.reclaim_expired(350), ["t1"])
+        self.assertEqual(self.pop("m2", deadline=500), "t1")
+        self.assertEqual(renew("m1", 600), 0)
+        self.assertListEqual(start("m1"), [-1])
+        self.assertEqual(start("m2")[0], 1)
+        # and m1 can't take it back from m2
+        self.assertEqual(self.ack("m1", "t1"), 0)
+        self.assertEqual(self.target.run_script(REQUEUE_TASK, keys=self.lease_keys("m1"), args=["t1", 360]), 0)
+        self.assertEqual(self.target.conn.hget(self.OWNERS, "t1"), "{task_queue}_processing_m2")
+        self.assertEqual(self.ack("m2", "t1"), 1)
+        self.assertSetEqual(self.target.conn.smembers("running_tasks"), {"t1"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,20 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import tempfile
+import time
 import unittest
 
-from op_center.server import orm
+import sqlalchemy as sa
+
+from op_center.basic import DB_ENGINE_THREAD, DB_ENGINE_ASYNC, LazyJson, serializer
+from op_center.server import orm, table
 from test import async_run
 
+logger = logging.getLogger(__name__)
+
 
 class TestABCDB(unittest.TestCase):
     class Sample(orm.ABCOrm):
@@ -37,6 +49,22 @@ class TestABCDB(unittest.TestCase):
         exists = await self.target.exists(orm.t.g.name == "test")
         self.assertFalse(exists)
 
+    @async_run
+    async def test_statement_count(self):
+        await self.target.create(name="test")
+        for f in [self.target.only_or_raise, self.target.only_or_none,
+                  self.target.exists, self.target.not_exist_or_raise]:
+            before = self.target.statement_count
+            try:
+                await f(orm.t.g.name == "not exist")
+            except orm.QueryResultException:
+                pass
+            logger.info(f"{f.__name__} issued {self.target.statement_count - before} statements")
+            self.assertEqual(self.target.statement_count - before, 1)
+        cardinality, row = await self.target.fetch_cardinality(orm.t.g.name == "test")
+        self.assertEqual(cardinality, orm.CARDINALITY_ONE)
+        self.assertEqual(row["name"], "test")
+
     @async_run
     async def tearDown(self):
         await self.target.query_delete(orm.t.g.name == "test")
@@ -59,5 +87,254 @@ class TestGroup(unittest.TestCase):
         await self.target.query_delete(orm.t.g.name == "test1")
 
 
+class TestIdentityMap(unittest.TestCase):
+
+    def test_x(self):
+        target = orm.IdentityMap()
+        row = {"id": 1, "status": {"task_status": "queue"}, "hosts": ["10.0.0.1"], "result": LazyJson('{"a": 1}')}
+        target.set("task", 1, row)
+        row["status"]["task_status"] = "running"
+        cached = target.get("task", 1)
+        self.assertEqual(cached["status"]["task_status"], "queue")
+        # json values handed out can be changed freely
+        cached["hosts"].append("10.0.0.2")
+        cached["result"].value["a"] = 2
+        self.assertListEqual(target.get("task", 1)["hosts"], ["10.0.0.1"])
+        self.assertEqual(target.get("task", 1)["result"]["a"], 1)
+        target.invalidate("task")
+        self.assertIsNone(target.get("task", 1))
+
+
+class TestUnitOfWork(unittest.TestCase):
+
+    @async_run
+    async def test_x(self):
+        async with orm.UnitOfWork() as session:
+            await orm.Group(session=session).count()
+            self.assertEqual((await orm.Group(session=session).get_or_raise(1))["name"], "admins")
+        metrics = orm.pool_metrics.snapshot()
+        logger.info(metrics)
+        self.assertEqual(metrics["checked_out"], 0)
+
+
+class TestBulk(unittest.TestCase):
+    """bulk_upsert / bulk_update / keyset reads against the sqlite equivalent statements"""
+
+    @async_run
+    async def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.db_dir.name, "test.sqlite")
+        self.engine, session_maker = orm.create_session_maker(f"sqlite:///{self.db_file}")
+        table.meta.metadata.create_all(self.engine, tables=[table.Host.__table__])
+        self.target = orm.Host(session=session_maker())
+
+    @async_run
+    async def test_x(self):
+        rows = [{"ip": f"10.0.0.{i}", "basic": {"idc": "idc1"}, "envs": {}, "ok": False} for i in range(10)]
+        await self.target.bulk_upsert(rows, batch_size=3)
+        before = self.target.statement_count
+        await self.target.bulk_upsert([{**r, "ok": True} for r in rows[5:]] +
+                                      [{"ip": "10.0.1.1", "basic": {}, "envs": {}, "ok": True}], batch_size=3)
+        self.assertEqual(self.target.statement_count - before, 2)
+        self.assertEqual(await self.target.count(), 11)
+        self.assertEqual(await self.target.count(orm.t.h.ok == True), 6)
+        # insert ignore
+        await self.target.bulk_upsert([{**rows[0], "ok": True},
+                                       {"ip": "10.0.1.2", "basic": {}, "envs": {}, "ok": True}], update_columns=[])
+        self.assertEqual(await self.target.count(), 12)
+        self.assertEqual(await self.target.count(orm.t.h.ok == True), 7)
+
+        await self.target.bulk_update([{"ip": r["ip"], "envs": {"ARGS_IP": r["ip"]}} for r in rows])
+        host = await self.target.only_or_raise(orm.t.h.ip == "10.0.0.3", columns=[orm.t.h.envs, orm.t.h.basic])
+        self.assertDictEqual(host, {"envs": {"ARGS_IP": "10.0.0.3"}, "basic": {"idc": "idc1"}})
+
+    @async_run
+    async def test_lazy_columns(self):
+        now = datetime.datetime.now()
+        await self.target.bulk_upsert([{"ip": "10.0.0.1", "basic": {}, "envs": {}, "ok": True,
+                                        "issystem": {"zone": "z1", "app4": ["a.b"]}, "c_time": now, "m_time": now}])
+        host, = await self.target.query()
+        self.assertNotIn("issystem", host)
+        self.assertEqual(host["zone"], "z1")
+
+        host = await self.target.only_or_raise(orm.t.h.ip == "10.0.0.1")
+        self.assertIsInstance(host["issystem"], LazyJson)
+        self.assertFalse(host["issystem"].decoded)
+        self.assertListEqual(host["issystem"]["app4"], ["a.b"])
+        self.assertEqual(json.loads(serializer(host))["issystem"]["zone"], "z1")
+        # a lazy value written back is stored as the json it holds
+        await self.target.query_update(orm.t.h.ip == "10.0.0.1", envs=host["issystem"])
+        host, = await self.target.query(columns=[orm.t.h.envs])
+        self.assertEqual(host["envs"], {"zone": "z1", "app4": ["a.b"]})
+
+    @async_run
+    async def test_iter_query(self):
+        await self.target.bulk_upsert([{"ip": f"10.0.0.{i:03}", "basic": {}, "envs": {}, "ok": bool(i % 2)}
+                                       for i in range(25)])
+        chunks = [rows async for rows in self.target.iter_query(orm.t.h.ok == True, columns=[orm.t.h.ok],
+                                                                chunk_size=5)]
+        self.assertListEqual([len(rows) for rows in chunks], [5, 5, 2])
+        ips = [r["ip"] for rows in chunks for r in rows]
+        self.assertListEqual(ips, sorted(ips))
+        self.assertEqual(len(set(ips)), 12)
+
+        rows, cursor = await self.target.query_page(columns=[orm.t.h.ip], limit=10)
+        self.assertEqual(cursor, "10.0.0.009")
+        rows, cursor = await self.target.query_page(columns=[orm.t.h.ip], cursor=cursor, limit=20)
+        self.assertEqual(len(rows), 15)
+        self.assertIsNone(cursor)
+
+    @async_run
+    async def tearDown(self):
+        self.engine.dispose()
+        self.db_dir.cleanup()
+
+
+class TestTaskHostResult(unittest.TestCase):
+    """task archive into task_host_result and the indexed result queries"""
+
+    @async_run
+    async def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.db_dir.name, "test.sqlite")
+        self.engine, session_maker = orm.create_session_maker(f"sqlite:///{self.db_file}")
+        table.meta.metadata.create_all(self.engine, tables=[table.Task.__table__, table.TaskHostResult.__table__])
+        self.session = session_maker()
+        self.target = orm.Task(session=self.session)
+        with self.engine.begin() as conn:
+            conn.execute(table.Task.__table__.insert(),
+                         {"id": "t1", "operation_id": 1, "hosts": ["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+                          "workflow": {}, "runner": "tester", "status": {}, "result": {}})
+
+    @async_run
+    async def test_x(self):
+        results = {
+            "10.0.0.1": {"status": "success", "code": 0, "c_time": 1.0, "f_time": 2.0, "stdout": "ok"},
+            "10.0.0.2": {"status": "failure", "code": 1, "c_time": 1.0, "f_time": 11.0, "stderr": "bad"},
+        }
+        await self.target.archive("t1", hosts=["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+                                  status={"task_status": "finish"}, results=results, f_time=None)
+        task = await self.target.only_or_raise(orm.t.tsk.id == "t1", columns=[orm.t.tsk.result])
+        self.assertEqual(task["result"], {})
+
+        host_result = orm.TaskHostResult(session=self.session)
+        self.assertDictEqual(await host_result.code_map("t1"), {None: 1, 0: 1, 1: 1})
+        self.assertListEqual([r["ip"] for r in await host_result.parse("t1", success=False)],
+                             ["10.0.0.2", "10.0.0.3"])
+        self.assertListEqual([r["ip"] for r in await host_result.parse("t1", finish=True, cost_gt=5)],
+                             ["10.0.0.2"])
+        failure, = await host_result.parse("t1", code=1)
+        self.assertEqual(failure["stderr"], "bad")
+        not_begin, = await host_result.parse("t1", finish=False)
+        self.assertEqual(not_begin["status"], "not_begin")
+
+    @async_run
+    async def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.db_dir.cleanup()
+
+
+class TestReplicaRouter(unittest.TestCase):
+    """reads go to the replica until the unit of work writes or the replica lags, two sqlite files stand in"""
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_files = [os.path.join(self.db_dir.name, f"{name}.sqlite") for name in ["primary", "replica"]]
+        (self.primary_engine, self.primary), (self.replica_engine, replica) = \
+            [orm.create_session_maker(f"sqlite:///{f}") for f in self.db_files]
+        for _engine, ip in [(self.primary_engine, "10.0.0.1"), (self.replica_engine, "10.0.0.2")]:
+            table.meta.metadata.create_all(_engine, tables=[table.Host.__table__])
+            with _engine.begin() as conn:
+                conn.execute(table.Host.__table__.insert(), {"ip": ip, "basic": {}, "envs": {}, "ok": True})
+        self.lag = 0
+        self.router = orm.ReplicaRouter([replica], max_lag=5, check_interval=0, lag_check=lambda conn: self.lag)
+
+    async def ips(self, host):
+        return [h["ip"] for h in await host.query(columns=[orm.t.h.ip])]
+
+    @async_run
+    async def test_x(self):
+        async with orm.UnitOfWork(self.primary) as session:
+            host = orm.Host(session=session, router=self.router)
+            self.assertListEqual(await self.ips(host), ["10.0.0.2"])
+            self.assertEqual(await host.count(), 1)
+            await host.create(ip="10.0.0.3", basic={}, envs={}, ok=True)
+            # read your own writes
+            self.assertListEqual(await self.ips(host), ["10.0.0.1", "10.0.0.3"])
+
+        self.lag = 10
+        async with orm.UnitOfWork(self.primary) as session:
+            host = orm.Host(session=session, router=self.router)
+            self.assertListEqual(await self.ips(host), ["10.0.0.1", "10.0.0.3"])
+        self.assertEqual(self.router.fallback, 1)
+
+    def tearDown(self):
+        self.primary_engine.dispose()
+        self.replica_engine.dispose()
+        self.db_dir.cleanup()
+
+
+class TestEngineBenchmark(unittest.TestCase):
+    """
+    thread executor vs native asyncio engine against a local sqlite stand-in:
+    both answer the same concurrent workload and give every connection back, requests/s are logged
+    """
+    HOSTS = 500
+    REQUESTS = 1000
+    CONCURRENCY = 100
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.db_dir.name, "bench.sqlite")
+        sync_engine, _ = orm.create_session_maker(f"sqlite:///{self.db_file}")
+        table.meta.metadata.create_all(sync_engine, tables=[table.Host.__table__])
+        with sync_engine.begin() as conn:
+            conn.execute(table.Host.__table__.insert(),
+                         [{"ip": f"10.0.{i // 256}.{i % 256}", "basic": {}, "envs": {}, "ok": bool(i % 2)}
+                          for i in range(self.HOSTS)])
+        sync_engine.dispose()
+        self.makers = {
+            DB_ENGINE_THREAD: orm.create_session_maker(f"sqlite:///{self.db_file}", mode=DB_ENGINE_THREAD,
+                                                       poolclass=sa.pool.QueuePool, pool_size=20,
+                                                       connect_args={"check_same_thread": False}),
+            DB_ENGINE_ASYNC: orm.create_session_maker(f"sqlite+aiosqlite:///{self.db_file}", mode=DB_ENGINE_ASYNC,
+                                                      poolclass=sa.pool.AsyncAdaptedQueuePool, pool_size=20),
+        }
+
+    async def bench(self, session_maker):
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+
+        async def one_request(i):
+            async with semaphore, orm.UnitOfWork(session_maker) as session:
+                return await orm.Host(session=session).query(orm.t.h.ip == f"10.0.{i // 256}.{i % 256}",
+                                                             columns=[orm.t.h.ip, orm.t.h.ok])
+
+        start = time.time()
+        results = await asyncio.gather(*[one_request(i % self.HOSTS) for i in range(self.REQUESTS)])
+        cost = time.time() - start
+        return results, self.REQUESTS / cost
+
+    @async_run
+    async def test_x(self):
+        expect = [[{"ip": f"10.0.{i // 256}.{i % 256}", "ok": bool(i % 2)}]
+                  for i in (n % self.HOSTS for n in range(self.REQUESTS))]
+        for mode, (_engine, session_maker) in self.makers.items():
+            results, rps = await self.bench(session_maker)
+            self.assertListEqual([[dict(row) for row in r] for r in results], expect, mode)
+            self.assertEqual(_engine.pool.checkedout(), 0, mode)
+            logger.info(f"db engine {mode}: {rps:.2f} requests/s "
+                        f"(concurrency={self.CONCURRENCY}, requests={self.REQUESTS})")
+
+    @async_run
+    async def tearDown(self):
+        for mode, (_engine, _) in self.makers.items():
+            if mode == DB_ENGINE_ASYNC:
+                await _engine.dispose()
+            else:
+                _engine.dispose()
+        self.db_dir.cleanup()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+import json
+import logging
+import unittest
+
+from op_center.mq.result_codec import ResultCodec, truncate_output
+
+logger = logging.getLogger(__name__)
+
+
+class TestResultCodec(unittest.TestCase):
+
+    def mk_result(self, steps=3, size=2000):
+        history = [{"code": 0, "stdout": f"line of step {i}\n" * (size // 15), "stderr": "", "desc": f"cmd: {i}"}
+                   for i in range(steps)]
+        return {"ip": "10.0.0.1", "status": "success", "c_time": 1.5, "f_time": 2.5, "worker": None,
+                "history": history, "code": 0,
+                "stdout": "".join(h["stdout"] for h in history), "stderr": ""}
+
+    def test_x(self):
+        target = ResultCodec()
+        result = self.mk_result()
+        raw = target.encode(result)
+        self.assertEqual(raw[0], ResultCodec.FORMAT_MSGPACK_ZLIB)
+        self.assertDictEqual(target.decode(raw), result)
+        # the joined outputs are not stored a second time, compression does the rest
+        self.assertLess(len(raw) * 10, len(json.dumps(result)))
+
+        # small results are not worth compressing
+        running = {"ip": "10.0.0.1", "status": "running", "c_time": 1.5, "f_time": None, "worker": None,
+                   "history": [], "code": None, "stdout": None, "stderr": None}
+        raw = target.encode(running)
+        self.assertEqual(raw[0], ResultCodec.FORMAT_MSGPACK)
+        self.assertDictEqual(target.decode(raw), running)
+        self.assertDictEqual(ResultCodec(compress=None).decode(target.encode(result)), result)
+
+        # an output set apart from the history(work_raise) is kept
+        result["stderr"] = "boom"
+        self.assertDictEqual(target.decode(target.encode(result)), result)
+
+        # written by an older worker
+        self.assertDictEqual(target.decode(json.dumps(result)), result)
+        self.assertDictEqual(target.decode(json.dumps(result).encode()), result)
+
+    def test_diff(self):
+        target = ResultCodec()
+        result = self.mk_result(steps=2, size=30)
+        written = {k: v for k, v in result.items() if k != "history"}
+        self.assertDictEqual(target.diff(written, 2, result), {})
+        result["history"].append({"code": 1, "stdout": "more", "stderr": "error"})
+        result.update(code=1, stderr="error")
+        delta = target.diff(written, 2, result)
+        self.assertDictEqual(delta, {"code": 1, "joined": ["stderr"], "history": result["history"][2:]})
+        old = {**written, "history": result["history"][:2]}
+        self.assertDictEqual(target.fold(old, target.decode(target.encode(delta, whole=False), whole=False)),
+                             {**result, "stdout": old["stdout"]})
+
+    def test_cap_output(self):
+        self.assertEqual(truncate_output("abcdef", 6), "abcdef")
+        self.assertEqual(truncate_output("abcdefgh", 4), "ab\n...[4 chars truncated]...\ngh")
+
+        target = ResultCodec(max_output=10)
+        first = {"code": 0, "stdout": "12345678", "stderr": ""}
+        used = target.cap_output(first)
+        self.assertEqual((used, first["stdout"]), (8, "12345678"))
+        second = {"code": 1, "stdout": "abcdef", "stderr": "error"}
+        used = target.cap_output(second, used)
+        self.assertEqual(used, 10)
+        self.assertEqual(second["stdout"], "a\n...[4 chars truncated]...\nf")
+        self.assertEqual(second["stderr"], "\n...[5 chars truncated]...\n")
+        self.assertEqual(ResultCodec(max_output=None).cap_output(second, used), used)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import logging
+import unittest
+
+import fakeredis
+
+from op_center.basic import cfg, TASK_STATUS_RUNNING, TASK_STATUS_SUCCESS, TASK_STATUS_FAILURE
+from op_center.mq.result_codec import result_codec
+from op_center.server.task_result import TaskResultReader
+from op_center.worker.mq import WorkerMQ
+from test import async_run
+
+logger = logging.getLogger(__name__)
+
+
+class StreamReader:
+    """read_task_result of server.mq on the sync fakeredis client the workers write with"""
+
+    def __init__(self, worker_mq):
+        self.worker_mq = worker_mq
+        self.reads = []
+
+    async def read_task_result(self, task_id, after="0", count=1000):
+        key = self.worker_mq.TASK_RESULT_STREAM_PREFIX + task_id
+        reply = self.worker_mq.conn.xread({key: after}, count=count)
+        entries = [(entry_id.decode(), result_codec.decode_entry(fields)) for entry_id, fields in
+                   (reply[0][1] if reply else [])]
+        self.reads.append(len(entries))
+        return entries
+
+
+class TestTaskResultReader(unittest.TestCase):
+
+    def setUp(self):
+        self.worker_mq = WorkerMQ(link_kwargs=cfg["mq"]["main"])
+        self.worker_mq.conn = fakeredis.FakeRedis()
+        self.mq = StreamReader(self.worker_mq)
+        self.target = TaskResultReader(self.mq, batch_size=2)
+
+    def write(self, ip, status, code=None):
+        self.worker_mq.write_host_result("t1", ip, {
+            "ip": ip, "status": status, "code": code,
+            "f_time": None if status == TASK_STATUS_RUNNING else 1})
+
+    @async_run
+    async def test_x(self):
+        for ip in ["10.0.0.1", "10.0.0.2", "10.0.0.3"]:
+            self.write(ip, TASK_STATUS_RUNNING)
+        view = await self.target.get("t1")
+        self.assertDictEqual(view.aggregates(), {"hosts": 3, "status": {TASK_STATUS_RUNNING: 3}, "code": {}})
+        # batches of 2: 2 + 1
+        self.assertListEqual(self.mq.reads, [2, 1])
+
+        self.write("10.0.0.1", TASK_STATUS_SUCCESS, 0)
+        self.write("10.0.0.2", TASK_STATUS_FAILURE, 1)
+        self.mq.reads.clear()
+        view = await self.target.get("t1")
+        # only the new entries are read
+        self.assertListEqual(self.mq.reads, [2, 0])
+        self.assertEqual(view.results["10.0.0.2"]["code"], 1)
+        self.assertDictEqual(view.aggregates(), {
+            "hosts": 3,
+            "status": {TASK_STATUS_RUNNING: 1, TASK_STATUS_SUCCESS: 1, TASK_STATUS_FAILURE: 1},
+            "code": {0: 1, 1: 1}})
+
+        # a new reader folds the whole stream to the same view
+        other = await TaskResultReader(self.mq).get("t1")
+        self.assertDictEqual(other.results, view.results)
+        self.assertDictEqual(other.aggregates(), view.aggregates())
+
+    @async_run
+    async def test_delta(self):
+        # what ABCWorker.update_result writes for a host running 3 steps
+        result = {"ip": "10.0.0.9", "status": TASK_STATUS_RUNNING, "c_time": 1, "f_time": None, "history": [],
+                  "code": None, "stdout": None, "stderr": None}
+        written, steps = {}, 0
+        for i in range(3):
+            if i:
+                result["history"].append({"code": 0, "stdout": f"out{i}\n", "stderr": ""})
+            delta = result_codec.diff(written, steps, result)
+            self.worker_mq.write_host_delta("t1", "10.0.0.9", delta)
+            written, steps = {k: v for k, v in result.items() if k != "history"}, len(result["history"])
+            view = await self.target.get("t1")
+            self.assertDictEqual(view.results["10.0.0.9"], result)
+        result.update(status=TASK_STATUS_SUCCESS, f_time=2, code=0, stdout="out1\nout2\n", stderr="")
+        delta = result_codec.diff(written, steps, result)
+        self.assertNotIn("history", delta)
+        self.assertListEqual(delta["joined"], ["stdout"])
+        self.worker_mq.write_host_delta("t1", "10.0.0.9", delta)
+        view = await self.target.get("t1")
+        self.assertDictEqual(view.results["10.0.0.9"], result)
+        self.assertDictEqual(view.aggregates()["code"], {0: 1})
+        # each step is in the stream once
+        entries = self.worker_mq.conn.xrange(self.worker_mq.TASK_RESULT_STREAM_PREFIX + "t1")
+        self.assertEqual(sum(len(result_codec.decode_entry(f)["delta"].get("history", [])) for _, f in entries), 2)
+        self.assertDictEqual((await TaskResultReader(self.mq).get("t1")).results, view.results)
+
+
+if __name__ == '__main__':
+    unittest.main()